@@ -1,12 +1,195 @@
+"""
+AI Engine - Grid and zone based risk scoring
+Risk weights are loaded once at startup from a lat/lng grid file into a NumPy array;
+large batches are scored with vectorized lookups, single points with a scalar fast path.
+Named risk zones from zones.py raise the area weight where they apply
+"""
+import hashlib
+import math
+import os
 from datetime import datetime
+import numpy as np
+import zones
+from logger import info, error
 
-def run_ai_risk_check(lat, lng):
-    hour = datetime.now().hour
+RISK_GRID_PATH = os.getenv(
+    'RISK_GRID_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "risk_grid.csv")
+)
+RISK_GRID_RESOLUTION = float(os.getenv('RISK_GRID_RESOLUTION', 0.1))
 
-    if hour >= 22 or hour <= 5:
-        return "High", "Late night risk detected"
+# Extra risk added during late night hours (22:00-05:59)
+NIGHT_HOURS = (22, 23, 0, 1, 2, 3, 4, 5)
+NIGHT_WEIGHT = 0.6
 
-    if 12.0 <= lat <= 13.0 and 77.0 <= lng <= 78.0:
-        return "Medium", "Isolated area detected"
+# Score thresholds for each level (score is clipped to 0..1)
+HIGH_THRESHOLD = 0.6
+MEDIUM_THRESHOLD = 0.3
 
-    return "Low", "Area appears safe"
+LEVELS = np.array(["Low", "Medium", "High"])
+REASONS = np.array(["Area appears safe", "Isolated area detected", "Late night risk detected"])
+
+HOUR_WEIGHTS = np.zeros(24, dtype=np.float32)
+HOUR_WEIGHTS[list(NIGHT_HOURS)] = NIGHT_WEIGHT
+
+class RiskModel:
+    """Dense lat/lng grid of risk weights; cells outside the grid weigh 0"""
+
+    def __init__(self, lats, lngs, weights, resolution=RISK_GRID_RESOLUTION):
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float32)
+        self.resolution = resolution
+
+        if lats.size == 0:
+            self.lat0 = self.lng0 = 0.0
+            self.grid = np.zeros((0, 0), dtype=np.float32)
+            self.version = self._version()
+            return
+
+        self.lat0 = float(lats.min())
+        self.lng0 = float(lngs.min())
+        rows = np.rint((lats - self.lat0) / resolution).astype(np.int64)
+        cols = np.rint((lngs - self.lng0) / resolution).astype(np.int64)
+        self.grid = np.zeros((rows.max() + 1, cols.max() + 1), dtype=np.float32)
+        self.grid[rows, cols] = weights
+        self.version = self._version()
+
+    def _version(self):
+        """Digest of the grid, so every worker (and a restarted one) agrees on it"""
+        digest = hashlib.sha1(np.asarray([self.lat0, self.lng0, self.resolution]).tobytes())
+        digest.update(str(self.grid.shape).encode('ascii'))
+        digest.update(self.grid.tobytes())
+        return digest.hexdigest()[:12]
+
+    @classmethod
+    def from_file(cls, path, resolution=RISK_GRID_RESOLUTION):
+        """Load a grid from CSV (lat,lng,weight columns) or Parquet with the same columns"""
+        if path.endswith(".parquet"):
+            try:
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise RuntimeError("pyarrow is required to load Parquet risk grids")
+            table = pq.read_table(path, columns=["lat", "lng", "weight"])
+            lats, lngs, weights = (table.column(name).to_numpy() for name in ("lat", "lng", "weight"))
+        else:
+            data = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+            lats, lngs, weights = data[:, 0], data[:, 1], data[:, 2]
+        return cls(lats, lngs, weights, resolution)
+
+    def cell_weights(self, lats, lngs):
+        """Vectorized grid lookup for arrays of coordinates"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        # NaN/inf cast to out-of-range indexes, so they fall outside the grid
+        with np.errstate(invalid="ignore"):
+            rows = np.floor((lats - self.lat0) / self.resolution + 1e-9).astype(np.int64)
+            cols = np.floor((lngs - self.lng0) / self.resolution + 1e-9).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.grid.shape[0]) & (cols >= 0) & (cols < self.grid.shape[1])
+        weights = np.zeros(lats.shape, dtype=np.float32)
+        weights[inside] = self.grid[rows[inside], cols[inside]]
+        return weights
+
+    def cell_weight(self, lat, lng):
+        """Scalar grid lookup (avoids array allocation for single points)"""
+        if not (math.isfinite(lat) and math.isfinite(lng)):
+            # NaN/inf are outside every cell (math.floor would raise)
+            return 0.0
+        row = math.floor((lat - self.lat0) / self.resolution + 1e-9)
+        col = math.floor((lng - self.lng0) / self.resolution + 1e-9)
+        if 0 <= row < self.grid.shape[0] and 0 <= col < self.grid.shape[1]:
+            return float(self.grid[row, col])
+        return 0.0
+
+    def single_cell(self, min_lat, min_lng, max_lat, max_lng):
+        """True if the box lies within one grid cell, so every point in it has the same weight"""
+        if self.grid.size == 0:
+            return True
+        return math.floor((min_lat - self.lat0) / self.resolution + 1e-9) == \
+            math.floor((max_lat - self.lat0) / self.resolution + 1e-9) and \
+            math.floor((min_lng - self.lng0) / self.resolution + 1e-9) == \
+            math.floor((max_lng - self.lng0) / self.resolution + 1e-9)
+
+
+def load_risk_model(path=RISK_GRID_PATH):
+    """(Re)load the global risk grid"""
+    global risk_model
+    risk_model = RiskModel.from_file(path)
+    info("Risk grid loaded from %s: %sx%s cells", path, risk_model.grid.shape[0], risk_model.grid.shape[1])
+    return risk_model
+
+
+def score_points(lats, lngs, hours=None):
+    """
+    Score many points at once.
+    hours may be a scalar or an array; defaults to the current hour.
+    Returns: (scores, level_index, reason_index, zone_index) NumPy arrays;
+    reason_index is -1 where the containing zone (zone_index) supplies the reason
+    """
+    if hours is None:
+        hours = datetime.now().hour
+    index = zones.get_zone_index()
+    cell = risk_model.cell_weights(lats, lngs)
+    zone_weight, zone_index = index.max_weights(lats, lngs)
+    area = np.maximum(cell, zone_weight)
+    night = HOUR_WEIGHTS[np.asarray(hours, dtype=np.int64) % 24]
+    night = np.broadcast_to(night, cell.shape)
+    scores = np.clip(area + night, 0.0, 1.0)
+
+    level_index = (scores >= MEDIUM_THRESHOLD).astype(np.int8) + (scores >= HIGH_THRESHOLD)
+    reason_index = np.where(
+        (night > 0) & (night >= area), 2,
+        np.where((zone_index >= 0) & (zone_weight >= cell), -1,
+                 np.where(cell > 0, 1, 0))
+    )
+    return scores, level_index, reason_index, zone_index
+
+
+def run_ai_risk_check_batch(lats, lngs, hours=None):
+    """Return a list of (risk_level, reason) tuples for arrays of coordinates"""
+    index = zones.get_zone_index()
+    _, level_index, reason_index, zone_index = score_points(lats, lngs, hours)
+    reasons = REASONS[np.maximum(reason_index, 0)].astype(object)
+    from_zone = reason_index < 0
+    reasons[from_zone] = [index.zones[i].reason for i in zone_index[from_zone].tolist()]
+    return list(zip(LEVELS[level_index].tolist(), reasons.tolist()))
+
+
+def model_version():
+    """Identifies the risk grid and zone index in use; changes whenever either is reloaded"""
+    return f"{risk_model.version}.{zones.get_zone_index().version}"
+
+
+def is_uniform(min_lat, min_lng, max_lat, max_lng):
+    """
+    True if every point in the box scores the same: it lies in one grid cell and every zone
+    near it either misses it or covers all of it
+    """
+    return risk_model.single_cell(min_lat, min_lng, max_lat, max_lng) and \
+        not zones.get_zone_index().crosses(min_lat, min_lng, max_lat, max_lng)
+
+
+def run_ai_risk_check(lat, lng, hour=None):
+    """Return (risk_level, reason) for a single point at the given (default: current) hour"""
+    lat, lng = float(lat), float(lng)
+    cell = risk_model.cell_weight(lat, lng)
+    zone = zones.get_zone_index().max_zone(lat, lng)
+    area = max(cell, zone.weight) if zone else cell
+    night = float(HOUR_WEIGHTS[datetime.now().hour if hour is None else hour % 24])
+    score = min(1.0, area + night)
+
+    level = 2 if score >= HIGH_THRESHOLD else 1 if score >= MEDIUM_THRESHOLD else 0
+    if night > 0 and night >= area:
+        reason = REASONS[2]
+    elif zone and zone.weight >= cell:
+        reason = zone.reason
+    else:
+        reason = REASONS[1] if cell > 0 else REASONS[0]
+    return str(LEVELS[level]), str(reason)
+
+
+try:
+    risk_model = load_risk_model()
+except Exception as e:
+    error("Risk grid load failed, scoring on time of day only: %s", e)
+    risk_model = RiskModel([], [], [])
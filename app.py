@@ -1,11 +1,27 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
+import json
 import os
-from ai_engine import run_ai_risk_check
-from db_adapter import log_location, log_sos, log_user, log_contact, user_exists
-from database import get_user, get_user_contacts, get_user_locations, get_connection, insert_routine, get_user_routines, delete_routine
-from logger import info, error, warning, debug
+import signal
+import sys
+import time
+from db_adapter import log_location, log_locations, log_location_array, log_sos, log_user, log_contact, user_exists, location_buffer, lookup_user, lookup_contacts, lookup_sos_recipients, register_device, remove_device_tokens
+from storage import backend
+from logger import info, error, warning, debug, access, stats as logging_stats
+from metrics import Spans, SharedMetrics, set_spans, request_metrics, span
+from sos_pipeline import SOSPipeline
+from sos_fanout import SOSFanout, fcm_multicast_sender
+from outbox import Outbox, PRIORITY_INFO
+import zones
+from cache import cache
+from risk_cache import risk_cache
+import risk_tiles
+from risk_tiles import risk_tiles as tile_cache
+from wire import decode_fixes, WireFormatError
+from validators import validate_username, validate_coordinates, validate_place_radius, validate_polygon, validate_tile, validate_sos_id, validate_accuracy, validate_time_of_day
+from geofence import GeofenceEngine
+from trips import TripManager
 import firebase_admin
 from firebase_admin import credentials, messaging
 
@@ -13,6 +29,26 @@ from firebase_admin import credentials, messaging
 app = Flask(__name__)
 CORS(app)
 
+MAX_LOCATION_BATCH = int(os.getenv('MAX_LOCATION_BATCH', 1000))
+MAX_BINARY_LOCATION_BATCH = int(os.getenv('MAX_BINARY_LOCATION_BATCH', 20000))
+# Admin endpoints (/zones/reload) only answer requests from these addresses
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+# Open this process's DB connections (and, on MySQL, start location table maintenance)
+# so the first requests don't pay for them
+backend.start()
+
+# /metrics sums every worker's histograms; this process publishes its own in the background
+shared_metrics = SharedMetrics(request_metrics)
+shared_metrics.start()
+
+# Precompute risk for the busiest areas so the first fixes there are cache hits
+risk_cache.warm_from(backend.get_hot_locations)
+
+# Routine and saved-place fences, evaluated in memory on every /analyze fix; membership and
+# invalidations are shared with the other workers
+geofences = GeofenceEngine(backend.get_routine_schedule, backend.get_user_places, backend.invalidate_routine_schedule)
+
 # --- 2. FIREBASE SETUP (With Error Protection) ---
 current_directory = os.path.dirname(os.path.abspath(__file__))
 key_path = os.path.join(current_directory, "firebase_key.json")
@@ -23,9 +59,65 @@ try:
         firebase_admin.initialize_app(cred)
     info("Firebase is connected and ready!")
 except Exception as e:
-    error(f"Firebase initialization error: {e}")
+    error("Firebase initialization error: %s", e)
     error("Make sure 'firebase_key.json' is in the same folder as app.py")
 
+def _store_sos(event):
+    """Write an SOS event to sos_logs, raising if it was not stored"""
+    success, message = log_sos(event["username"], event["timestamp"])
+    if not success:
+        raise RuntimeError(message)
+
+def _send_sos_alert(event):
+    """Send the SOS push notification"""
+    msg = messaging.Message(
+        notification=messaging.Notification(
+            title="🚨 SAFEHER EMERGENCY",
+            body=f"SOS Alert: {event['name']} needs immediate help!"
+        ),
+        topic="safety"
+    )
+    with span("fcm"):
+        messaging.send(msg)
+
+# Failed topic sends and failed contact devices are both retried from this queue
+outbox = Outbox()
+
+# Each SOS also goes to the devices of the user's contacts, in multicast chunks
+sos_fanout = SOSFanout(lookup_sos_recipients, fcm_multicast_sender(messaging), remove_device_tokens, outbox)
+
+sos_pipeline = SOSPipeline(_store_sos, _send_sos_alert, sos_fanout.send, outbox=outbox)
+
+TRIP_ALERT_MESSAGES = {
+    "deviation": "{name} has gone off their planned route",
+    "long_stop": "{name} has not moved for {minutes} minutes on their journey",
+    "overdue": "{name} has not arrived after {minutes} minutes",
+    "overspeed": "{name} is travelling at {speed} km/h"
+}
+
+def _queue_trip_alert(trip, alert):
+    """Queue a journey alert for the user's contacts; the outbox sends it, so /analyze never waits on FCM"""
+    minutes = round(alert.get("stopped_seconds", 0) / 60) or alert.get("elapsed_minutes", 0)
+    event = {
+        "type": "trip_alert",
+        "alert_id": f"trip:{trip.id}:{alert['type']}:{alert['at']}",
+        "username": trip.username,
+        "name": trip.username,
+        "trip_id": trip.id,
+        "alert": alert["type"],
+        "message": TRIP_ALERT_MESSAGES[alert["type"]].format(
+            name=trip.username, minutes=minutes, speed=alert.get("speed_kmh")),
+        "timestamp": datetime.now().isoformat()
+    }
+    outbox.enqueue("trip_alert", event, PRIORITY_INFO, dedup_key=event["alert_id"])
+    outbox.start()
+
+outbox.register("trip_alert", sos_fanout.send)
+
+# Journeys in progress; fixes from /analyze are checked against the user's active trip, and
+# deviation / long-stop / overdue alerts go to the user's contacts
+trips = TripManager(notify_fn=_queue_trip_alert)
+
 # --- 3. ERROR HANDLER ---
 @app.errorhandler(400)
 def bad_request(error):
@@ -40,21 +132,64 @@ def not_found(error):
     return jsonify({"error": "Not Found", "message": "Endpoint does not exist"}), 404
 
 @app.errorhandler(500)
-def internal_error(error):
-    error(f"Internal Server Error: {error}")
+def internal_error(e):
+    error("Internal Server Error: %s", e)
     return jsonify({"error": "Internal Server Error", "message": "Please try again later"}), 500
 
-# --- 4. API ENDPOINTS ---
+# --- 4. REQUEST METRICS ---
+def _route():
+    """URL rule rather than path, so /locations/<username> is one series"""
+    return request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.spans = Spans(_route())
+    set_spans(g.spans)
+
+@app.after_request
+def record_request(response):
+    """Latency histogram, status count and one JSON access log line per request"""
+    start = g.get("request_start")
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    route = g.spans.route
+    request_metrics.observe(route, request.method, response.status_code, elapsed)
+    fields = {
+        "method": request.method,
+        "route": route,
+        "path": request.path,
+        "status": response.status_code,
+        "duration_ms": round(elapsed * 1000, 3),
+        "bytes": response.content_length,
+        "remote": request.remote_addr
+    }
+    for name, seconds in g.spans.totals.items():
+        fields[f"{name}_ms"] = round(seconds * 1000, 3)
+    access(fields)
+    return response
+
+@app.teardown_request
+def end_request_spans(exc):
+    set_spans(None)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus text exposition of request and sub-span histograms, summed over every
+    worker process of this server (at most METRICS_PUBLISH_INTERVAL seconds old for the
+    workers other than the one answering), so counters don't depend on which one answers
+    """
+    return Response(shared_metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+# --- 5. API ENDPOINTS ---
 
 @app.route('/ping', methods=['GET'])
 def ping():
     """Health check with database connectivity verification"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.close()
-        conn.close()
+        backend.ping()
         info("Health check passed")
         return jsonify({
             "status": "Online",
@@ -63,7 +198,7 @@ def ping():
             "timestamp": datetime.now().isoformat()
         }), 200
     except Exception as e:
-        error(f"Health check failed: {e}")
+        error("Health check failed: %s", e)
         return jsonify({
             "status": "Online",
             "project": "SAFEHER",
@@ -83,20 +218,20 @@ def register():
     
     # Validate all required fields
     if not all([username, password, email, pin]):
-        warning(f"Registration attempt with missing fields: {username}")
+        warning("Registration attempt with missing fields: %s", username)
         return jsonify({"error": "Missing required fields: username, password, email, pin"}), 400
     
     # Log attempt
-    debug(f"Registration attempt for username: {username}")
+    debug("Registration attempt for username: %s", username)
     
     # Register user
     success, message = log_user(username, password, email, pin)
     
     if success:
-        info(f"User registered successfully: {username}")
+        info("User registered successfully: %s", username)
         return jsonify({"status": "Success", "message": message}), 201
     else:
-        warning(f"Registration failed for {username}: {message}")
+        warning("Registration failed for %s: %s", username, message)
         return jsonify({"error": "Registration failed", "message": message}), 400
 
 @app.route('/analyze', methods=['POST'])
@@ -115,28 +250,182 @@ def analyze():
     
     # Validate location
     if lat is None or lng is None:
-        warning(f"Analyze request from {username} without location")
+        warning("Analyze request from %s without location", username)
         return jsonify({"error": "Location required"}), 400
     
-    debug(f"Analyzing location for {username}: lat={lat}, lng={lng}")
+    # Scoring, fences and trips all need finite in-range numbers
+    valid, msg = validate_coordinates(lat, lng)
+    if not valid:
+        warning("Analyze request from %s with invalid location: %s", username, msg)
+        return jsonify({"error": "Invalid location", "message": msg}), 400
+    
+    lat, lng = float(lat), float(lng)
+    debug("Analyzing location for %s: lat=%s, lng=%s", username, lat, lng)
     
     # Log location
     success, message = log_location(username, lat, lng, accuracy)
     if not success:
-        warning(f"Location logging failed for {username}: {message}")
+        warning("Location logging failed for %s: %s", username, message)
     
-    # Run AI risk check
-    risk, reason = run_ai_risk_check(lat, lng)
+    # Run AI risk check (memoized per geohash cell and hour)
+    risk, reason = risk_cache.check(lat, lng)
     
-    info(f"Risk analysis completed for {username}: {risk}")
+    info("Risk analysis completed for %s: %s", username, risk)
+    
+    # Routine and saved-place fences (no query once the user's fences are cached)
+    try:
+        geofence = geofences.evaluate(username, lat, lng)
+    except Exception as e:
+        warning("Geofence evaluation failed for %s: %s", username, e)
+        geofence = None
+    
+    # Journey mode: O(1) deviation / speed / stop checks against the active trip
+    trip_state = None
+    try:
+        # An unusable accuracy (already reported by log_location) counts as unknown
+        fix_accuracy = float(accuracy) if accuracy and validate_accuracy(accuracy)[0] else 0.0
+        trip, alerts = trips.add_fix(username, lat, lng, fix_accuracy)
+        if trip is not None:
+            trip_state = {**trip.to_dict(), "new_alerts": alerts}
+    except Exception as e:
+        warning("Trip update failed for %s: %s", username, e)
     
     return jsonify({
         "risk_level": risk,
         "reason": reason,
         "time": datetime.now().strftime("%H:%M"),
-        "location_logged": success
+        "location_logged": success,
+        "geofence": geofence,
+        "trip": trip_state
     }), 200
 
+@app.route('/risk/tile/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def risk_tile(z, x, y):
+    """Risk heatmap grid for one XYZ map tile (read-only; see risk_tiles.py for the encodings)"""
+    size = request.args.get('size', risk_tiles.RISK_TILE_SIZE, type=int)
+    hour = request.args.get('hour', datetime.now().hour, type=int)
+    binary = request.args.get('format', 'json') == 'binary'
+    
+    valid, msg = validate_tile(z, x, y, size)
+    if not valid:
+        return jsonify({"error": "Invalid tile", "message": msg}), 400
+    if not 0 <= hour <= 23:
+        return jsonify({"error": "Hour must be between 0 and 23"}), 400
+    
+    # The ETag only depends on the request and the model version, so a revalidation costs no scoring
+    etag = tile_cache.etag(z, x, y, size, hour) + ("-b" if binary else "")
+    if request.if_none_match.contains(etag):
+        tile_cache.not_modified += 1
+        response = Response(status=304)
+    else:
+        levels, scores = tile_cache.get(z, x, y, size, hour)
+        if binary:
+            response = Response(risk_tiles.encode_binary(levels, scores), mimetype=risk_tiles.CONTENT_TYPE)
+        else:
+            min_lat, min_lng, max_lat, max_lng = risk_tiles.tile_bbox(z, x, y)
+            response = jsonify({
+                "z": z, "x": x, "y": y,
+                "bbox": [min_lat, min_lng, max_lat, max_lng],
+                "size": size,
+                "hour": hour,
+                "encoding": "rle",
+                "levels": risk_tiles.rle_encode(levels),
+                "scores": risk_tiles.rle_encode(scores)
+            })
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = risk_tiles.RISK_TILE_MAX_AGE
+    return response
+
+@app.route('/locations/batch', methods=['POST'])
+def ingest_locations():
+    """Ingest an array of location fixes for one user"""
+    data = request.get_json() or {}
+    username = data.get('username')
+    fixes = data.get('locations')
+    
+    if not username:
+        warning("Batch location request without username")
+        return jsonify({"error": "Username required"}), 400
+    
+    if not isinstance(fixes, list) or not fixes:
+        warning("Batch location request from %s without locations", username)
+        return jsonify({"error": "locations must be a non-empty array"}), 400
+    
+    if len(fixes) > MAX_LOCATION_BATCH:
+        return jsonify({"error": f"At most {MAX_LOCATION_BATCH} locations per batch"}), 400
+    
+    accepted, errors = log_locations(username, fixes)
+    
+    info("Batch of %d locations from %s: %d accepted", len(fixes), username, accepted)
+    
+    return jsonify({
+        "accepted": accepted,
+        "rejected": len(fixes) - accepted,
+        "errors": errors
+    }), 202 if accepted else 400
+
+@app.route('/locations/binary/<username>', methods=['POST'])
+def ingest_locations_binary(username):
+    """Ingest a packed binary batch of location fixes (see wire.py for the layout)"""
+    body = request.get_data(cache=False)
+    
+    try:
+        fixes = decode_fixes(body)
+    except WireFormatError as e:
+        warning("Malformed binary location batch from %s: %s", username, e)
+        return jsonify({"error": "Malformed payload", "message": str(e)}), 400
+    
+    if len(fixes) == 0:
+        return jsonify({"error": "Payload contains no fixes"}), 400
+    
+    if len(fixes) > MAX_BINARY_LOCATION_BATCH:
+        return jsonify({"error": f"At most {MAX_BINARY_LOCATION_BATCH} fixes per batch"}), 400
+    
+    accepted, rejected, message = log_location_array(username, fixes)
+    
+    info("Binary batch of %d locations from %s: %d accepted", len(fixes), username, accepted)
+    
+    return jsonify({
+        "accepted": accepted,
+        "rejected": len(fixes) - accepted,
+        "invalid_indexes": rejected[:100],
+        "error": message
+    }), 202 if accepted else 400
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Internal queue and latency statistics"""
+    return jsonify({
+        "location_buffer": location_buffer.stats(),
+        "sos": sos_pipeline.stats(),
+        "sos_fanout": sos_fanout.stats(),
+        "outbox": outbox.stats(),
+        "zones": zones.get_zone_index().stats(),
+        "cache": cache.stats(),
+        "risk_cache": risk_cache.stats(),
+        "risk_tiles": tile_cache.stats(),
+        "logging": logging_stats(),
+        "geofence": geofences.stats(),
+        "trips": trips.stats(),
+        **backend.stats()
+    }), 200
+
+@app.route('/zones/reload', methods=['POST'])
+def reload_risk_zones():
+    """Reload risk zones from disk without restarting (every worker picks them up within ZONES_CHECK_INTERVAL)"""
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        warning("Zone reload refused for %s", request.remote_addr)
+        return jsonify({"error": "Zone reload is only allowed from localhost"}), 403
+    try:
+        index = zones.reload_zones()
+        # Results for the old zones are keyed by the old model version; refill the hot cells
+        risk_cache.rewarm()
+        return jsonify({"status": "Success", "zones": index.stats()}), 200
+    except Exception as e:
+        error("Risk zone reload failed: %s", e)
+        return jsonify({"error": "Failed to reload zones", "message": str(e)}), 500
+
 @app.route('/sos', methods=['POST'])
 def trigger_sos():
     """Trigger SOS emergency alert"""
@@ -149,30 +438,64 @@ def trigger_sos():
         warning("SOS triggered without username")
         return jsonify({"error": "Username required"}), 400
     
-    info(f"🚨 SOS RECEIVED FROM: {username}")
+    valid, msg = validate_username(username)
+    if not valid:
+        warning("SOS triggered with invalid username: %s", msg)
+        return jsonify({"error": "Invalid username", "message": msg}), 400
     
-    # Log SOS event
-    success, message = log_sos(username)
-    if not success:
-        error(f"SOS logging failed for {username}: {message}")
+    # Optional client id for this alert; a resent request with the same id is not queued twice
+    sos_id = data.get('sos_id')
+    if sos_id is not None:
+        valid, msg = validate_sos_id(sos_id)
+        if not valid:
+            return jsonify({"error": "Invalid SOS id", "message": msg}), 400
     
-    try:
-        # Send Real Push Notification
-        msg = messaging.Message(
-            notification=messaging.Notification(
-                title="🚨 SAFEHER EMERGENCY",
-                body=f"SOS Alert: {user_name} needs immediate help!"
-            ),
-            topic="safety"
-        )
-        messaging.send(msg)
+    info("🚨 SOS RECEIVED FROM: %s", username)
+    
+    # Log SOS event and send the push notification concurrently
+    result = sos_pipeline.dispatch(username, user_name, sos_id)
+    
+    if result["sent"]:
         info("✅ FCM alert sent")
-        return jsonify({"status": "Success", "message": "FCM Alert Sent"}), 200
-    except Exception as e:
-        error("❌ FCM failed, fallback triggered")
-        error(f"ALERT: {username}")
-        warning(f"Firebase error: {e}")
-        return jsonify({"status": "Error", "message": "FCM failed but SOS logged"}), 500
+        return jsonify({"status": "Success", "message": "FCM Alert Sent", **result}), 200
+    elif result["queued_for_retry"]:
+        warning("FCM failed, SOS alert for %s queued for retry", username)
+        return jsonify({"status": "Queued", "message": "FCM failed, alert queued for retry", **result}), 202
+    else:
+        error("❌ FCM failed and the alert could not be queued")
+        error("ALERT: %s", username)
+        return jsonify({"status": "Error", "message": "FCM failed, alert not sent", **result}), 500
+
+@app.route('/device', methods=['POST'])
+def add_device():
+    """Register a device's FCM token so SOS alerts reach it when its phone is someone's contact"""
+    data = request.get_json() or {}
+    token = data.get('token')
+    phone = data.get('phone')
+    
+    if not all([token, phone]):
+        warning("Device registration with missing fields")
+        return jsonify({"error": "Missing required fields: token, phone"}), 400
+    
+    success, message = register_device(token, phone, data.get('username'), data.get('platform'))
+    
+    if success:
+        info("Device registered for %s", data.get('username') or "contact")
+        return jsonify({"status": "Success", "message": message}), 201
+    else:
+        warning("Device registration failed: %s", message)
+        return jsonify({"error": message}), 400
+
+@app.route('/device/<token>', methods=['DELETE'])
+def delete_device(token):
+    """Unregister a device token (e.g. on sign-out)"""
+    success, message = remove_device_tokens([token])
+    
+    if success:
+        return jsonify({"status": "Success", "message": message}), 200
+    else:
+        error("Device unregistration failed: %s", message)
+        return jsonify({"error": message}), 500
 
 @app.route('/contact', methods=['POST'])
 def add_contact():
@@ -188,16 +511,16 @@ def add_contact():
         warning("Add contact request with missing fields")
         return jsonify({"error": "Missing required fields: username, name, contact"}), 400
     
-    debug(f"Adding contact for {username}: {name}")
+    debug("Adding contact for %s: %s", username, name)
     
     # Add contact
     success, message = log_contact(username, name, relation, contact)
     
     if success:
-        info(f"Contact added for {username}: {name}")
+        info("Contact added for %s: %s", username, name)
         return jsonify({"status": "Success", "message": message}), 201
     else:
-        warning(f"Contact addition failed for {username}: {message}")
+        warning("Contact addition failed for %s: %s", username, message)
         return jsonify({"error": "Failed to add contact", "message": message}), 400
 
 @app.route('/contacts/<username>', methods=['GET'])
@@ -206,24 +529,25 @@ def get_contacts(username):
     if not username:
         return jsonify({"error": "Username required"}), 400
     
-    debug(f"Fetching contacts for {username}")
+    debug("Fetching contacts for %s", username)
     
     try:
-        contacts = get_user_contacts(username)
-        info(f"Retrieved {len(contacts)} contacts for {username}")
+        contacts = lookup_contacts(username)
+        info("Retrieved %s contacts for %s", len(contacts), username)
         return jsonify({
             "username": username,
             "contacts": contacts,
             "count": len(contacts)
         }), 200
     except Exception as e:
-        error(f"Error fetching contacts for {username}: {e}")
+        error("Error fetching contacts for %s: %s", username, e)
         return jsonify({"error": "Failed to fetch contacts", "message": str(e)}), 500
 
 @app.route('/locations/<username>', methods=['GET'])
 def get_locations(username):
-    """Get location history for a user"""
+    """Get location history for a user (one keyset page, or a full NDJSON stream)"""
     limit = request.args.get('limit', 50, type=int)
+    output_format = request.args.get('format', 'json')
     
     if not username:
         return jsonify({"error": "Username required"}), 400
@@ -231,42 +555,95 @@ def get_locations(username):
     if limit > 1000 or limit < 1:
         return jsonify({"error": "Limit must be between 1 and 1000"}), 400
     
-    debug(f"Fetching last {limit} locations for {username}")
+    before = None
+    if request.args.get('before'):
+        before = parse_location_cursor(request.args['before'])
+        if before is None:
+            return jsonify({"error": "before must be a '<timestamp>,<id>' cursor"}), 400
+    
+    if output_format == 'ndjson':
+        debug("Streaming location history for %s", username)
+        rows = backend.iter_user_locations(username, before)
+        return Response(
+            stream_with_context(json.dumps(row) + "\n" for row in rows),
+            mimetype='application/x-ndjson'
+        )
+    
+    debug("Fetching last %d locations for %s", limit, username)
     
     try:
-        locations = get_user_locations(username, limit)
-        info(f"Retrieved {len(locations)} location records for {username}")
+        locations = backend.get_user_locations(username, limit, before)
+        info("Retrieved %d location records for %s", len(locations), username)
+        next_cursor = None
+        if len(locations) == limit:
+            last = locations[-1]
+            next_cursor = f"{last['timestamp']},{last['id']}"
         return jsonify({
             "username": username,
             "locations": locations,
-            "count": len(locations)
+            "count": len(locations),
+            "next_cursor": next_cursor
         }), 200
     except Exception as e:
-        error(f"Error fetching locations for {username}: {e}")
+        error("Error fetching locations for %s: %s", username, e)
         return jsonify({"error": "Failed to fetch locations", "message": str(e)}), 500
 
+@app.route('/locations/<username>/track', methods=['GET'])
+def get_location_track(username):
+    """Get a user's downsampled track (older history kept after raw fixes expire)"""
+    limit = request.args.get('limit', 500, type=int)
+    if limit > 5000 or limit < 1:
+        return jsonify({"error": "Limit must be between 1 and 5000"}), 400
+    
+    before = None
+    if request.args.get('before'):
+        try:
+            before = datetime.fromisoformat(request.args['before'])
+        except ValueError:
+            return jsonify({"error": "before must be an ISO 8601 timestamp"}), 400
+    
+    try:
+        track = backend.get_user_track(username, limit, before)
+        return jsonify({
+            "username": username,
+            "track": track,
+            "count": len(track),
+            "next_before": track[-1]["timestamp"] if len(track) == limit else None
+        }), 200
+    except Exception as e:
+        error("Error fetching track for %s: %s", username, e)
+        return jsonify({"error": "Failed to fetch track", "message": str(e)}), 500
+
+def parse_location_cursor(cursor):
+    """Parse a '<timestamp>,<id>' history cursor into (datetime, id), or None if malformed"""
+    timestamp, _, row_id = cursor.rpartition(',')
+    try:
+        return datetime.fromisoformat(timestamp.strip()), int(row_id)
+    except ValueError:
+        return None
+
 @app.route('/user/<username>', methods=['GET'])
 def get_user_info(username):
     """Get user information (username, email)"""
     if not username:
         return jsonify({"error": "Username required"}), 400
     
-    debug(f"Fetching user info for {username}")
+    debug("Fetching user info for %s", username)
     
     try:
-        user = get_user(username)
+        # Only safe fields (not password/pin) are loaded and cached
+        user = lookup_user(username)
         if not user:
-            warning(f"User not found: {username}")
+            warning("User not found: %s", username)
             return jsonify({"error": "User not found"}), 404
         
-        # Return only safe fields (not password/pin)
-        info(f"User info retrieved for {username}")
+        info("User info retrieved for %s", username)
         return jsonify({
-            "username": user[0],
-            "email": user[2]
+            "username": user["username"],
+            "email": user["email"]
         }), 200
     except Exception as e:
-        error(f"Error fetching user {username}: {e}")
+        error("Error fetching user %s: %s", username, e)
         return jsonify({"error": "Failed to fetch user", "message": str(e)}), 500
 
 @app.route('/routine', methods=['POST'])
@@ -285,16 +662,22 @@ def add_routine():
         warning("Add routine request with missing fields")
         return jsonify({"error": "Missing required fields: username, title, timeFrom, timeTo"}), 400
     
-    debug(f"Adding routine for {username}: {title}")
+    for value in (time_from, time_to):
+        valid, msg = validate_time_of_day(value)
+        if not valid:
+            return jsonify({"error": "Invalid time", "message": msg}), 400
+    
+    debug("Adding routine for %s: %s", username, title)
     
     # Add routine to database
-    success, message = insert_routine(username, title, time_from, time_to, location, days)
+    success, message = backend.insert_routine(username, title, time_from, time_to, location, days)
     
     if success:
-        info(f"Routine added for {username}: {title}")
+        geofences.invalidate(username)
+        info("Routine added for %s: %s", username, title)
         return jsonify({"status": "Success", "message": message}), 201
     else:
-        warning(f"Routine addition failed for {username}: {message}")
+        warning("Routine addition failed for %s: %s", username, message)
         return jsonify({"error": "Failed to add routine", "message": message}), 400
 
 @app.route('/routines/<username>', methods=['GET'])
@@ -303,34 +686,175 @@ def get_routines(username):
     if not username:
         return jsonify({"error": "Username required"}), 400
     
-    debug(f"Fetching routines for {username}")
+    debug("Fetching routines for %s", username)
     
     try:
-        routines = get_user_routines(username)
-        info(f"Routines retrieved for {username}")
+        routines = backend.get_user_routines(username)
+        info("Routines retrieved for %s", username)
         return jsonify({"routines": routines}), 200
     except Exception as e:
-        error(f"Error fetching routines for {username}: {e}")
+        error("Error fetching routines for %s: %s", username, e)
         return jsonify({"error": "Failed to fetch routines", "message": str(e)}), 500
 
 @app.route('/routine/<int:routine_id>', methods=['DELETE'])
 def remove_routine(routine_id):
     """Delete a routine"""
-    debug(f"Deleting routine: {routine_id}")
+    debug("Deleting routine: %s", routine_id)
     
     try:
-        success, message = delete_routine(routine_id)
+        # Looked up first so only the owner's fences are reloaded
+        owner = backend.get_routine_owner(routine_id)
+        success, message = backend.delete_routine(routine_id)
         if success:
-            info(f"Routine deleted: {routine_id}")
+            if owner is not None:
+                geofences.invalidate(owner)
+            info("Routine deleted: %s", routine_id)
             return jsonify({"status": "Success", "message": message}), 200
         else:
-            warning(f"Routine deletion failed: {message}")
+            warning("Routine deletion failed: %s", message)
             return jsonify({"error": "Failed to delete routine", "message": message}), 400
     except Exception as e:
-        error(f"Error deleting routine {routine_id}: {e}")
+        error("Error deleting routine %s: %s", routine_id, e)
         return jsonify({"error": "Failed to delete routine", "message": str(e)}), 500
 
-# --- 5. LAUNCH ---
+@app.route('/place', methods=['POST'])
+def add_place():
+    """Save a place fence: a circle (latitude, longitude, radius in meters) or a polygon"""
+    data = request.get_json() or {}
+    username = data.get('username')
+    name = data.get('name')
+    polygon = data.get('polygon')
+    
+    if not username or not name:
+        warning("Add place request with missing fields")
+        return jsonify({"error": "Missing required fields: username, name"}), 400
+    
+    if polygon is not None:
+        valid, msg = validate_polygon(polygon)
+        if not valid:
+            return jsonify({"error": "Invalid polygon", "message": msg}), 400
+        # Centroid of the vertices, for display
+        latitude = sum(float(v[0]) for v in polygon) / len(polygon)
+        longitude = sum(float(v[1]) for v in polygon) / len(polygon)
+        radius = None
+    else:
+        latitude, longitude, radius = data.get('latitude'), data.get('longitude'), data.get('radius')
+        valid, msg = validate_coordinates(latitude, longitude)
+        if not valid:
+            return jsonify({"error": "Invalid coordinates", "message": msg}), 400
+        valid, msg = validate_place_radius(radius)
+        if not valid:
+            return jsonify({"error": "Invalid radius", "message": msg}), 400
+        latitude, longitude, radius = float(latitude), float(longitude), float(radius)
+        polygon = None
+    
+    debug("Adding place for %s: %s", username, name)
+    
+    success, message = backend.insert_place(username, name, latitude, longitude, radius,
+                                            [[float(v[0]), float(v[1])] for v in polygon] if polygon else None)
+    
+    if success:
+        geofences.invalidate(username)
+        info("Place added for %s: %s", username, name)
+        return jsonify({"status": "Success", "message": message}), 201
+    else:
+        warning("Failed to add place for %s: %s", username, message)
+        return jsonify({"error": "Failed to save place", "message": message}), 400
+
+@app.route('/places/<username>', methods=['GET'])
+def get_places(username):
+    """Get all saved places for a user"""
+    debug("Fetching places for %s", username)
+    
+    try:
+        places = backend.get_user_places(username)
+        return jsonify({"places": places}), 200
+    except Exception as e:
+        error("Error fetching places for %s: %s", username, e)
+        return jsonify({"error": "Failed to fetch places", "message": str(e)}), 500
+
+@app.route('/place/<int:place_id>', methods=['DELETE'])
+def remove_place(place_id):
+    """Delete a saved place"""
+    debug("Deleting place: %s", place_id)
+    
+    try:
+        # Looked up first so only the owner's fences are reloaded
+        owner = backend.get_place_owner(place_id)
+        success, message = backend.delete_place(place_id)
+        if success:
+            if owner is not None:
+                geofences.invalidate(owner)
+            info("Place deleted: %s", place_id)
+            return jsonify({"status": "Success", "message": message}), 200
+        else:
+            warning("Place deletion failed: %s", message)
+            return jsonify({"error": "Failed to delete place", "message": message}), 400
+    except Exception as e:
+        error("Error deleting place %s: %s", place_id, e)
+        return jsonify({"error": "Failed to delete place", "message": str(e)}), 500
+
+def _point(data):
+    """(lat, lng) from a {"lat": .., "lng": ..} object, or None"""
+    if not isinstance(data, dict):
+        return None
+    valid, _ = validate_coordinates(data.get('lat'), data.get('lng'))
+    return (float(data['lat']), float(data['lng'])) if valid else None
+
+@app.route('/trip/start', methods=['POST'])
+def start_trip():
+    """Start journey mode towards a destination"""
+    data = request.get_json() or {}
+    username = data.get('username')
+    destination = _point(data.get('destination'))
+    origin = _point(data.get('origin'))
+    expected_minutes = data.get('expectedMinutes')
+    
+    if not username or destination is None:
+        warning("Trip start request with missing fields")
+        return jsonify({"error": "Missing required fields: username, destination {lat, lng}"}), 400
+    
+    if expected_minutes is not None:
+        try:
+            expected_minutes = float(expected_minutes)
+        except (TypeError, ValueError):
+            return jsonify({"error": "expectedMinutes must be a number"}), 400
+    
+    if origin is None:
+        # Default to the user's latest logged fix
+        try:
+            latest = backend.get_user_locations(username, 1)
+        except Exception as e:
+            error("Error fetching latest location for %s: %s", username, e)
+            latest = []
+        if not latest:
+            return jsonify({"error": "origin {lat, lng} required (no logged location for this user)"}), 400
+        origin = (latest[0]["latitude"], latest[0]["longitude"])
+    
+    trip = trips.start(username, origin, destination, expected_minutes)
+    return jsonify({"status": "Success", "trip": trip.to_dict()}), 201
+
+@app.route('/trip/<trip_id>', methods=['GET'])
+def get_trip(trip_id):
+    """Trip state; ?track=1 includes the recorded fixes"""
+    track = request.args.get('track') == '1'
+    trip = trips.get(trip_id, track=track)
+    if trip is None:
+        return jsonify({"error": "Trip not found"}), 404
+    return jsonify({"trip": trip.to_dict(track=track)}), 200
+
+@app.route('/trip/<trip_id>/end', methods=['POST'])
+def end_trip(trip_id):
+    """End a trip before arrival"""
+    trip = trips.end(trip_id)
+    if trip is None:
+        return jsonify({"error": "Trip not found"}), 404
+    info("Trip %s ended by %s", trip_id, trip.username)
+    return jsonify({"status": "Success", "trip": trip.to_dict()}), 200
+
+# --- 6. LAUNCH ---
 if __name__ == '__main__':
     info("Starting SAFEHER Flask Application")
+    # Turn SIGTERM into a normal exit so atexit hooks flush buffered writes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=False, host='0.0.0.0', port=5000)
@@ -0,0 +1,69 @@
+"""
+ASGI Entry Point - Serve the API from an ASGI server (e.g. uvicorn)
+/analyze, /sos and the location history GETs are async views (async_views.py) that
+run on the event loop: their database queries use an async driver and their FCM
+sends run on a thread pool, so a request waiting on either holds no thread. Every
+other route is the Flask app, bridged by asgiref's WsgiToAsgi on a thread of its
+own, at most SERVER_THREADS at a time. ASGI_ASYNC_VIEWS=0 serves everything through
+the bridge (for comparing the two with loadtest.py). A client that disconnects
+before its body has arrived is dropped without running the view.
+Usage: uvicorn asgi:asgi_app --lifespan off
+"""
+import asyncio
+import contextvars
+import os
+
+try:
+    from asgiref.sync import ThreadSensitiveContext
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', 32))
+ASGI_ASYNC_VIEWS = os.getenv('ASGI_ASYNC_VIEWS', '1') == '1'
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the request body arrived"""
+
+
+class BoundedWsgiToAsgi:
+    """asgiref's WsgiToAsgi with every request on its own thread, at most `threads` at a time"""
+
+    def __init__(self, wsgi_app, threads=SERVER_THREADS):
+        if WsgiToAsgi is None:
+            raise RuntimeError("SERVER_MODE=asgi requires asgiref (pip install asgiref)")
+        self.app = WsgiToAsgi(wsgi_app)
+        self.slots = asyncio.Semaphore(threads)
+
+    async def __call__(self, scope, receive, send):
+        async def receive_request():
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            return message
+
+        async def send_response(message):
+            # Sent from a clean context: asgiref calls send from inside its sync-thread machinery,
+            # and uvicorn starts the next keep-alive request from within send
+            await asyncio.get_running_loop().create_task(send(message), context=contextvars.Context())
+
+        try:
+            async with self.slots:
+                # Outside a context asgiref runs every request on one shared thread
+                async with ThreadSensitiveContext():
+                    await self.app(scope, receive_request, send_response)
+        except ClientDisconnected:
+            pass
+
+
+def create_asgi_app(async_views=ASGI_ASYNC_VIEWS):
+    import app as api
+    bridged = BoundedWsgiToAsgi(api.app)
+    if not async_views:
+        return bridged
+    from async_views import AsyncViews
+    return AsyncViews(api, bridged)
+
+
+asgi_app = create_asgi_app()
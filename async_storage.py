@@ -0,0 +1,218 @@
+"""
+Async Storage - Storage calls for the views served on the event loop (async_views.py)
+  mysql   aiomysql pool per worker process; same statements and result shapes as
+          database.py and location_store.py, so a query wait holds no thread
+  sqlite  the SQLite backend's own functions on a small thread pool; the database is
+          a local file, so there is no network wait to overlap, only disk I/O to keep
+          off the event loop
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from logger import info, error
+from metrics import span
+from storage import DB_BACKEND, backend
+from validators import phone_key
+
+# Connections in the async pool (in addition to the sync pool the Flask views use)
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', os.getenv('DB_POOL_SIZE', 10)))
+# Threads for blocking local work (SQLite files, the SOS spool) done for async views
+LOCAL_IO_THREADS = int(os.getenv('LOCAL_IO_THREADS', 8))
+
+
+class Offload:
+    """A thread pool for blocking calls made from the event loop, created lazily (and again after a fork)"""
+
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=self.name)
+                self._pid = os.getpid()
+            return self._executor
+
+    async def __call__(self, fn, *args):
+        """Await fn(*args) on the pool; spans it records count towards the calling request"""
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), call)
+
+
+local_io = Offload("local-io", LOCAL_IO_THREADS)
+
+
+class MySQLStore:
+    """Async counterparts of the MySQL backend functions the async views need"""
+
+    def __init__(self, size=ASYNC_DB_POOL_SIZE):
+        try:
+            import aiomysql
+        except ImportError:
+            raise RuntimeError("SERVER_MODE=asgi with DB_BACKEND=mysql requires aiomysql (pip install aiomysql)")
+        import database
+        import location_store
+        self.aiomysql = aiomysql
+        self.db = database
+        self.locations = location_store
+        self.size = size
+        self._pool = None
+        self._pool_key = None
+
+    async def _get_pool(self):
+        """This process's pool on the running loop; concurrent first callers share one creation"""
+        key = (os.getpid(), asyncio.get_running_loop())
+        if self._pool is None or self._pool_key != key:
+            config = self.db.DB_CONFIG
+            self._pool_key = key
+            self._pool = asyncio.ensure_future(self.aiomysql.create_pool(
+                minsize=1, maxsize=self.size, autocommit=True, host=config['host'], user=config['user'],
+                password=config['password'], db=config['database']))
+            info("Creating async connection pool (max %s, pid %s)", self.size, os.getpid())
+        creating = self._pool
+        try:
+            # Shielded: a client that goes away must not cancel the creation for everyone else
+            return await asyncio.shield(creating)
+        except Exception:
+            if self._pool is creating:
+                # Try again on the next call (the database may be back by then)
+                self._pool = None
+            raise
+
+    async def execute(self, name, sql, params=(), fetch=None):
+        """database.execute on the async pool: None (rowcount), "one" or "all" """
+        pool = await self._get_pool()
+        try:
+            with span("db"), self.db._latency(name).time():
+                async with pool.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(sql, params)
+                        if fetch is None:
+                            return cursor.rowcount
+                        rows = await cursor.fetchall()
+        except Exception as e:
+            error("Async query %s failed: %s", name, e)
+            raise
+        if fetch == "one":
+            return rows[0] if rows else None
+        return rows
+
+    async def insert_location(self, username, latitude, longitude, accuracy):
+        await self.execute('insert_location', self.db.SQL_INSERT_LOCATION, (username, latitude, longitude, accuracy))
+
+    async def insert_sos(self, username, timestamp=None):
+        await self.execute('insert_sos', self.db.SQL_INSERT_SOS, (username, timestamp))
+
+    async def get_user_contacts(self, username):
+        rows = await self.execute('get_user_contacts', self.db.SQL_GET_CONTACTS, (username,), fetch="all")
+        return [self.db._contact_row(r) for r in rows]
+
+    async def get_device_tokens(self, phones):
+        phones = list(phones)
+        if not phones:
+            return {}
+        rows = await self.execute('get_device_tokens', self.db.sql_get_device_tokens(len(phones)),
+                                  tuple(phones), fetch="all")
+        return self.db._tokens_by_phone(rows)
+
+    async def get_routine_schedule(self, username):
+        """The user's RoutineSchedule from the backend's routine cache, loaded on a miss"""
+        schedule, miss = self.db.routine_cache.lookup(username)
+        if schedule is None:
+            rows = await self.execute('load_routines', self.db.SQL_LOAD_ROUTINES, (username,), fetch="all")
+            schedule = self.db.routine_cache.store(username, [self.db._routine_row(r) for r in rows], miss)
+        return schedule
+
+    async def get_user_places(self, username):
+        rows = await self.execute('get_user_places', self.db.SQL_GET_PLACES, (username,), fetch="all")
+        return [self.db._place_row(r) for r in rows]
+
+    async def _history_page(self, username, limit, before):
+        tables = self.locations.archive_tables
+        if tables.expired():
+            months = tables.update(await self.execute(
+                'list_location_tables', self.locations.SQL_LIST_LOCATION_TABLES, fetch="all"))
+        else:
+            months = tables.months()
+        sql, params = self.locations.history_statement(months, username, limit, before)
+        return await self.execute('get_user_locations', sql, params, fetch="all")
+
+    async def get_user_locations(self, username, limit=50, before=None):
+        return [self.locations._location_row(r) for r in await self._history_page(username, limit, before)]
+
+    async def iter_user_locations(self, username, before=None, batch_size=500):
+        while True:
+            rows = await self._history_page(username, batch_size, before)
+            for r in rows:
+                yield self.locations._location_row(r)
+            if len(rows) < batch_size:
+                return
+            before = (rows[-1][4], rows[-1][0])
+
+    async def get_user_track(self, username, limit=500, before=None):
+        rows = await self.execute('get_user_track', self.locations.SQL_GET_TRACK,
+                                  (username, before or datetime(9999, 12, 31), limit), fetch="all")
+        return [self.locations._track_row(r) for r in rows]
+
+
+class LocalStore:
+    """A local backend's own functions, each run on the local I/O pool"""
+
+    def __init__(self, backend, offload=local_io):
+        self.backend = backend
+        self.offload = offload
+
+    async def insert_location(self, username, latitude, longitude, accuracy):
+        await self.offload(self.backend.insert_location, username, latitude, longitude, accuracy)
+
+    async def insert_sos(self, username, timestamp=None):
+        await self.offload(self.backend.insert_sos, username, timestamp)
+
+    async def get_user_contacts(self, username):
+        return await self.offload(self.backend.get_user_contacts, username)
+
+    async def get_device_tokens(self, phones):
+        return await self.offload(self.backend.get_device_tokens, list(phones))
+
+    async def get_routine_schedule(self, username):
+        return await self.offload(self.backend.get_routine_schedule, username)
+
+    async def get_user_places(self, username):
+        return await self.offload(self.backend.get_user_places, username)
+
+    async def get_user_locations(self, username, limit=50, before=None):
+        return await self.offload(self.backend.get_user_locations, username, limit, before)
+
+    async def iter_user_locations(self, username, before=None, batch_size=500):
+        while True:
+            rows = await self.offload(self.backend.get_user_locations, username, batch_size, before)
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            before = (rows[-1]["timestamp"], rows[-1]["id"])
+
+    async def get_user_track(self, username, limit=500, before=None):
+        return await self.offload(self.backend.get_user_track, username, limit, before)
+
+
+async def lookup_sos_recipients(store, username):
+    """db_adapter.lookup_sos_recipients over an async store (read from the database every time)"""
+    contacts = await store.get_user_contacts(username) or []
+    recipients = [{"name": c["name"], "phone": phone_key(c["contact"])} for c in contacts]
+    tokens = await store.get_device_tokens({r["phone"] for r in recipients if r["phone"]})
+    for recipient in recipients:
+        recipient["tokens"] = tokens.get(recipient["phone"], [])
+    return recipients
+
+
+def create_store(name=DB_BACKEND):
+    return MySQLStore() if name == 'mysql' else LocalStore(backend)
@@ -0,0 +1,411 @@
+"""
+Async Views - /analyze, /sos and the location history reads served on the event loop
+Used by asgi.py (SERVER_MODE=asgi). Database waits go through async_storage (aiomysql
+on MySQL), FCM sends run on their own thread pool, and the SQLite files shared by the
+workers (geofence membership, trips, SOS spool) on the local I/O pool, so a request
+waiting on any of them holds no request thread. Validation, responses, metrics and
+access logs match the Flask views in app.py, which still serve every other route and
+any request these views can't read (e.g. a body that is not a JSON object).
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime
+from urllib.parse import parse_qs
+from async_storage import Offload, create_store, local_io, lookup_sos_recipients
+from db_adapter import queue_location
+from logger import info, error, warning, debug, access
+from metrics import Spans, set_spans, request_metrics
+from validators import validate_username, validate_coordinates, validate_sos_id, validate_accuracy
+
+# Threads for FCM sends made by async views (the topic alert and contact fan-out chunks)
+FCM_THREADS = int(os.getenv('FCM_THREADS', 64))
+
+fcm_io = Offload("fcm", FCM_THREADS)
+
+
+class Request:
+    """The parts of an ASGI HTTP request the views read"""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        self.args = {name: values[0] for name, values in
+                     parse_qs(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True).items()}
+        self.remote_addr = scope["client"][0] if scope.get("client") else None
+        self.body = body
+
+    def arg(self, name, default=None, type=str):
+        """request.args.get(name, default, type=type): the default when missing or unconvertible"""
+        if name not in self.args:
+            return default
+        try:
+            return type(self.args[name])
+        except ValueError:
+            return default
+
+    def json_object(self):
+        """The body as a dict, or None for anything Flask's get_json() would reject or return as a non-dict"""
+        mimetype = self.headers.get("content-type", "").split(";")[0].strip().lower()
+        if mimetype != "application/json" and not (mimetype.startswith("application/") and mimetype.endswith("+json")):
+            return None
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+class Response:
+    """A complete body, or chunks from an async iterator (content_length None)"""
+
+    def __init__(self, body=b"", status=200, mimetype="application/json", chunks=None):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.chunks = chunks
+
+    @property
+    def content_length(self):
+        return None if self.chunks is not None else len(self.body)
+
+
+class AsyncViews:
+    """
+    ASGI app serving /analyze, /sos and the history GETs natively and handing every other
+    request to fallback (the Flask app behind BoundedWsgiToAsgi)
+    """
+
+    def __init__(self, api, fallback, store=None):
+        # api is the app module: its Flask app and the engines its views share
+        self.api = api
+        self.json = api.app.json
+        self.debug = api.app.debug
+        self.fallback = fallback
+        self.store = store or create_store()
+        self.routes = [
+            ("POST", re.compile(r"/analyze"), "/analyze", self.analyze),
+            ("POST", re.compile(r"/sos"), "/sos", self.trigger_sos),
+            ("GET", re.compile(r"/locations/([^/]+)"), "/locations/<username>", self.get_locations),
+            ("GET", re.compile(r"/locations/([^/]+)/track"), "/locations/<username>/track", self.get_location_track)
+        ]
+
+    def _match(self, scope):
+        if scope["type"] != "http":
+            return None
+        for method, pattern, rule, view in self.routes:
+            if scope["method"] == method:
+                match = pattern.fullmatch(scope["path"])
+                if match:
+                    return rule, view, match.groups()
+        return None
+
+    async def __call__(self, scope, receive, send):
+        matched = self._match(scope)
+        if matched is None:
+            return await self.fallback(scope, receive, send)
+        body = await self._read_body(receive)
+        if body is None:
+            # The client went away before its body arrived; nothing to run
+            return
+        request = Request(scope, body)
+        if request.method == "POST" and request.json_object() is None:
+            # Flask answers malformed bodies with its own error responses
+            return await self.fallback(scope, self._replay(body, receive), send)
+        await self._handle(request, matched, send)
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    def _replay(self, body, receive):
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return replay
+
+    async def _handle(self, request, matched, send):
+        rule, view, params = matched
+        start = time.perf_counter()
+        spans = Spans(rule)
+        set_spans(spans)
+        try:
+            try:
+                response = await view(request, *params)
+            except Exception as e:
+                error("Internal Server Error: %s", e)
+                response = self.jsonify({"error": "Internal Server Error", "message": "Please try again later"}, 500)
+            await self._send(request, response, send)
+        finally:
+            set_spans(None)
+        # Same histogram and access log line as app.record_request
+        elapsed = time.perf_counter() - start
+        request_metrics.observe(rule, request.method, response.status, elapsed)
+        fields = {
+            "method": request.method,
+            "route": rule,
+            "path": request.path,
+            "status": response.status,
+            "duration_ms": round(elapsed * 1000, 3),
+            "bytes": response.content_length,
+            "remote": request.remote_addr
+        }
+        for name, seconds in spans.totals.items():
+            fields[f"{name}_ms"] = round(seconds * 1000, 3)
+        access(fields)
+
+    async def _send(self, request, response, send):
+        headers = [(b"content-type", response.mimetype.encode())]
+        # The CORS headers flask_cors adds to the Flask views' responses
+        origin = request.headers.get("origin")
+        if origin:
+            headers += [(b"access-control-allow-origin", origin.encode("latin-1")), (b"vary", b"Origin")]
+        else:
+            headers.append((b"access-control-allow-origin", b"*"))
+        if response.chunks is None:
+            headers.append((b"content-length", str(len(response.body)).encode()))
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        if response.chunks is None:
+            await send({"type": "http.response.body", "body": response.body})
+            return
+        try:
+            async for chunk in response.chunks:
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        except Exception as e:
+            # Headers are out; the client sees a truncated stream
+            error("Error streaming %s: %s", response.mimetype, e)
+        await send({"type": "http.response.body", "body": b""})
+
+    def jsonify(self, obj, status=200):
+        """flask.jsonify with the app's JSON provider settings"""
+        if self.debug:
+            body = self.json.dumps(obj, indent=2)
+        else:
+            body = self.json.dumps(obj, separators=(",", ":"))
+        return Response(f"{body}\n".encode(), status)
+
+    # --- Views (same behaviour as their app.py counterparts) ---
+
+    async def analyze(self, request):
+        """Analyze location safety"""
+        data = request.json_object()
+        username = data.get('username')
+        lat = data.get('lat')
+        lng = data.get('lng')
+        accuracy = data.get('accuracy', 0)
+
+        if not username:
+            warning("Analyze request without username")
+            return self.jsonify({"error": "Username required"}, 400)
+
+        if lat is None or lng is None:
+            warning("Analyze request from %s without location", username)
+            return self.jsonify({"error": "Location required"}, 400)
+
+        valid, msg = validate_coordinates(lat, lng)
+        if not valid:
+            warning("Analyze request from %s with invalid location: %s", username, msg)
+            return self.jsonify({"error": "Invalid location", "message": msg}, 400)
+
+        lat, lng = float(lat), float(lng)
+        debug("Analyzing location for %s: lat=%s, lng=%s", username, lat, lng)
+
+        success, message = await self._log_location(username, lat, lng, accuracy)
+        if not success:
+            warning("Location logging failed for %s: %s", username, message)
+
+        # In memory, so it runs on the loop
+        risk, reason = self.api.risk_cache.check(lat, lng)
+
+        info("Risk analysis completed for %s: %s", username, risk)
+
+        try:
+            geofence = await self._evaluate_geofence(username, lat, lng)
+        except Exception as e:
+            warning("Geofence evaluation failed for %s: %s", username, e)
+            geofence = None
+
+        trip_state = None
+        try:
+            fix_accuracy = float(accuracy) if accuracy and validate_accuracy(accuracy)[0] else 0.0
+            trip, alerts = await local_io(self.api.trips.add_fix, username, lat, lng, fix_accuracy)
+            if trip is not None:
+                trip_state = {**trip.to_dict(), "new_alerts": alerts}
+        except Exception as e:
+            warning("Trip update failed for %s: %s", username, e)
+
+        return self.jsonify({
+            "risk_level": risk,
+            "reason": reason,
+            "time": datetime.now().strftime("%H:%M"),
+            "location_logged": success,
+            "geofence": geofence,
+            "trip": trip_state
+        })
+
+    async def _log_location(self, username, lat, lng, accuracy):
+        """db_adapter.log_location, writing through the async store when the buffer is full"""
+        success, message = queue_location(username, lat, lng, accuracy)
+        if success is not None:
+            return success, message
+        try:
+            await self.store.insert_location(username, lat, lng, accuracy)
+            return True, "Location logged successfully"
+        except Exception as e:
+            return False, f"Database error: {str(e)}"
+
+    async def _evaluate_geofence(self, username, lat, lng):
+        """GeofenceEngine.evaluate with the schedule and places loaded through the async store"""
+        geofences = self.api.geofences
+        previous, version = await local_io(geofences.state.read, username)
+        user, generation = geofences.cached(username, version)
+        schedule = await self.store.get_routine_schedule(username)
+        if user is None or user.schedule is not schedule:
+            places = user.places if user is not None else await self.store.get_user_places(username)
+            user = geofences.build(username, version, generation, schedule, places, reloaded=user is None)
+        return await local_io(geofences.check, username, user, previous, lat, lng)
+
+    async def trigger_sos(self, request):
+        """Trigger SOS emergency alert"""
+        data = request.json_object()
+        username = data.get('username')
+        user_name = data.get('name', 'User')
+
+        if not username:
+            warning("SOS triggered without username")
+            return self.jsonify({"error": "Username required"}, 400)
+
+        valid, msg = validate_username(username)
+        if not valid:
+            warning("SOS triggered with invalid username: %s", msg)
+            return self.jsonify({"error": "Invalid username", "message": msg}, 400)
+
+        sos_id = data.get('sos_id')
+        if sos_id is not None:
+            valid, msg = validate_sos_id(sos_id)
+            if not valid:
+                return self.jsonify({"error": "Invalid SOS id", "message": msg}, 400)
+
+        info("🚨 SOS RECEIVED FROM: %s", username)
+
+        result = await self._dispatch_sos(username, user_name, sos_id)
+
+        if result["sent"]:
+            info("✅ FCM alert sent")
+            return self.jsonify({"status": "Success", "message": "FCM Alert Sent", **result})
+        elif result["queued_for_retry"]:
+            warning("FCM failed, SOS alert for %s queued for retry", username)
+            return self.jsonify({"status": "Queued", "message": "FCM failed, alert queued for retry", **result}, 202)
+        else:
+            error("❌ FCM failed and the alert could not be queued")
+            error("ALERT: %s", username)
+            return self.jsonify({"status": "Error", "message": "FCM failed, alert not sent", **result}, 500)
+
+    async def _dispatch_sos(self, username, name, sos_id):
+        """SOSPipeline.dispatch with the three stages awaited concurrently on the loop"""
+        pipeline = self.api.sos_pipeline
+        pipeline.start()
+        event = pipeline.new_event(username, name, sos_id)
+        start = time.perf_counter()
+        stages = [
+            self._stage(pipeline, "db", self.store.insert_sos(username, datetime.fromisoformat(event["timestamp"]))),
+            self._stage(pipeline, "fcm", fcm_io(pipeline.send_fn, event))
+        ]
+        if pipeline.fanout_fn is not None:
+            stages.append(self._stage(pipeline, "fanout", self._fan_out(event)))
+        db, fcm, *fanout = await asyncio.gather(*stages)
+        pipeline.timings["total"].record((time.perf_counter() - start) * 1000.0)
+        fanout = fanout[0] if fanout else None
+        if db[0] and fcm[0]:
+            # Nothing to spool or queue
+            return pipeline.finish(event, db, fcm, fanout)
+        return await local_io(pipeline.finish, event, db, fcm, fanout)
+
+    async def _stage(self, pipeline, stage, awaitable):
+        """(True, result) or (False, error), timed like SOSPipeline._timed"""
+        with pipeline.timings[stage].time():
+            try:
+                return True, await awaitable
+            except Exception as e:
+                return False, e
+
+    async def _fan_out(self, event):
+        recipients = await lookup_sos_recipients(self.store, event["username"])
+        return await fcm_io(self.api.sos_fanout.deliver, event, recipients)
+
+    async def get_locations(self, request, username):
+        """Get location history for a user (one keyset page, or a full NDJSON stream)"""
+        limit = request.arg('limit', 50, type=int)
+        output_format = request.arg('format', 'json')
+
+        if limit > 1000 or limit < 1:
+            return self.jsonify({"error": "Limit must be between 1 and 1000"}, 400)
+
+        before = None
+        if request.arg('before'):
+            before = self.api.parse_location_cursor(request.arg('before'))
+            if before is None:
+                return self.jsonify({"error": "before must be a '<timestamp>,<id>' cursor"}, 400)
+
+        if output_format == 'ndjson':
+            debug("Streaming location history for %s", username)
+            rows = self.store.iter_user_locations(username, before)
+            return Response(mimetype='application/x-ndjson', chunks=(json.dumps(row) + "\n" async for row in rows))
+
+        debug("Fetching last %d locations for %s", limit, username)
+
+        try:
+            locations = await self.store.get_user_locations(username, limit, before)
+            info("Retrieved %d location records for %s", len(locations), username)
+            next_cursor = None
+            if len(locations) == limit:
+                last = locations[-1]
+                next_cursor = f"{last['timestamp']},{last['id']}"
+            return self.jsonify({
+                "username": username,
+                "locations": locations,
+                "count": len(locations),
+                "next_cursor": next_cursor
+            })
+        except Exception as e:
+            error("Error fetching locations for %s: %s", username, e)
+            return self.jsonify({"error": "Failed to fetch locations", "message": str(e)}, 500)
+
+    async def get_location_track(self, request, username):
+        """Get a user's downsampled track (older history kept after raw fixes expire)"""
+        limit = request.arg('limit', 500, type=int)
+        if limit > 5000 or limit < 1:
+            return self.jsonify({"error": "Limit must be between 1 and 5000"}, 400)
+
+        before = None
+        if request.arg('before'):
+            try:
+                before = datetime.fromisoformat(request.arg('before'))
+            except ValueError:
+                return self.jsonify({"error": "before must be an ISO 8601 timestamp"}, 400)
+
+        try:
+            track = await self.store.get_user_track(username, limit, before)
+            return self.jsonify({
+                "username": username,
+                "track": track,
+                "count": len(track),
+                "next_before": track[-1]["timestamp"] if len(track) == limit else None
+            })
+        except Exception as e:
+            error("Error fetching track for %s: %s", username, e)
+            return self.jsonify({"error": "Failed to fetch track", "message": str(e)}, 500)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - API benchmark harness
+Starts the Flask app in-process on an ephemeral port against a throwaway SQLite
+database (no MySQL needed), seeds users and location history, runs loadtest.py
+scenarios against it and writes the results as JSON. FCM sends are replaced by a
+fake with fixed latency unless --real-fcm is given; each SOS also fans out to the
+devices of --contacts seeded contacts. With --compare, endpoints whose p95 grew or
+throughput fell by more than --tolerance exit non-zero.
+--server runs the same scenarios on the ASGI server (async views, or every route bridged
+to Flask) for a side-by-side comparison with the threaded server.
+Usage: python bench_api.py [--scenarios pings,sos,history,mixed] [--concurrency 16] [--duration 10]
+                           [--server threaded|asgi|asgi-bridged] [--out bench_results/run.json]
+                           [--compare bench_results/baseline.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# The throwaway database, logs and spool files (SOS spool, outbox, trips, geofence state)
+# must be configured before the app is imported, so bench jobs never reach a real server
+_workdir = tempfile.mkdtemp(prefix="safeher_bench_api_")
+os.environ.setdefault('DB_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_PATH', os.path.join(_workdir, "bench.db"))
+os.environ.setdefault('LOG_DIR', os.path.join(_workdir, "logs"))
+os.environ.setdefault('SPOOL_DIR', os.path.join(_workdir, "spool"))
+
+import numpy as np
+import loadtest
+
+BENCH_PREFIX = "bench_api_"
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+SERVERS = ("threaded", "asgi", "asgi-bridged")
+
+
+def start_server(app):
+    """Serve app on 127.0.0.1 with a threaded werkzeug server; returns (url, stop)"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server.shutdown
+
+
+def start_asgi_server(asgi_app):
+    """Serve an ASGI app on 127.0.0.1 with uvicorn on a background thread; returns (url, stop)"""
+    import socket
+    import uvicorn
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Inherited by accepted connections (asyncio leaves sockets not opened as IPPROTO_TCP alone)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(asgi_app, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, name="bench-server", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return f"http://127.0.0.1:{sock.getsockname()[1]}", stop
+
+
+def seed(backend, users, history, contacts):
+    """Create users, history fixes per user spread over the last week, and contacts with one device each"""
+    rng = np.random.default_rng(7)
+    names = [f"{BENCH_PREFIX}{i}" for i in range(users)]
+    for name in names:
+        if backend.get_user(name) is None:
+            backend.insert_user(name, "x", "bench@example.com", "1234")
+    now = datetime.now()
+    for name in names:
+        seconds = np.sort(rng.uniform(0, 7 * 86400, history)).tolist()
+        backend.insert_locations([
+            (name, 12.9 + lat, 77.5 + lng, 10.0, now - timedelta(seconds=s))
+            for s, lat, lng in zip(seconds, rng.uniform(0, 0.1, history).tolist(), rng.uniform(0, 0.1, history).tolist())
+        ])
+    from validators import phone_key
+    for i in range(contacts):
+        phone = f"98450{i:05d}"
+        backend.insert_contact(names[0], "Bench Contact", "Friend", phone)
+        backend.insert_device_token(f"{BENCH_PREFIX}token_{i}", phone_key(phone))
+    return names
+
+
+def fake_fcm(latency_ms):
+    def send(event):
+        time.sleep(latency_ms / 1000.0)
+    return send
+
+
+def fake_fcm_multicast(latency_ms):
+    def send(tokens, event):
+        time.sleep(latency_ms / 1000.0)
+        return [None] * len(tokens)
+    return send
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of p95 latency and throughput against a baseline run; returns a list of messages"""
+    regressions = []
+    for scenario, run in results["scenarios"].items():
+        base_run = baseline.get("scenarios", {}).get(scenario)
+        if base_run is None:
+            continue
+        for label, s in run["endpoints"].items():
+            base = base_run["endpoints"].get(label)
+            if base is None:
+                continue
+            if base["p95_ms"] and s["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{scenario} {label}: p95 {base['p95_ms']} -> {s['p95_ms']} ms")
+            if base["rps"] and s["rps"] < base["rps"] * (1 - tolerance):
+                regressions.append(f"{scenario} {label}: throughput {base['rps']} -> {s['rps']} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SAFEHER API in-process against SQLite")
+    parser.add_argument("--scenarios", default="pings,sos,history,mixed",
+                        help=f"comma-separated, from: {', '.join(sorted(loadtest.SCENARIOS))}")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--history", type=int, default=2000, help="seeded location fixes per user")
+    parser.add_argument("--contacts", type=int, default=30, help="seeded contacts with a device each (SOS fan-out)")
+    parser.add_argument("--fcm-latency-ms", type=float, default=50.0, help="fake FCM send latency")
+    parser.add_argument("--real-fcm", action="store_true", help="send through firebase_admin instead of the fake")
+    parser.add_argument("--server", choices=SERVERS, default="threaded",
+                        help="threaded werkzeug, asgi (async views) or asgi-bridged (every route through Flask)")
+    parser.add_argument("--out", help="results file (default bench_results/bench_api_<time>.json)")
+    parser.add_argument("--compare", help="baseline results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional regression")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in loadtest.SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    import app as app_module
+    from storage import backend
+    if not args.real_fcm:
+        app_module.sos_pipeline.send_fn = fake_fcm(args.fcm_latency_ms)
+        app_module.sos_fanout.send_fn = fake_fcm_multicast(args.fcm_latency_ms)
+
+    print(f"Seeding {args.users} users x {args.history} fixes into {os.environ['SQLITE_PATH']}")
+    users = seed(backend, args.users, args.history, args.contacts)
+    if args.server == "threaded":
+        url, stop = start_server(app_module.app)
+    else:
+        from asgi import create_asgi_app
+        url, stop = start_asgi_server(create_asgi_app(async_views=args.server == "asgi"))
+
+    results = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": backend.name,
+            "server": args.server,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "users": args.users,
+            "history": args.history,
+            "contacts": args.contacts,
+            "fcm": "real" if args.real_fcm else f"fake {args.fcm_latency_ms} ms"
+        },
+        "scenarios": {}
+    }
+    try:
+        for name in scenarios:
+            summary, elapsed = loadtest.run(url, args.concurrency, args.duration, loadtest.SCENARIOS[name], users)
+            total = sum(s["requests"] for s in summary.values())
+            results["scenarios"][name] = {"rps": round(total / elapsed, 1), "endpoints": summary}
+            loadtest.report(f"\nscenario={name}  concurrency={args.concurrency}", summary, elapsed)
+    finally:
+        stop()
+
+    out = args.out or os.path.join(RESULTS_DIR, f"bench_api_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"Compared with {args.compare} (tolerance {args.tolerance:.0%}): "
+              f"{len(regressions) or 'no'} regression{'s' if len(regressions) != 1 else ''}")
+        for message in regressions:
+            print(f"  ✗ {message}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Location history storage benchmark (needs a MySQL server, see DB_* settings)
+Loads N fixes spread over several months into the hot `location` table, measures
+history page latency, rotates finished months into location_YYYYMM tables, measures
+again, then times retention (DROP TABLE) against the equivalent DELETE
+Usage: python bench_locations.py [--rows 10000000] [--users 2000] [--months 12] [--skip-load]
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import location_store
+from database import execute, execute_many
+from location_store import add_months, archive_tables, get_user_locations, month_start, rotate, expire
+from metrics import LatencyStats
+
+BENCH_PREFIX = "bench_user_"
+
+
+def load(rows, users, months, batch):
+    """Insert bench users and rows fixes with timestamps spread over the last months months"""
+    execute_many('bench_users', 'INSERT IGNORE INTO user_details (username, password, email, pin) VALUES (%s, %s, %s, %s)',
+                 [(f"{BENCH_PREFIX}{i}", "x", "bench@example.com", "1234") for i in range(users)])
+    rng = np.random.default_rng(7)
+    end = datetime.now()
+    span = (end - add_months(month_start(end), -months)).total_seconds()
+    start = time.perf_counter()
+    for offset in range(0, rows, batch):
+        count = min(batch, rows - offset)
+        user_ids = rng.integers(0, users, count).tolist()
+        seconds = rng.uniform(0, span, count).tolist()
+        lats = rng.uniform(12.0, 13.0, count).tolist()
+        lngs = rng.uniform(77.0, 78.0, count).tolist()
+        accuracies = rng.uniform(3, 80, count).tolist()
+        execute_many('bench_load', 'INSERT INTO location (username, latitude, longitude, accuracy, timestamp) VALUES (%s, %s, %s, %s, %s)', [
+            (f"{BENCH_PREFIX}{u}", lat, lng, acc, end - timedelta(seconds=s))
+            for u, s, lat, lng, acc in zip(user_ids, seconds, lats, lngs, accuracies)
+        ])
+        if (offset // batch) % 100 == 0:
+            print(f"  loaded {offset + count:,} rows ({(offset + count) / (time.perf_counter() - start):,.0f} rows/s)")
+
+
+def measure(label, users, months, queries):
+    """Latency of a first page and of a page starting months/2 back, for random users"""
+    rng = np.random.default_rng(11)
+    deep_cursor = (add_months(month_start(datetime.now()), -(months // 2)), 2 ** 62)
+    first, deep = LatencyStats(), LatencyStats()
+    for user in rng.integers(0, users, queries).tolist():
+        with first.time():
+            get_user_locations(f"{BENCH_PREFIX}{user}", 50)
+        with deep.time():
+            get_user_locations(f"{BENCH_PREFIX}{user}", 50, deep_cursor)
+    for name, stats in (("first page", first), ("deep page", deep)):
+        s = stats.summary()
+        print(f"  {label:<22} {name:<11} p50 {s['p50_ms']:>7.2f} ms  p99 {s['p99_ms']:>7.2f} ms  mean {s['mean_ms']:>7.2f} ms")
+
+
+def hot_rows():
+    return execute('bench_count', 'SELECT COUNT(*) FROM location', fetch="one")[0]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SAFEHER location storage rotation")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="fixes to load")
+    parser.add_argument("--users", type=int, default=2000, help="distinct users")
+    parser.add_argument("--months", type=int, default=12, help="months of history to spread rows over")
+    parser.add_argument("--queries", type=int, default=1000, help="history queries per measurement")
+    parser.add_argument("--batch", type=int, default=5000, help="rows per insert statement")
+    parser.add_argument("--skip-load", action="store_true", help="reuse rows loaded by an earlier run")
+    args = parser.parse_args()
+
+    if not args.skip_load:
+        print(f"Loading {args.rows:,} rows for {args.users} users over {args.months} months")
+        load(args.rows, args.users, args.months, args.batch)
+    print(f"Hot table: {hot_rows():,} rows")
+    print("=" * 78)
+
+    measure("single table", args.users, args.months, args.queries)
+
+    # The first pass copies and rolls up; the second deletes from the hot table
+    archive_tables.ttl = 0
+    copied, copy_time = timed(rotate)
+    purged, purge_time = timed(rotate)
+    print(f"\nRotation: copy + rollup {copy_time:.1f} s ({sum(m['copied'] for m in copied.values()):,} rows), "
+          f"purge {purge_time:.1f} s ({sum(m['deleted'] for m in purged.values()):,} rows); "
+          f"hot table now {hot_rows():,} rows in {len(archive_tables.months())} monthly tables\n")
+
+    measure("rotated", args.users, args.months, args.queries)
+
+    # Retention: drop everything older than half the history
+    cutoff = add_months(month_start(datetime.now()), -(args.months // 2))
+    expired_rows = sum(
+        execute('bench_count', f'SELECT COUNT(*) FROM `{location_store.archive_table(m)}`', fetch="one")[0]
+        for m in archive_tables.months() if m < cutoff
+    )
+    location_store.LOCATION_RETENTION_MONTHS = args.months // 2
+    dropped, drop_time = timed(expire)
+    print(f"\nRetention: dropped {len(dropped['dropped'])} tables ({expired_rows:,} rows) in {drop_time * 1000:.0f} ms; "
+          f"a DELETE of the same rows would rewrite every secondary index entry")
+
+
+if __name__ == "__main__":
+    main()
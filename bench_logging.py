@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Logging overhead benchmark
+Times POST /analyze through the Flask test client with logging written inline
+(sync), through the queue listener (async), and with logging off, on the SQLite
+storage backend so no MySQL server is needed
+Usage: python bench_logging.py [--requests 5000] [--threads 4] [--fsync]
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+
+# Keep bench records and data out of the real logs/ and database
+os.environ.setdefault('LOG_DIR', tempfile.mkdtemp(prefix="safeher_bench_logs_"))
+os.environ.setdefault('DB_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(prefix="safeher_bench_db_"), "bench.db"))
+
+import logging
+import logger
+from metrics import LatencyStats
+
+
+def fsync_handlers():
+    """Make every file write durable, as on a slow or network disk"""
+    handlers = logger.async_handler.handlers if logger.async_handler else logger.logger.handlers
+    for handler in handlers:
+        if isinstance(handler, logging.FileHandler):
+            def flush(handler=handler, flush=handler.flush):
+                flush()
+                if handler.stream is not None:
+                    os.fsync(handler.stream.fileno())
+            handler.flush = flush
+
+
+def run(client, requests, threads):
+    stats = LatencyStats()
+    per_thread = requests // threads
+
+    def worker(n):
+        body = {"username": f"bench_log_{n}", "lat": 12.97, "lng": 77.59, "accuracy": 10}
+        for _ in range(per_thread):
+            with stats.time():
+                client.post('/analyze', json=body)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return stats.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request latency with logging sync, async and off")
+    parser.add_argument("--requests", type=int, default=5000, help="requests per mode")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent client threads")
+    parser.add_argument("--fsync", action="store_true", help="fsync after every log record")
+    args = parser.parse_args()
+
+    from app import app
+    client = app.test_client()
+    print(f"Logs in {logger.LOG_DIR}; {args.requests} requests x 3 modes, {args.threads} threads"
+          f"{', fsync on' if args.fsync else ''}")
+    print("=" * 78)
+
+    for mode, level, use_async in (("sync", "DEBUG", False), ("async", "DEBUG", True), ("off", "CRITICAL", True)):
+        logger.configure(level, use_async, access_log=mode != "off")
+        if args.fsync:
+            fsync_handlers()
+        run(client, min(args.requests, 200), args.threads)  # warm up
+        s = run(client, args.requests, args.threads)
+        logger.flush()
+        print(f"  {mode:<6} p50 {s['p50_ms']:>7.3f} ms  p99 {s['p99_ms']:>7.3f} ms  mean {s['mean_ms']:>7.3f} ms  "
+              f"dropped {logger.stats()['dropped']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Risk scoring benchmark
+Measures points/second for single-point and batched risk scoring
+Usage: python bench_risk.py [--points 100000]
+"""
+
+import argparse
+import time
+import numpy as np
+from ai_engine import run_ai_risk_check, run_ai_risk_check_batch, score_points, risk_model
+from risk_cache import RiskCache
+
+
+def bench(label, fn, points):
+    """Run fn once and print points/second"""
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {points:>9} pts  {elapsed * 1000:>9.1f} ms  {points / elapsed:>14,.0f} pts/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SAFEHER risk engine")
+    parser.add_argument("--points", type=int, default=100000, help="number of random points")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    lats = rng.uniform(11.5, 13.5, args.points)
+    lngs = rng.uniform(76.5, 78.5, args.points)
+    hours = rng.integers(0, 24, args.points)
+    single_count = min(args.points, 20000)
+
+    print(f"Risk grid: {risk_model.grid.shape[0]}x{risk_model.grid.shape[1]} cells")
+    print("=" * 78)
+    bench("run_ai_risk_check (per point)",
+          lambda: [run_ai_risk_check(lat, lng) for lat, lng in zip(lats[:single_count], lngs[:single_count])],
+          single_count)
+    bench("run_ai_risk_check_batch", lambda: run_ai_risk_check_batch(lats, lngs, hours), args.points)
+    bench("score_points (arrays only)", lambda: score_points(lats, lngs, hours), args.points)
+
+    # Users clustered in a few neighbourhoods, as in a city: most lookups hit a cached cell
+    cache = RiskCache()
+    centers = rng.integers(0, 50, single_count)
+    city_lats = (lats[:50][centers] + rng.normal(0, 0.005, single_count)).tolist()
+    city_lngs = (lngs[:50][centers] + rng.normal(0, 0.005, single_count)).tolist()
+    bench("run_ai_risk_check (clustered)",
+          lambda: [run_ai_risk_check(lat, lng, 12) for lat, lng in zip(city_lats, city_lngs)], single_count)
+    for run in ("cold", "warm"):
+        bench(f"RiskCache.check (clustered, {run})",
+              lambda: [cache.check(lat, lng, 12) for lat, lng in zip(city_lats, city_lngs)], single_count)
+    print(f"risk cache hit rate: {cache.stats()['hit_rate']:.1%}, {cache.stats()['entries']} cells")
+
+
+if __name__ == "__main__":
+    main()
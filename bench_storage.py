@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Storage backend benchmark
+Runs the same workload (user setup, batched location writes, single inserts,
+history pages and track queries) against the backend chosen by DB_BACKEND
+Usage: DB_BACKEND=sqlite SQLITE_PATH=/tmp/bench.db python bench_storage.py [--rows 200000] [--users 200]
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from storage import backend
+from metrics import LatencyStats
+
+BENCH_PREFIX = "bench_user_"
+
+
+def setup_users(users):
+    for i in range(users):
+        if backend.get_user(f"{BENCH_PREFIX}{i}") is None:
+            backend.insert_user(f"{BENCH_PREFIX}{i}", "x", "bench@example.com", "1234")
+
+
+def write_batches(rows, users, batch):
+    """Batched inserts as the location buffer issues them; returns rows/s"""
+    rng = np.random.default_rng(7)
+    end = datetime.now()
+    start = time.perf_counter()
+    for offset in range(0, rows, batch):
+        count = min(batch, rows - offset)
+        user_ids = rng.integers(0, users, count).tolist()
+        seconds = rng.uniform(0, 30 * 86400, count).tolist()
+        lats = rng.uniform(12.0, 13.0, count).tolist()
+        lngs = rng.uniform(77.0, 78.0, count).tolist()
+        backend.insert_locations([
+            (f"{BENCH_PREFIX}{u}", lat, lng, 10.0, end - timedelta(seconds=s))
+            for u, s, lat, lng in zip(user_ids, seconds, lats, lngs)
+        ])
+    return rows / (time.perf_counter() - start)
+
+
+def timed_calls(calls, fn):
+    stats = LatencyStats()
+    for args in calls:
+        with stats.time():
+            fn(*args)
+    return stats.summary()
+
+
+def report(label, s):
+    print(f"  {label:<18} p50 {s['p50_ms']:>7.3f} ms  p99 {s['p99_ms']:>7.3f} ms  mean {s['mean_ms']:>7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the selected SAFEHER storage backend")
+    parser.add_argument("--rows", type=int, default=200_000, help="fixes to write in batches")
+    parser.add_argument("--users", type=int, default=200, help="distinct users")
+    parser.add_argument("--batch", type=int, default=500, help="rows per batched write")
+    parser.add_argument("--queries", type=int, default=1000, help="calls per read/single-write measurement")
+    args = parser.parse_args()
+
+    print(f"Backend: {backend.name}")
+    print("=" * 70)
+    setup_users(args.users)
+
+    print(f"  batched writes     {write_batches(args.rows, args.users, args.batch):>10,.0f} rows/s "
+          f"({args.rows:,} rows, {args.batch} per batch)")
+
+    rng = np.random.default_rng(11)
+    users = [f"{BENCH_PREFIX}{u}" for u in rng.integers(0, args.users, args.queries).tolist()]
+    report("single insert", timed_calls([(u, 12.5, 77.5, 10.0) for u in users], backend.insert_location))
+    report("history page", timed_calls([(u, 50) for u in users], backend.get_user_locations))
+    report("track (500 pts)", timed_calls([(u, 500) for u in users], backend.get_user_track))
+    report("get_user", timed_calls([(u,) for u in users], backend.get_user))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Validator micro-benchmarks
+Scalar validators (precompiled vs inline regexes) and the bulk column validator
+vs a per-row loop over the scalar ones
+Usage: python bench_validators.py [--rows 100000] [--calls 100000]
+"""
+
+import argparse
+import re
+import time
+import numpy as np
+from validators import (
+    validate_username, validate_email, validate_contact_phone,
+    validate_coordinates, validate_accuracy, validate_fix_columns
+)
+
+
+def inline_username(username):
+    """Pre-change validate_username: pattern looked up by re.match on every call"""
+    if not username or len(username) < 3 or len(username) > 50:
+        return False, "Username must be 3-50 characters"
+    if not re.match(r'^[a-zA-Z0-9_]+$', username):
+        return False, "Username can only contain letters, numbers, and underscores"
+    return True, "Valid"
+
+
+def inline_email(email):
+    if not email:
+        return False, "Email is required"
+    if not re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email):
+        return False, "Invalid email format"
+    return True, "Valid"
+
+
+def inline_phone(contact):
+    if not contact:
+        return False, "Contact is required"
+    clean_contact = re.sub(r'[-()\s+]', '', contact)
+    if not clean_contact.isdigit():
+        return False, "Contact must be numeric (with optional formatting)"
+    if len(clean_contact) < 10 or len(clean_contact) > 15:
+        return False, "Contact must be 10-15 digits"
+    return True, "Valid"
+
+
+def scalar_rows(lats, lngs, accuracies):
+    """Per-row loop over the scalar validators"""
+    return [validate_coordinates(lat, lng)[0] and validate_accuracy(acc)[0]
+            for lat, lng, acc in zip(lats, lngs, accuracies)]
+
+
+def per_call(fn, values):
+    start = time.perf_counter()
+    for value in values:
+        fn(value)
+    return (time.perf_counter() - start) / len(values)
+
+
+def report(label, seconds, baseline=None):
+    speedup = f"  {baseline / seconds:>7.1f}x" if baseline else ""
+    print(f"  {label:<36} {seconds * 1e9:>10.0f} ns/item{speedup}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SAFEHER validators")
+    parser.add_argument("--rows", type=int, default=100000, help="rows for the column validators")
+    parser.add_argument("--calls", type=int, default=100000, help="calls per scalar validator")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    usernames = [f"user_{i}" for i in range(args.calls)]
+    emails = [f"user{i}@example.com" for i in range(args.calls)]
+    phones = [f"+91 (98{i % 10}) 555-{i % 10000:04d}" for i in range(args.calls)]
+
+    print("Scalar validators")
+    for label, inline, compiled, values in (("username", inline_username, validate_username, usernames),
+                                            ("email", inline_email, validate_email, emails),
+                                            ("phone", inline_phone, validate_contact_phone, phones)):
+        baseline = per_call(inline, values)
+        report(f"{label} (re.match inline)", baseline)
+        report(f"{label} (precompiled)", per_call(compiled, values), baseline)
+
+    # Roughly 1% of rows out of range so both paths do real work
+    lats = rng.uniform(-91, 91, args.rows)
+    lngs = rng.uniform(-181, 181, args.rows)
+    accuracies = rng.uniform(-100, 10100, args.rows)
+
+    print(f"\nColumn validation ({args.rows:,} rows)")
+    start = time.perf_counter()
+    expected = scalar_rows(lats.tolist(), lngs.tolist(), accuracies.tolist())
+    baseline = (time.perf_counter() - start) / args.rows
+    report("scalar loop", baseline)
+
+    start = time.perf_counter()
+    mask, _ = validate_fix_columns(lats, lngs, accuracies)
+    report("validate_fix_columns (NumPy)", (time.perf_counter() - start) / args.rows, baseline)
+
+    as_lists = (lats.tolist(), lngs.tolist(), accuracies.tolist())
+    start = time.perf_counter()
+    validate_fix_columns(*as_lists)
+    report("validate_fix_columns (lists)", (time.perf_counter() - start) / args.rows, baseline)
+
+    mismatches = int(np.count_nonzero(mask != np.array(expected)))
+    print(f"\n{int(mask.sum()):,} valid rows, {mismatches} mismatches vs scalar loop")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Location batch decoding benchmark
+Compares the binary wire format (wire.py) against the JSON body of /locations/batch:
+parse + validate + build insert rows, per fix
+Usage: python bench_wire.py [--fixes 10000] [--rounds 20]
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime
+import numpy as np
+from validators import validate_coordinates, validate_accuracy, validate_timestamp
+from wire import decode_fixes, encode_fixes, validate_fixes
+
+
+def json_path(body, username):
+    """What /locations/batch does with a JSON body"""
+    rows = []
+    for fix in json.loads(body)["locations"]:
+        if not (validate_coordinates(fix["lat"], fix["lng"])[0]
+                and validate_accuracy(fix["accuracy"])[0]
+                and validate_timestamp(fix["timestamp"])[0]):
+            continue
+        rows.append((username, float(fix["lat"]), float(fix["lng"]), float(fix["accuracy"]),
+                     datetime.fromtimestamp(fix["timestamp"])))
+    return rows
+
+
+def binary_path(body, username):
+    """What /locations/binary/<username> does with a packed body"""
+    fixes = decode_fixes(body)
+    good = fixes[validate_fixes(fixes)]
+    return [(username, lat, lng, accuracy, datetime.fromtimestamp(ts / 1000.0))
+            for lat, lng, accuracy, ts in zip(good["lat"].tolist(), good["lng"].tolist(),
+                                              good["accuracy"].tolist(), good["timestamp"].tolist())]
+
+
+def binary_decode_only(body, username):
+    """Decode + validate without materializing rows"""
+    fixes = decode_fixes(body)
+    return fixes[validate_fixes(fixes)]
+
+
+def best_of(fn, body, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(body, "bench_user")
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SAFEHER location batch decoding")
+    parser.add_argument("--fixes", type=int, default=10000, help="fixes per batch")
+    parser.add_argument("--rounds", type=int, default=20, help="timed rounds (best is reported)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    lats = rng.uniform(12.0, 13.0, args.fixes)
+    lngs = rng.uniform(77.0, 78.0, args.fixes)
+    accuracies = rng.uniform(3, 80, args.fixes).astype(np.float32)
+    seconds = 1737104400 + np.arange(args.fixes)
+
+    json_body = json.dumps({"username": "bench_user", "locations": [
+        {"lat": float(lat), "lng": float(lng), "accuracy": float(acc), "timestamp": int(ts)}
+        for lat, lng, acc, ts in zip(lats, lngs, accuracies, seconds)
+    ]}).encode()
+    binary_body = encode_fixes(lats, lngs, accuracies, seconds * 1000)
+
+    print(f"Batch of {args.fixes} fixes: JSON {len(json_body):,} bytes, binary {len(binary_body):,} bytes "
+          f"({len(json_body) / len(binary_body):.1f}x smaller)")
+    print("=" * 78)
+
+    results = []
+    for label, fn, body in (("json parse + validate + rows", json_path, json_body),
+                            ("binary decode + validate + rows", binary_path, binary_body),
+                            ("binary decode + validate", binary_decode_only, binary_body)):
+        elapsed = best_of(fn, body, args.rounds)
+        results.append(elapsed)
+        print(f"{label:<34} {elapsed * 1000:>9.2f} ms  {elapsed / args.fixes * 1e6:>8.3f} us/fix  "
+              f"{args.fixes / elapsed:>12,.0f} fixes/s")
+    print(f"\nSpeedup vs JSON: {results[0] / results[1]:.1f}x with rows, {results[0] / results[2]:.0f}x decode only")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Risk zone lookup benchmark
+Compares the grid-bucket zone index against a linear scan over every zone
+Usage: python bench_zones.py [--zones 20000] [--points 5000]
+"""
+
+import argparse
+import math
+import time
+import numpy as np
+from zones import Zone, ZoneIndex
+
+
+def random_zones(count, rng):
+    """Random hexagons of roughly 0.5-3 km radius scattered over south India"""
+    zones = []
+    centers = zip(rng.uniform(8.0, 20.0, count), rng.uniform(72.0, 85.0, count), rng.uniform(0.005, 0.03, count))
+    for i, (lat, lng, radius) in enumerate(centers):
+        polygon = [(lat + radius * math.sin(a), lng + radius * math.cos(a))
+                   for a in np.linspace(0, 2 * math.pi, 6, endpoint=False)]
+        zones.append(Zone(f"z{i}", f"Zone {i}", round(float(rng.uniform(0.1, 0.9)), 2), "High-risk zone detected", polygon))
+    return zones
+
+
+def linear_max_zone(zones, lat, lng):
+    """Reference implementation: test every zone"""
+    best = None
+    for zone in zones:
+        if (best is None or zone.weight > best.weight) and zone.contains(lat, lng):
+            best = zone
+    return best
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SAFEHER risk zone lookups")
+    parser.add_argument("--zones", type=int, default=20000, help="number of random zones")
+    parser.add_argument("--points", type=int, default=5000, help="number of lookup points")
+    parser.add_argument("--linear-points", type=int, default=200, help="points for the (slow) linear scan")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    zones = random_zones(args.zones, rng)
+    lats = rng.uniform(8.0, 20.0, args.points)
+    lngs = rng.uniform(72.0, 85.0, args.points)
+
+    index, build_time = timed(lambda: ZoneIndex(zones))
+    print(f"Built index over {len(zones)} zones in {build_time * 1000:.1f} ms: {index.stats()}")
+    print("=" * 78)
+
+    linear_count = min(args.linear_points, args.points)
+    linear, linear_time = timed(lambda: [linear_max_zone(zones, lat, lng)
+                                         for lat, lng in zip(lats[:linear_count], lngs[:linear_count])])
+    indexed, index_time = timed(lambda: [index.max_zone(lat, lng) for lat, lng in zip(lats, lngs)])
+    _, bulk_time = timed(lambda: index.max_weights(lats, lngs))
+
+    mismatches = sum(1 for a, b in zip(linear, indexed) if (a and a.weight) != (b and b.weight))
+    for label, count, elapsed in (("linear scan", linear_count, linear_time),
+                                  ("index max_zone", args.points, index_time),
+                                  ("index max_weights (bulk)", args.points, bulk_time)):
+        print(f"{label:<28} {count:>7} pts  {elapsed / count * 1e6:>10.2f} us/pt  {count / elapsed:>12,.0f} pts/s")
+    print(f"\nSpeedup vs linear scan: {(linear_time / linear_count) / (index_time / args.points):,.0f}x "
+          f"({mismatches} mismatches)")
+
+
+if __name__ == "__main__":
+    main()
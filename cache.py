@@ -0,0 +1,181 @@
+"""
+Cache - Read-through TTL cache with pluggable backends
+  memory  in-process LRU dict (per worker)
+  redis   any Redis-protocol client (shared across workers)
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from logger import info, error
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+CACHE_TTL = float(os.getenv('CACHE_TTL', 60))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+MISSING = object()
+
+
+class MemoryBackend:
+    """Thread-safe LRU dict whose entries expire after their TTL"""
+
+    name = "memory"
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def size(self):
+        return len(self._data)
+
+
+class RedisBackend:
+    """
+    Stores JSON values in a Redis-protocol server.
+    client needs get, set(ex=), delete and scan_iter(match=), e.g. redis.Redis;
+    eviction is left to the server's maxmemory policy.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, namespace="safeher:"):
+        self.client = client
+        self.namespace = namespace
+        self.evictions = 0
+
+    def get(self, key):
+        raw = self.client.get(self.namespace + key)
+        return MISSING if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.namespace + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.namespace + key)
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=self.namespace + prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def size(self):
+        return None
+
+
+class Cache:
+    """Read-through cache with hit/miss/eviction counters"""
+
+    def __init__(self, backend, default_ttl=CACHE_TTL):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        # Bumped on every invalidation so a load that raced with one is not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return the cached value for key, or call loader() and cache its result (None is not cached)"""
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            error("Cache get failed for %s: %s", key, e)
+            value = MISSING
+        if value is not MISSING:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        generation = self._generation
+        value = loader()
+        if value is not None and generation == self._generation:
+            try:
+                self.backend.set(key, value, ttl or self.default_ttl)
+            except Exception as e:
+                self.errors += 1
+                error("Cache set failed for %s: %s", key, e)
+        return value
+
+    def _bump(self):
+        with self._lock:
+            self._generation += 1
+
+    def invalidate(self, key):
+        self._bump()
+        try:
+            self.backend.delete(key)
+        except Exception as e:
+            self.errors += 1
+            error("Cache invalidate failed for %s: %s", key, e)
+
+    def invalidate_prefix(self, prefix):
+        self._bump()
+        try:
+            self.backend.delete_prefix(prefix)
+        except Exception as e:
+            self.errors += 1
+            error("Cache invalidate failed for %s*: %s", prefix, e)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.backend.evictions,
+            "errors": self.errors,
+            "entries": self.backend.size()
+        }
+
+
+def create_cache():
+    """Build the cache selected by CACHE_BACKEND, falling back to memory if Redis is unavailable"""
+    if CACHE_BACKEND == 'redis':
+        try:
+            import redis
+            client = redis.Redis.from_url(REDIS_URL)
+            client.ping()
+            info("Cache backend: redis (%s)", REDIS_URL)
+            return Cache(RedisBackend(client))
+        except Exception as e:
+            error("Redis cache unavailable, using in-process cache: %s", e)
+    return Cache(MemoryBackend())
+
+
+cache = create_cache()
@@ -1,8 +1,15 @@
+import json
 import mysql.connector
-from mysql.connector import pooling
 import os
+import threading
+import weakref
+from contextlib import contextmanager
 from datetime import datetime
 from logger import info, error, debug
+from routine_cache import RoutineCache
+from geo import parse_coordinates, haversine_km
+from db_pool import ConnectionPool
+from metrics import LatencyStats, span
 
 # MySQL Database Configuration
 DB_CONFIG = {
@@ -12,32 +19,154 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME', 'zoha')
 }
 
-# Create connection pool
-try:
-    connection_pool = pooling.MySQLConnectionPool(
-        pool_name="safeher_pool",
-        pool_size=10,
-        pool_reset_session=True,
-        **DB_CONFIG
-    )
-    info("Connection pool created successfully")
-except Exception as e:
-    error(f"Connection pool error: {e}")
-    connection_pool = None
+# Connections per process; the multi-worker launcher sizes this from DB_CONNECTION_BUDGET
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+# Connections opened at startup and kept open when idle
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+
+# The pool is created on first use in each process, never inherited across fork()
+connection_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Reuse one server-side prepared statement per (connection, SQL) instead of sending SQL text.
+# Off by default: Connector/Python resets the statement before every execute, which costs
+# an extra round trip compared with a plain text query.
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', '0') == '1'
+
+def _connect():
+    # Autocommit: a single-statement write is one round trip, with no separate COMMIT
+    return mysql.connector.connect(autocommit=True, **DB_CONFIG)
+
+def _get_pool():
+    """Return this process's connection pool, creating it on first use"""
+    global connection_pool, _pool_pid
+    if connection_pool is not None and _pool_pid == os.getpid():
+        return connection_pool
+    with _pool_lock:
+        if connection_pool is None or _pool_pid != os.getpid():
+            # A pool inherited from a parent process is dropped without closing its sockets
+            connection_pool = ConnectionPool(_connect, min_size=DB_POOL_MIN, max_size=DB_POOL_SIZE)
+            _pool_pid = os.getpid()
+            info("Connection pool created (min %s, max %s, pid %s)",
+                 connection_pool.min_size, connection_pool.max_size, _pool_pid)
+    return connection_pool
+
+def start_pool():
+    """Create this process's pool and start prewarming it in the background"""
+    _get_pool().start()
 
 def get_connection():
-    """Get connection from pool"""
-    if connection_pool:
-        return connection_pool.get_connection()
-    else:
-        # Fallback to direct connection if pool fails
-        return mysql.connector.connect(**DB_CONFIG)
+    """Check out a pooled connection; close() returns it to the pool"""
+    return _get_pool().acquire()
+
+def ping_database():
+    """Round-trip a pooled connection (COM_PING); raises if the database is unreachable"""
+    conn = get_connection()
+    try:
+        conn.ping()
+    except Exception:
+        conn.discard()
+        raise
+    conn.close()
+
+def pool_stats():
+    return _get_pool().stats()
+
+# Per-statement latency (including pool checkout), keyed by query name
+query_latency = {}
+_query_latency_lock = threading.Lock()
+# Prepared cursors per raw connection, dropped with the connection
+_statements = weakref.WeakKeyDictionary()
+
+def _latency(name):
+    stats = query_latency.get(name)
+    if stats is None:
+        with _query_latency_lock:
+            stats = query_latency.setdefault(name, LatencyStats())
+    return stats
+
+def query_stats():
+    return {name: stats.summary() for name, stats in sorted(query_latency.items())}
+
+@contextmanager
+def connection():
+    """Pooled connection for a with-block; returned on exit, or discarded after a connection-level error"""
+    conn = get_connection()
+    try:
+        yield conn
+    except (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError):
+        conn.discard()
+        raise
+    finally:
+        conn.close()
+
+@contextmanager
+def dedicated_connection():
+    """A connection outside the pool, for a session held open a long time (a named lock); closed on exit"""
+    conn = _connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+@contextmanager
+def transaction():
+    """Connection with an explicit transaction, for writes that span several statements"""
+    with connection() as conn:
+        conn.start_transaction()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def _cursor(conn, sql):
+    """Cursor for one statement: a cached prepared cursor, or a plain one (caller closes it)"""
+    if not DB_PREPARED_STATEMENTS:
+        return conn.cursor()
+    cursors = _statements.setdefault(conn.raw, {})
+    cursor = cursors.get(sql)
+    if cursor is None:
+        cursor = cursors[sql] = conn.cursor(prepared=True)
+    return cursor
+
+def execute(name, sql, params=(), fetch=None):
+    """
+    Run one statement on a pooled connection and time it under name.
+    fetch: None (returns rowcount), "one" or "all"
+    """
+    with span("db"), _latency(name).time(), connection() as conn:
+        cursor = _cursor(conn, sql)
+        try:
+            cursor.execute(sql, params)
+            if fetch is None:
+                return cursor.rowcount
+            rows = cursor.fetchall()
+            if fetch == "one":
+                return rows[0] if rows else None
+            return rows
+        finally:
+            if not DB_PREPARED_STATEMENTS:
+                cursor.close()
+
+def execute_many(name, sql, rows):
+    """executemany on a plain cursor, which sends a multi-row INSERT as one statement"""
+    with span("db"), _latency(name).time(), connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.executemany(sql, rows)
+            return cursor.rowcount
+        finally:
+            cursor.close()
 
 def init_db():
     """Initialize database with required tables"""
     conn = None
     try:
-        conn = get_connection()
+        # One-off connection: importing this module must not build a pool before a fork
+        conn = mysql.connector.connect(**DB_CONFIG)
         cursor = conn.cursor()
         
         # Create user_details table
@@ -85,40 +214,136 @@ def init_db():
             )
         ''')
         
+        # Create routines table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS routines (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                title VARCHAR(255) NOT NULL,
+                time_from TIME NOT NULL,
+                time_to TIME NOT NULL,
+                location VARCHAR(255),
+                days VARCHAR(50),
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                latitude DOUBLE NULL,
+                longitude DOUBLE NULL,
+                FOREIGN KEY (username) REFERENCES user_details(username) ON DELETE CASCADE
+            )
+        ''')
+        
+        # Saved places: a circle (latitude, longitude, radius in meters) or a JSON polygon
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS places (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                latitude DOUBLE NULL,
+                longitude DOUBLE NULL,
+                radius FLOAT NULL,
+                polygon TEXT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_places_user (username),
+                FOREIGN KEY (username) REFERENCES user_details(username) ON DELETE CASCADE
+            )
+        ''')
+        
+        # Emergency contacts, owned by the user who added them
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS emergency_contacts (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(255) NULL,
+                `contact-name` VARCHAR(255) NOT NULL,
+                `contact-phone` INT NOT NULL,
+                `contact-relation` VARCHAR(100)
+            )
+        ''')
+        # Contacts saved before they had an owner keep NULL and are not returned to anyone
+        _add_column_if_missing(cursor, 'emergency_contacts', 'username', 'VARCHAR(255) NULL')
+        _add_index_if_missing(cursor, 'emergency_contacts', 'idx_emergency_contacts_user', '(username)')
+        
+        # FCM tokens of contacts' devices, matched to emergency_contacts by phone key
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_tokens (
+                token VARCHAR(255) PRIMARY KEY,
+                phone VARCHAR(20) NOT NULL,
+                username VARCHAR(255) NULL,
+                platform VARCHAR(20) NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                INDEX idx_device_tokens_phone (phone)
+            )
+        ''')
+        
+        # Routines created before coordinates were parsed on save
+        _add_column_if_missing(cursor, 'routines', 'latitude', 'DOUBLE NULL')
+        _add_column_if_missing(cursor, 'routines', 'longitude', 'DOUBLE NULL')
+        
+        # Keyset pagination over a user's history walks this index backwards
+        _add_index_if_missing(cursor, 'location', 'idx_location_user_time', '(username, timestamp, id)')
+        # Monthly rotation (location_store.py) finds and moves old rows by time
+        _add_index_if_missing(cursor, 'location', 'idx_location_time', '(timestamp)')
+        
+        # Downsampled tracks kept after raw monthly tables expire
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS location_rollup (
+                username VARCHAR(255) NOT NULL,
+                bucket DATETIME NOT NULL,
+                latitude DOUBLE NOT NULL,
+                longitude DOUBLE NOT NULL,
+                accuracy FLOAT,
+                fixes INT NOT NULL,
+                PRIMARY KEY (username, bucket)
+            )
+        ''')
+        
         conn.commit()
         cursor.close()
     except Exception as e:
-        error(f"Error initializing database: {e}")
+        error("Error initializing database: %s", e)
         raise
     finally:
         if conn:
             conn.close()
 
+def _add_column_if_missing(cursor, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists"""
+    cursor.execute(
+        'SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s',
+        (table, column)
+    )
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f'ALTER TABLE `{table}` ADD COLUMN `{column}` {definition}')
+        info("Added column %s.%s", table, column)
+
+def _add_index_if_missing(cursor, table, index, columns):
+    """CREATE INDEX unless an index with this name already exists"""
+    cursor.execute(
+        'SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s',
+        (table, index)
+    )
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f'CREATE INDEX `{index}` ON `{table}` {columns}')
+        info("Added index %s.%s", table, index)
+
+SQL_INSERT_USER = 'INSERT INTO user_details (username, password, email, pin) VALUES (%s, %s, %s, %s)'
+SQL_INSERT_CONTACT = 'INSERT INTO emergency_contacts (username, `contact-name`, `contact-phone`, `contact-relation`) VALUES (%s, %s, %s, %s)'
+SQL_INSERT_LOCATION = 'INSERT INTO location (username, latitude, longitude, accuracy) VALUES (%s, %s, %s, %s)'
+SQL_INSERT_LOCATIONS = 'INSERT INTO location (username, latitude, longitude, accuracy, timestamp) VALUES (%s, %s, %s, %s, %s)'
+SQL_INSERT_SOS = 'INSERT INTO sos_logs (username, timestamp) VALUES (%s, COALESCE(%s, NOW()))'
+SQL_GET_USER = 'SELECT * FROM user_details WHERE username = %s'
+SQL_GET_CONTACTS = 'SELECT `contact-name`, `contact-relation`, `contact-phone` FROM emergency_contacts WHERE username = %s ORDER BY id'
+
 def insert_user(username, password, email, pin):
     """Insert a new user into user_details table"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO user_details (username, password, email, pin) VALUES (%s, %s, %s, %s)',
-            (username, password, email, pin)
-        )
-        conn.commit()
-        cursor.close()
+        execute('insert_user', SQL_INSERT_USER, (username, password, email, pin))
     except Exception as e:
-        error(f"Error inserting user: {e}")
+        error("Error inserting user: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def insert_contact(username, name, relation, contact):
     """Insert a contact for a user"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
         # Convert phone to integer, taking last 9 digits if needed to fit INT
         phone_str = str(contact).replace('+', '').replace('-', '').replace(' ', '')
         # If phone number is too long, take last 9 digits (for INT max value ~2.1 billion)
@@ -127,271 +352,229 @@ def insert_contact(username, name, relation, contact):
         else:
             phone_int = int(phone_str)
         
-        cursor.execute(
-            'INSERT INTO emergency_contacts (`contact-name`, `contact-phone`, `contact-relation`) VALUES (%s, %s, %s)',
-            (name, phone_int, relation)
-        )
-        conn.commit()
-        cursor.close()
+        execute('insert_contact', SQL_INSERT_CONTACT, (username, name, phone_int, relation))
     except Exception as e:
-        error(f"Error inserting contact: {e}")
+        error("Error inserting contact: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def insert_location(username, latitude, longitude, accuracy):
     """Insert location data for a user"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO location (username, latitude, longitude, accuracy) VALUES (%s, %s, %s, %s)',
-            (username, latitude, longitude, accuracy)
-        )
-        conn.commit()
-        cursor.close()
+        execute('insert_location', SQL_INSERT_LOCATION, (username, latitude, longitude, accuracy))
     except Exception as e:
-        error(f"Error inserting location: {e}")
+        error("Error inserting location: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def insert_sos(username):
-    """Log an SOS call"""
-    conn = None
+def insert_locations(rows):
+    """Insert many (username, latitude, longitude, accuracy, timestamp) rows as one statement"""
+    if not rows:
+        return
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO sos_logs (username) VALUES (%s)',
-            (username,)
-        )
-        conn.commit()
-        cursor.close()
+        execute_many('insert_locations', SQL_INSERT_LOCATIONS, rows)
     except Exception as e:
-        error(f"Error logging SOS: {e}")
+        error("Error inserting %s locations: %s", len(rows), e)
+        raise
+
+def insert_sos(username, timestamp=None):
+    """Log an SOS call (at the given time, or now)"""
+    try:
+        execute('insert_sos', SQL_INSERT_SOS, (username, timestamp))
+    except Exception as e:
+        error("Error logging SOS: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def get_user(username):
     """Get user details by username"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM user_details WHERE username = %s', (username,))
-        result = cursor.fetchone()
-        cursor.close()
-        return result
+        return execute('get_user', SQL_GET_USER, (username,), fetch="one")
     except Exception as e:
-        error(f"Error getting user: {e}")
+        error("Error getting user: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
+
+def _contact_row(r):
+    return {"name": r[0], "relation": r[1], "contact": str(r[2])}
 
 def get_user_contacts(username):
     """Get all contacts for a user"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT `contact-name`, `contact-relation`, `contact-phone` FROM emergency_contacts', ())
-        results = cursor.fetchall()
-        cursor.close()
-        return [{"name": r[0], "relation": r[1], "contact": str(r[2])} for r in results]
+        return [_contact_row(r) for r in execute('get_user_contacts', SQL_GET_CONTACTS, (username,), fetch="all")]
     except Exception as e:
-        error(f"Error getting contacts: {e}")
+        error("Error getting contacts: %s", e)
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def get_user_locations(username, limit=50):
-    """Get location history for a user"""
-    conn = None
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT latitude, longitude, accuracy, timestamp 
-            FROM location 
-            WHERE username = %s 
-            ORDER BY timestamp DESC 
-            LIMIT %s
-        ''', (username, limit))
-        results = cursor.fetchall()
-        cursor.close()
-        return [{"latitude": r[0], "longitude": r[1], "accuracy": r[2], "timestamp": str(r[3])} for r in results]
-    except Exception as e:
-        error(f"Error getting locations: {e}")
-        raise
-    finally:
-        if conn:
-            conn.close()
+SQL_INSERT_ROUTINE = 'INSERT INTO routines (username, title, time_from, time_to, location, days, latitude, longitude, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())'
+SQL_GET_ROUTINES = 'SELECT id, title, time_from, time_to, location, days FROM routines WHERE username = %s ORDER BY time_from ASC'
+SQL_DELETE_ROUTINE = 'DELETE FROM routines WHERE id = %s'
+SQL_GET_ROUTINE_OWNER = 'SELECT username FROM routines WHERE id = %s'
+SQL_LOAD_ROUTINES = 'SELECT id, title, time_from, time_to, location, days, latitude, longitude FROM routines WHERE username = %s'
 
 def insert_routine(username, title, time_from, time_to, location, days):
-    """Insert a routine for a user"""
-    conn = None
+    """Insert a routine for a user; "lat,lng" locations are also stored as numeric coordinates"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO routines (username, title, time_from, time_to, location, days, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())',
-            (username, title, time_from, time_to, location, days)
+        coordinates = parse_coordinates(location) or (None, None)
+        execute(
+            'insert_routine', SQL_INSERT_ROUTINE,
+            (username, title, time_from, time_to, location, days, coordinates[0], coordinates[1])
         )
-        conn.commit()
-        cursor.close()
+        routine_cache.invalidate(username)
         return True, "Routine saved successfully"
     except Exception as e:
-        error(f"Error inserting routine: {e}")
+        error("Error inserting routine: %s", e)
         return False, str(e)
-    finally:
-        if conn:
-            conn.close()
 
 def get_user_routines(username):
     """Get all routines for a user"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, title, time_from, time_to, location, days FROM routines WHERE username = %s ORDER BY time_from ASC',
-            (username,)
-        )
-        results = cursor.fetchall()
-        cursor.close()
+        results = execute('get_user_routines', SQL_GET_ROUTINES, (username,), fetch="all")
         return [{"id": r[0], "title": r[1], "timeFrom": str(r[2]), "timeTo": str(r[3]), "location": r[4], "days": r[5]} for r in results]
     except Exception as e:
-        error(f"Error getting routines: {e}")
+        error("Error getting routines: %s", e)
         return []
-    finally:
-        if conn:
-            conn.close()
+
+def get_routine_owner(routine_id):
+    """Username a routine belongs to (None if there is no such routine)"""
+    row = execute('get_routine_owner', SQL_GET_ROUTINE_OWNER, (routine_id,), fetch="one")
+    return row[0] if row else None
 
 def delete_routine(routine_id):
     """Delete a routine by ID"""
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM routines WHERE id = %s', (routine_id,))
-        conn.commit()
-        cursor.close()
+        execute('delete_routine', SQL_DELETE_ROUTINE, (routine_id,))
+        routine_cache.invalidate_routine(routine_id)
         return True, "Routine deleted successfully"
     except Exception as e:
-        error(f"Error deleting routine: {e}")
+        error("Error deleting routine: %s", e)
         return False, str(e)
-    finally:
-        if conn:
-            conn.close()
+
+def _routine_row(r):
+    return {"id": r[0], "title": r[1], "time_from": r[2], "time_to": r[3], "location": r[4], "days": r[5],
+            "latitude": r[6], "longitude": r[7]}
+
+def _load_routines(username):
+    """Fetch a user's routines for the routine cache"""
+    return [_routine_row(r) for r in execute('load_routines', SQL_LOAD_ROUTINES, (username,), fetch="all")]
+
+routine_cache = RoutineCache(_load_routines)
+
+def get_routine_schedule(username):
+    """The user's cached RoutineSchedule"""
+    return routine_cache.get(username)
+
+def invalidate_routine_schedule(username):
+    """Drop this process's cached schedule (another worker changed the user's routines)"""
+    routine_cache.invalidate(username)
 
 def check_location_against_routine(username, current_lat, current_lon):
     """
     Check if user's current location matches their routine location for current time.
     Returns: (is_at_correct_location, routine_info, distance_km)
     """
-    conn = None
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Get all routines for user
-        cursor.execute(
-            'SELECT id, title, time_from, time_to, location FROM routines WHERE username = %s',
-            (username,)
-        )
-        routines = cursor.fetchall()
-        cursor.close()
-        
-        from datetime import datetime
-        current_time = datetime.now().time()
-        
-        # Check if user is currently in a scheduled routine
-        for routine in routines:
-            routine_id, title, time_from, time_to, routine_location = routine
-            
-            # Check if current time falls within routine time
-            if time_from <= current_time <= time_to:
-                # Calculate distance between current location and routine location
-                distance = calculate_distance(current_lat, current_lon, routine_location)
-                
-                # If routine has specific location and user is far (>1km), it's a mismatch
-                if routine_location and distance is not None and distance > 1.0:
-                    return False, {
-                        "routine_id": routine_id,
-                        "title": title,
-                        "location": routine_location,
-                        "time_from": str(time_from),
-                        "time_to": str(time_to)
-                    }, distance
-                elif routine_location and distance is not None:
-                    return True, {
-                        "routine_id": routine_id,
-                        "title": title,
-                        "location": routine_location,
-                        "distance_km": round(distance, 2)
-                    }, distance
-        
-        # No active routine at this time
-        return True, None, 0
-        
+        return routine_cache.get(username).check_location(float(current_lat), float(current_lon))
     except Exception as e:
-        error(f"Error checking location against routine: {e}")
+        error("Error checking location against routine: %s", e)
         return None, None, None
-    finally:
-        if conn:
-            conn.close()
+
+SQL_INSERT_PLACE = 'INSERT INTO places (username, name, latitude, longitude, radius, polygon) VALUES (%s, %s, %s, %s, %s, %s)'
+SQL_GET_PLACES = 'SELECT id, name, latitude, longitude, radius, polygon FROM places WHERE username = %s ORDER BY id'
+SQL_DELETE_PLACE = 'DELETE FROM places WHERE id = %s'
+SQL_GET_PLACE_OWNER = 'SELECT username FROM places WHERE id = %s'
+
+def _place_row(r):
+    return {"id": r[0], "name": r[1], "latitude": r[2], "longitude": r[3], "radius": r[4],
+            "polygon": json.loads(r[5]) if r[5] else None}
+
+def insert_place(username, name, latitude, longitude, radius=None, polygon=None):
+    """Save a place fence: a circle of radius meters, or a polygon of [lat, lng] vertices"""
+    try:
+        execute('insert_place', SQL_INSERT_PLACE,
+                (username, name, latitude, longitude, radius, json.dumps(polygon) if polygon else None))
+        return True, "Place saved successfully"
+    except Exception as e:
+        error("Error inserting place: %s", e)
+        return False, str(e)
+
+def get_user_places(username):
+    """Get all saved places for a user"""
+    try:
+        return [_place_row(r) for r in execute('get_user_places', SQL_GET_PLACES, (username,), fetch="all")]
+    except Exception as e:
+        error("Error getting places: %s", e)
+        raise
+
+def get_place_owner(place_id):
+    """Username a saved place belongs to (None if there is no such place)"""
+    row = execute('get_place_owner', SQL_GET_PLACE_OWNER, (place_id,), fetch="one")
+    return row[0] if row else None
+
+def delete_place(place_id):
+    """Delete a saved place by ID"""
+    try:
+        execute('delete_place', SQL_DELETE_PLACE, (place_id,))
+        return True, "Place deleted successfully"
+    except Exception as e:
+        error("Error deleting place: %s", e)
+        return False, str(e)
+
+SQL_INSERT_DEVICE_TOKEN = ('INSERT INTO device_tokens (token, phone, username, platform) VALUES (%s, %s, %s, %s) '
+                           'ON DUPLICATE KEY UPDATE phone = VALUES(phone), username = VALUES(username), '
+                           'platform = VALUES(platform), updated_at = NOW()')
+
+def insert_device_token(token, phone, username=None, platform=None):
+    """Register (or move) a device's FCM token under a phone number key (validators.phone_key)"""
+    try:
+        execute('insert_device_token', SQL_INSERT_DEVICE_TOKEN, (token, phone, username, platform))
+        return True, "Device registered successfully"
+    except Exception as e:
+        error("Error registering device token: %s", e)
+        return False, str(e)
+
+def sql_get_device_tokens(count):
+    return f'SELECT phone, token FROM device_tokens WHERE phone IN ({", ".join(["%s"] * count)})'
+
+def _tokens_by_phone(rows):
+    tokens = {}
+    for phone, token in rows:
+        tokens.setdefault(phone, []).append(token)
+    return tokens
+
+def get_device_tokens(phones):
+    """FCM tokens for a list of phone keys: {phone: [tokens]}"""
+    phones = list(phones)
+    if not phones:
+        return {}
+    try:
+        rows = execute('get_device_tokens', sql_get_device_tokens(len(phones)), tuple(phones), fetch="all")
+        return _tokens_by_phone(rows)
+    except Exception as e:
+        error("Error getting device tokens: %s", e)
+        raise
+
+def delete_device_tokens(tokens):
+    """Remove tokens FCM reported as unregistered"""
+    tokens = list(tokens)
+    if not tokens:
+        return True, "No tokens to delete"
+    try:
+        execute('delete_device_tokens', f'DELETE FROM device_tokens WHERE token IN ({", ".join(["%s"] * len(tokens))})',
+                tuple(tokens))
+        return True, f"Deleted {len(tokens)} device tokens"
+    except Exception as e:
+        error("Error deleting device tokens: %s", e)
+        return False, str(e)
 
 def calculate_distance(lat1, lon1, location_name):
     """
-    Calculate distance from coordinates to a location name.
-    For now, returns a placeholder - can integrate with geocoding API later.
-    Returns distance in kilometers.
+    Calculate distance from coordinates to a "lat,lng" location string.
+    Returns distance in kilometers, or None if the location is not coordinates.
     """
-    try:
-        # This is a simplified version - in production, you'd use geocoding
-        # to convert location_name to coordinates, then calculate distance
-        
-        # For now, we'll just return None if location_name is not specific coordinates
-        # In future, integrate with Google Maps or similar API
-        
-        # Simple check: if location_name contains coordinates format
-        if "," in str(location_name):
-            try:
-                parts = location_name.split(",")
-                loc_lat = float(parts[0].strip())
-                loc_lon = float(parts[1].strip())
-                
-                # Haversine formula to calculate distance
-                from math import radians, sin, cos, sqrt, atan2
-                
-                R = 6371  # Earth's radius in kilometers
-                
-                lat1_rad = radians(float(lat1))
-                lon1_rad = radians(float(lon1))
-                lat2_rad = radians(loc_lat)
-                lon2_rad = radians(loc_lon)
-                
-                dlat = lat2_rad - lat1_rad
-                dlon = lon2_rad - lon1_rad
-                
-                a = sin(dlat/2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon/2)**2
-                c = 2 * atan2(sqrt(a), sqrt(1-a))
-                
-                distance = R * c
-                return distance
-            except:
-                return None
+    coordinates = parse_coordinates(location_name)
+    if coordinates is None:
         return None
-    except Exception as e:
-        error(f"Error calculating distance: {e}")
+    try:
+        return haversine_km(float(lat1), float(lon1), coordinates[0], coordinates[1])
+    except (TypeError, ValueError) as e:
+        error("Error calculating distance: %s", e)
         return None
 
 # Initialize database on import
@@ -399,5 +582,5 @@ try:
     init_db()
     info("MySQL database initialized successfully")
 except Exception as e:
-    error(f"MySQL connection warning: {e}")
+    error("MySQL connection warning: %s", e)
     error("Make sure MySQL is running and credentials are correct in environment variables")
@@ -2,13 +2,12 @@
 DB Adapter - Clean interface to database operations
 Exposes high-level functions for app.py to use
 """
-from database import (
-    insert_user,
-    insert_contact,
-    insert_location,
-    insert_sos,
-    get_user
-)
+from datetime import datetime
+import numpy as np
+from storage import backend
+from location_buffer import create_location_buffer
+from cache import cache
+from wire import validate_fixes
 from validators import (
     validate_username,
     validate_email,
@@ -17,9 +16,18 @@ from validators import (
     validate_coordinates,
     validate_accuracy,
     validate_name,
-    validate_relation
+    validate_relation,
+    validate_timestamp,
+    validate_fix_columns,
+    validate_device_token,
+    phone_key,
+    FIX_ERRORS,
+    FIX_TIMESTAMP_INVALID
 )
 
+# Location writes are coalesced into multi-row commits off the request thread
+location_buffer = create_location_buffer(backend.insert_locations)
+
 def log_user(username, password, email, pin):
     """Log new user to database with validation"""
     # Validate all inputs
@@ -36,7 +44,8 @@ def log_user(username, password, email, pin):
         return False, f"PIN error: {msg}"
     
     try:
-        insert_user(username, password, email, pin)
+        backend.insert_user(username, password, email, pin)
+        cache.invalidate(f"user:{username}")
         return True, "User registered successfully"
     except Exception as e:
         return False, f"Database error: {str(e)}"
@@ -61,14 +70,17 @@ def log_contact(username, name, relation, contact):
         return False, f"Contact error: {msg}"
     
     try:
-        insert_contact(username, name, relation, contact)
+        backend.insert_contact(username, name, relation, contact)
+        cache.invalidate(f"contacts:{username}")
         return True, "Contact added successfully"
     except Exception as e:
         return False, f"Database error: {str(e)}"
 
-def log_location(username, lat, lng, accuracy):
-    """Log location with accuracy and validation"""
-    # Validate inputs
+def queue_location(username, lat, lng, accuracy):
+    """
+    Validate a fix and queue it for the next batched write.
+    Returns: (success, message), or (None, None) when the buffer is full and the caller must write it
+    """
     valid, msg = validate_username(username)
     if not valid:
         return False, f"Username error: {msg}"
@@ -81,24 +93,184 @@ def log_location(username, lat, lng, accuracy):
     if not valid:
         return False, f"Accuracy error: {msg}"
     
+    if location_buffer.add((username, float(lat), float(lng), float(accuracy), datetime.now())):
+        return True, "Location queued"
+    return None, None
+
+def log_location(username, lat, lng, accuracy):
+    """Log location with accuracy and validation"""
+    success, message = queue_location(username, lat, lng, accuracy)
+    if success is not None:
+        return success, message
+    
+    # Buffer is full: write synchronously so the request applies backpressure
     try:
-        insert_location(username, lat, lng, accuracy)
+        backend.insert_location(username, lat, lng, accuracy)
         return True, "Location logged successfully"
     except Exception as e:
         return False, f"Database error: {str(e)}"
 
-def log_sos(username):
+def log_locations(username, fixes):
+    """
+    Validate a batch of fixes for one user and queue the valid ones.
+    Returns: (accepted_count, errors) where errors is a list of {"index", "error"}
+    """
+    valid, msg = validate_username(username)
+    if not valid:
+        return 0, [{"index": None, "error": f"Username error: {msg}"}]
+    
+    fixes = [fix if isinstance(fix, dict) else None for fix in fixes]
+    columns = [fix or {} for fix in fixes]
+    timestamps = [fix.get('timestamp') for fix in columns]
+    # Numeric timestamps are range-checked with the coordinates; ISO strings per row below
+    numeric = [ts if isinstance(ts, (int, float)) and not isinstance(ts, bool) else None for ts in timestamps]
+    mask, codes = validate_fix_columns(
+        [fix.get('lat') for fix in columns],
+        [fix.get('lng') for fix in columns],
+        [fix.get('accuracy', 0) for fix in columns],
+        numeric
+    )
+    
+    rows = []
+    errors = []
+    now = datetime.now()
+    for index, (fix, valid, code) in enumerate(zip(fixes, mask.tolist(), codes.tolist())):
+        if fix is None:
+            errors.append({"index": index, "error": "Fix must be an object"})
+            continue
+        if not valid:
+            field, msg = FIX_ERRORS[code]
+            errors.append({"index": index, "error": f"{field} error: {msg}"})
+            continue
+        timestamp = timestamps[index]
+        if timestamp is not None and numeric[index] is None:
+            valid, msg = validate_timestamp(timestamp)
+            if not valid:
+                errors.append({"index": index, "error": f"Timestamp error: {msg}"})
+                continue
+        try:
+            when = _to_datetime(timestamp) or now
+        except (ValueError, OverflowError, OSError):
+            # e.g. NaN, or a time the local time zone cannot represent
+            field, msg = FIX_ERRORS[FIX_TIMESTAMP_INVALID]
+            errors.append({"index": index, "error": f"{field} error: {msg}"})
+            continue
+        
+        rows.append((username, float(fix['lat']), float(fix['lng']), float(fix.get('accuracy', 0)), when))
+    
+    accepted, db_error = _queue_locations(rows)
+    if db_error:
+        errors.append({"index": None, "error": db_error})
+    return accepted, errors
+
+def log_location_array(username, fixes):
+    """
+    Queue a decoded binary batch (wire.FIX_DTYPE array) for one user.
+    Returns: (accepted_count, rejected_indexes, error) where error is a message or None
+    """
+    valid, msg = validate_username(username)
+    if not valid:
+        return 0, [], f"Username error: {msg}"
+    
+    mask = validate_fixes(fixes)
+    good = fixes[mask]
+    now = datetime.now()
+    rows = []
+    rejected = np.flatnonzero(~mask).tolist()
+    for index, lat, lng, accuracy, ts in zip(
+        np.flatnonzero(mask).tolist(),
+        good["lat"].tolist(), good["lng"].tolist(), good["accuracy"].tolist(), good["timestamp"].tolist()
+    ):
+        try:
+            when = datetime.fromtimestamp(ts / 1000.0) if ts else now
+        except (ValueError, OverflowError, OSError):
+            # A time the local time zone cannot represent is an invalid record, not a failed batch
+            rejected.append(index)
+            continue
+        rows.append((username, lat, lng, accuracy, when))
+    accepted, db_error = _queue_locations(rows)
+    return accepted, sorted(rejected), db_error
+
+def _queue_locations(rows):
+    """Hand rows to the write-behind buffer; returns (accepted_count, error message or None)"""
+    accepted = location_buffer.add_many(rows)
+    if accepted < len(rows):
+        # Buffer is full: write the remainder synchronously
+        try:
+            backend.insert_locations(rows[accepted:])
+            accepted = len(rows)
+        except Exception as e:
+            return accepted, f"Database error: {str(e)}"
+    return accepted, None
+
+def _to_datetime(timestamp):
+    """Convert an epoch-seconds number or ISO 8601 string to a naive local datetime"""
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, (int, float)):
+        return datetime.fromtimestamp(timestamp)
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+def log_sos(username, timestamp=None):
     """Log SOS event with validation"""
     valid, msg = validate_username(username)
     if not valid:
         return False, f"Username error: {msg}"
     
     try:
-        insert_sos(username)
+        backend.insert_sos(username, _to_datetime(timestamp))
         return True, "SOS logged successfully"
     except Exception as e:
         return False, f"Database error: {str(e)}"
 
+def lookup_user(username):
+    """Public profile {username, email} for a user, or None (read-through cached)"""
+    def load():
+        user = backend.get_user(username)
+        return {"username": user[0], "email": user[2]} if user else None
+    return cache.get_or_load(f"user:{username}", load)
+
+def lookup_contacts(username):
+    """Emergency contacts for a user (read-through cached)"""
+    return cache.get_or_load(f"contacts:{username}", lambda: backend.get_user_contacts(username))
+
+def lookup_sos_recipients(username):
+    """
+    Contacts to alert for a user's SOS, each with the FCM tokens of their devices.
+    Read from the database every time: a contact or device added through another worker
+    must not miss an SOS while this worker's cache catches up.
+    """
+    contacts = backend.get_user_contacts(username) or []
+    recipients = [{"name": c["name"], "phone": phone_key(c["contact"])} for c in contacts]
+    tokens = backend.get_device_tokens({r["phone"] for r in recipients if r["phone"]})
+    for recipient in recipients:
+        recipient["tokens"] = tokens.get(recipient["phone"], [])
+    return recipients
+
+def register_device(token, phone, username=None, platform=None):
+    """Register a device's FCM token under its owner's phone number"""
+    valid, msg = validate_device_token(token)
+    if not valid:
+        return False, f"Token error: {msg}"
+    
+    valid, msg = validate_contact_phone(phone)
+    if not valid:
+        return False, f"Phone error: {msg}"
+    
+    if username:
+        valid, msg = validate_username(username)
+        if not valid:
+            return False, f"Username error: {msg}"
+    
+    return backend.insert_device_token(token, phone_key(phone), username, platform)
+
+def remove_device_tokens(tokens):
+    """Forget device tokens (unregistered apps, or a device signing out)"""
+    return backend.delete_device_tokens(tokens)
+
 def user_exists(username):
     """Check if user exists"""
     valid, msg = validate_username(username)
@@ -106,7 +278,7 @@ def user_exists(username):
         return False
     
     try:
-        return get_user(username) is not None
+        return lookup_user(username) is not None
     except Exception as e:
         print(f"Error checking user: {e}")
         return False
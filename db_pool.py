@@ -0,0 +1,439 @@
+"""
+DB Pool - Connection pool manager for MySQL
+Prewarms connections, validates idle ones in the background, shrinks back to its
+minimum when idle, and fails fast during an outage while a background thread
+reconnects, instead of opening a fresh connection on every request.
+SQLitePool is the much smaller counterpart for local SQLite files.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from metrics import LatencyStats
+from logger import info, error, warning
+
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5.0))
+DB_POOL_VALIDATE_AFTER = float(os.getenv('DB_POOL_VALIDATE_AFTER', 10.0))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', 300.0))
+DB_POOL_CHECK_INTERVAL = float(os.getenv('DB_POOL_CHECK_INTERVAL', 15.0))
+DB_POOL_RETRY_MAX = float(os.getenv('DB_POOL_RETRY_MAX', 30.0))
+# Connections per SQLite file per process (shared by all of its threads)
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', 4))
+
+
+class PoolUnavailableError(Exception):
+    """The database is unreachable; raised without attempting a connection while the pool is down"""
+
+
+class PoolExhaustedError(Exception):
+    """Every connection stayed checked out for the whole acquire timeout"""
+
+
+class PooledConnection:
+    """Checked-out connection; close() hands it back to the pool instead of closing the socket"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # Settings such as autocommit belong to the real connection
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
+
+    @property
+    def raw(self):
+        """The underlying driver connection"""
+        return self._conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn)
+
+    def discard(self):
+        """Close the underlying connection instead of reusing it (e.g. after a protocol error)"""
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn, broken=True)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of connections from connect() (e.g. a mysql.connector.connect partial).
+    Grows on demand up to max_size and keeps at least min_size open. Idle connections
+    are reused newest first, so surplus ones age out and are closed after idle_timeout.
+    Connections must support ping(), close(), rollback() and in_transaction.
+    With background=False nothing runs until maintain() is called.
+    """
+
+    def __init__(self, connect, min_size=2, max_size=10, timeout=DB_POOL_TIMEOUT,
+                 validate_after=DB_POOL_VALIDATE_AFTER, idle_timeout=DB_POOL_IDLE_TIMEOUT,
+                 check_interval=DB_POOL_CHECK_INTERVAL, retry_max=DB_POOL_RETRY_MAX, background=True):
+        self.connect = connect
+        self.background = background
+        self.max_size = max(1, max_size)
+        self.min_size = max(0, min(min_size, self.max_size))
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.retry_max = retry_max
+        self.wait_latency = LatencyStats()
+        # (connection, last time it was known to be alive), newest on the right
+        self._idle = deque()
+        self._total = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+        self._stopped = False
+        self.down = False
+        self.last_error = None
+        self.peak_in_use = 0
+        self.created = 0
+        self.closed = 0
+        self.validation_failures = 0
+        self.exhausted = 0
+        self.unavailable = 0
+        self.outages = 0
+
+    def start(self):
+        """Start the maintenance thread (prewarm, validation, reconnect) if it is not running in this process"""
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="db-pool", daemon=True)
+            self._thread.start()
+
+    def acquire(self, timeout=None):
+        """Check out a connection, waiting up to timeout seconds if every connection is busy"""
+        if self.background:
+            self.start()
+        start = time.monotonic()
+        deadline = start + (self.timeout if timeout is None else timeout)
+        while True:
+            conn, last_seen = self._checkout(deadline)
+            if conn is None:
+                conn = self._open_for_checkout()
+            elif time.monotonic() - last_seen > self.validate_after and not self._alive(conn):
+                # Stale and dead (server restart, dropped socket): replace it
+                with self._cond:
+                    self._in_use -= 1
+                self._drop(conn)
+                continue
+            self.wait_latency.record((time.monotonic() - start) * 1000)
+            return PooledConnection(self, conn)
+
+    def _checkout(self, deadline):
+        """Reserve an idle connection, or a slot to open one; (None, None) means open a new connection"""
+        with self._cond:
+            while True:
+                if self.down:
+                    self.unavailable += 1
+                    raise PoolUnavailableError(f"Database unavailable: {self.last_error}")
+                if self._idle:
+                    conn, last_seen = self._idle.pop()
+                    self._mark_in_use()
+                    return conn, last_seen
+                if self._total < self.max_size:
+                    self._total += 1
+                    self._mark_in_use()
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.exhausted += 1
+                    raise PoolExhaustedError(f"All {self.max_size} connections are in use")
+                self._waiting += 1
+                self._cond.wait(remaining)
+                self._waiting -= 1
+
+    def _mark_in_use(self):
+        self._in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self._in_use)
+
+    def _open_for_checkout(self):
+        try:
+            return self._open()
+        except Exception as e:
+            with self._cond:
+                self._total -= 1
+                self._in_use -= 1
+            self._mark_down(e)
+            raise PoolUnavailableError(f"Database unavailable: {e}") from e
+
+    def release(self, conn, broken=False):
+        """Return a checked-out connection (use PooledConnection.close instead of calling this)"""
+        if not broken:
+            try:
+                if getattr(conn, "unread_result", False):
+                    conn.consume_results()
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception as e:
+                warning("Discarding pooled connection that failed to reset: %s", e)
+                broken = True
+        with self._cond:
+            self._in_use -= 1
+            if not broken and not self._stopped and self._pid == os.getpid():
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        self._drop(conn)
+
+    def _open(self):
+        conn = self.connect()
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def _drop(self, conn):
+        """Close a connection that is no longer counted as idle"""
+        with self._cond:
+            self._total -= 1
+            self.closed += 1
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _alive(self, conn):
+        try:
+            conn.ping()
+            return True
+        except Exception:
+            with self._cond:
+                self.validation_failures += 1
+            return False
+
+    def _mark_down(self, e):
+        """Fail fast from now on and let the maintenance thread reconnect"""
+        with self._cond:
+            self.last_error = str(e)
+            if self.down:
+                return
+            self.down = True
+            self.outages += 1
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        error("Database pool down, failing fast until it reconnects: %s", e)
+        for conn in idle:
+            self._drop(conn)
+        self._wake.set()
+
+    def prewarm(self):
+        """Open connections until min_size exist; returns how many were opened"""
+        opened = 0
+        while True:
+            with self._cond:
+                if self.down or self._stopped or self._total >= self.min_size:
+                    return opened
+                self._total += 1
+            try:
+                conn = self._open()
+            except Exception as e:
+                with self._cond:
+                    self._total -= 1
+                self._mark_down(e)
+                return opened
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+            opened += 1
+
+    def _validate_idle(self):
+        """Ping idle connections not seen alive for validate_after seconds; drop the dead ones"""
+        now = time.monotonic()
+        with self._cond:
+            stale = [entry for entry in self._idle if now - entry[1] > self.validate_after]
+            for entry in stale:
+                self._idle.remove(entry)
+        for conn, _ in stale:
+            if self._alive(conn):
+                with self._cond:
+                    self._idle.appendleft((conn, time.monotonic()))
+                    self._cond.notify()
+            else:
+                self._drop(conn)
+        return len(stale)
+
+    def _shrink(self):
+        """Close the oldest idle connections above min_size that have been unused for idle_timeout"""
+        now = time.monotonic()
+        surplus = []
+        with self._cond:
+            while (self._idle and self._total - len(surplus) > self.min_size
+                   and now - self._idle[0][1] > self.idle_timeout):
+                surplus.append(self._idle.popleft()[0])
+        for conn in surplus:
+            self._drop(conn)
+        return len(surplus)
+
+    def _reconnect(self):
+        """One reconnect attempt while down; returns True once the database answers again"""
+        try:
+            conn = self._open()
+        except Exception as e:
+            with self._cond:
+                self.last_error = str(e)
+            return False
+        with self._cond:
+            self.down = False
+            self._total += 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify_all()
+        info("Database pool reconnected after outage (%s so far)", self.outages)
+        return True
+
+    def maintain(self):
+        """One maintenance pass; returns the number of seconds until the next one"""
+        if self.down:
+            if not self._reconnect():
+                return None
+        self._validate_idle()
+        self._shrink()
+        self.prewarm()
+        return self.check_interval
+
+    def _run(self):
+        retry_delay = 0.5
+        while not self._stopped:
+            try:
+                delay = self.maintain()
+            except Exception as e:
+                error("Database pool maintenance failed: %s", e)
+                delay = self.check_interval
+            if delay is None:
+                # Still down: back off between reconnect attempts
+                delay = retry_delay
+                retry_delay = min(self.retry_max, retry_delay * 2)
+            else:
+                retry_delay = 0.5
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def close(self):
+        """Stop maintenance and close idle connections (checked-out ones close on release)"""
+        with self._cond:
+            self._stopped = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        self._wake.set()
+        for conn in idle:
+            self._drop(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "state": "down" if self.down else "up",
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "open": self._total,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "peak_in_use": self.peak_in_use,
+                "created": self.created,
+                "closed": self.closed,
+                "validation_failures": self.validation_failures,
+                "exhausted": self.exhausted,
+                "unavailable": self.unavailable,
+                "outages": self.outages,
+                "last_error": self.last_error if self.down else None,
+                "wait": self.wait_latency.summary()
+            }
+
+
+class SQLitePool:
+    """
+    Bounded pool of SQLite connections shared by a process's threads. Connections from
+    connect() are opened on demand up to size and reused newest first, so a thread per
+    request doesn't mean a connection per request. After a fork the child starts an
+    empty pool rather than touch its parent's connections.
+    """
+
+    def __init__(self, connect, size=SQLITE_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.connect = connect
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+        self.exhausted = 0
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle
+            try:
+                return idle.get_nowait()
+            except queue.Empty:
+                pass
+            grow = self._opened < self.size
+            if grow:
+                self._opened += 1
+        if grow:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return idle.get(timeout=self.timeout)
+        except queue.Empty:
+            self.exhausted += 1
+            raise PoolExhaustedError(f"No SQLite connection free within {self.timeout:.1f}s (pool of {self.size})")
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection (autocommit) for the duration of the block"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._pid == os.getpid():
+                self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction on one connection held for the whole block; BEGIN IMMEDIATE takes the write lock up front"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def stats(self):
+        return {"size": self.size, "open": self._opened, "idle": self._idle.qsize(), "exhausted": self.exhausted}
@@ -34,6 +34,48 @@ export interface RiskAnalysis {
   message?: string;
 }
 
+// Risk heatmap tile; levels (0 low, 1 medium, 2 high) and scores (0-255) are row-major, north row first
+export interface RiskTile {
+  z: number;
+  x: number;
+  y: number;
+  bbox: [number, number, number, number];
+  size: number;
+  hour: number;
+  levels: Uint8Array;
+  scores: Uint8Array;
+}
+
+// Expand a run-length [value, count, ...] list from /risk/tile
+const decodeRuns = (runs: number[]) => {
+  let length = 0;
+  for (let i = 1; i < runs.length; i += 2) length += runs[i];
+  const values = new Uint8Array(length);
+  let offset = 0;
+  for (let i = 0; i < runs.length; i += 2) {
+    values.fill(runs[i], offset, offset + runs[i + 1]);
+    offset += runs[i + 1];
+  }
+  return values;
+};
+
+// XYZ tiles covering a bounding box at a zoom level
+export const tilesForBounds = (minLat: number, minLng: number, maxLat: number, maxLng: number, zoom: number) => {
+  const n = 2 ** zoom;
+  const tileX = (lng: number) => Math.min(n - 1, Math.floor(((lng + 180) / 360) * n));
+  const tileY = (lat: number) => {
+    const rad = (lat * Math.PI) / 180;
+    return Math.min(n - 1, Math.floor(((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2) * n));
+  };
+  const tiles: { z: number; x: number; y: number }[] = [];
+  for (let y = tileY(maxLat); y <= tileY(minLat); y++) {
+    for (let x = tileX(minLng); x <= tileX(maxLng); x++) {
+      tiles.push({ z: zoom, x, y });
+    }
+  }
+  return tiles;
+};
+
 export const apiService = {
   // Health check
   ping: async () => {
@@ -69,14 +111,23 @@ export const apiService = {
     return response.data as RiskAnalysis;
   },
 
+  // Read-only risk heatmap; the browser cache revalidates tiles with their ETag
+  getRiskTile: async (z: number, x: number, y: number, size: number = 32) => {
+    const response = await api.get(`/risk/tile/${z}/${x}/${y}?size=${size}`);
+    const data = response.data;
+    return { ...data, levels: decodeRuns(data.levels), scores: decodeRuns(data.scores) } as RiskTile;
+  },
+
   getLocations: async (username: string, limit: number = 50) => {
     const response = await api.get(`/locations/${username}?limit=${limit}`);
     return response.data;
   },
 
   // SOS endpoint
-  triggerSOS: async (username: string, latitude: number, longitude: number, accuracy: number) => {
-    const response = await api.post('/sos', { username, latitude, longitude, accuracy });
+  // Pass the same sosId when resending an alert so the server does not queue it twice
+  triggerSOS: async (username: string, latitude: number, longitude: number, accuracy: number,
+                     sosId: string = crypto.randomUUID()) => {
+    const response = await api.post('/sos', { username, latitude, longitude, accuracy, sos_id: sosId });
     return response.data;
   },
 };
@@ -0,0 +1,109 @@
+"""
+Geo Helpers - Coordinate parsing and distance calculations
+"""
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def parse_coordinates(text):
+    """Parse a "lat,lng" string into a (lat, lng) float tuple; None if it is not coordinates"""
+    if not text or "," not in str(text):
+        return None
+    parts = str(text).split(",")
+    if len(parts) != 2:
+        return None
+    try:
+        lat = float(parts[0].strip())
+        lng = float(parts[1].strip())
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance in kilometers between two points in degrees"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlng = math.radians(lng2 - lng1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def point_in_polygon(polygon, lat, lng):
+    """Ray casting test of a point against a list of (lat, lng) vertices"""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+        if (lng_i > lng) != (lng_j > lng):
+            cross_lat = lat_i + (lng - lng_i) * (lat_j - lat_i) / (lng_j - lng_i)
+            if lat < cross_lat:
+                inside = not inside
+        j = i
+    return inside
+
+
+def geohash_cell(lat, lng, precision=7):
+    """
+    (row, col) of the geohash cell containing a point: its latitude and longitude bits
+    as two integers, cheaper to compute and compare than the geohash string
+    """
+    lat_bits = precision * 5 // 2
+    lng_bits = precision * 5 - lat_bits
+    row = min(int((lat + 90.0) / 180.0 * (1 << lat_bits)), (1 << lat_bits) - 1)
+    col = min(int((lng + 180.0) / 360.0 * (1 << lng_bits)), (1 << lng_bits) - 1)
+    return row, col
+
+
+def geohash_cell_bbox(row, col, precision=7):
+    """(min_lat, min_lng, max_lat, max_lng) of a geohash cell"""
+    lat_bits = precision * 5 // 2
+    lat_size = 180.0 / (1 << lat_bits)
+    lng_size = 360.0 / (1 << (precision * 5 - lat_bits))
+    return row * lat_size - 90.0, col * lng_size - 180.0, (row + 1) * lat_size - 90.0, (col + 1) * lng_size - 180.0
+
+
+def geohash_encode(lat, lng, precision=7):
+    """Geohash string of a point; precision 7 is a cell of about 150 x 150 m"""
+    row, col = geohash_cell(lat, lng, precision)
+    lat_bits = precision * 5 // 2
+    lng_bits = precision * 5 - lat_bits
+    # Bits alternate between longitude and latitude, longitude first, 5 per character
+    value = 0
+    for i in range(precision * 5):
+        if i % 2 == 0:
+            value = value << 1 | (col >> (lng_bits - 1 - i // 2)) & 1
+        else:
+            value = value << 1 | (row >> (lat_bits - 1 - i // 2)) & 1
+    return "".join(GEOHASH_ALPHABET[(value >> shift) & 31] for shift in range(precision * 5 - 5, -1, -5))
+
+
+class PointSet:
+    """
+    Fixed set of points with radians and cosines precomputed,
+    for repeated one-to-many distance queries
+    """
+
+    def __init__(self, lats, lngs):
+        self.lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+        self.lng_rad = np.radians(np.asarray(lngs, dtype=np.float64))
+        self.cos_lat = np.cos(self.lat_rad)
+
+    def __len__(self):
+        return len(self.lat_rad)
+
+    def distances_km(self, lat, lng):
+        """Vectorized haversine distance from one point to every point in the set"""
+        lat_rad = math.radians(lat)
+        lng_rad = math.radians(lng)
+        a = np.sin((self.lat_rad - lat_rad) / 2) ** 2 + \
+            math.cos(lat_rad) * self.cos_lat * np.sin((self.lng_rad - lng_rad) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
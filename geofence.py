@@ -0,0 +1,358 @@
+"""
+Geofence - Per-user routine and saved-place fences evaluated on every location fix
+Fences are held in memory per user. Which fences matter is worked out once per grid
+cell: fences covering the whole cell count as inside without a test, fences missing
+it are skipped, and only those crossing it are tested exactly. Enter/exit events
+come from comparing the fences a fix is inside with those of the previous fix.
+The previous fix's fences and the fence versions bumped by invalidation live in a
+local SQLite file shared by every worker process, so events are emitted once and
+fence edits reach every worker whichever one handled the fix or the write. That
+costs one indexed read of the local file per fix (about 15 us in WAL mode, no
+network round trip) and a write only when the fences the fix is inside change.
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from db_pool import SQLitePool
+from geo import haversine_km, point_in_polygon
+from logger import info
+
+# Grid cell size in degrees (~550 m of latitude)
+GEOFENCE_CELL = float(os.getenv('GEOFENCE_CELL', 0.005))
+# Radius of the circle around a routine's location; 1 km matches the old routine check
+GEOFENCE_ROUTINE_RADIUS_M = float(os.getenv('GEOFENCE_ROUTINE_RADIUS_M', 1000))
+GEOFENCE_TTL = float(os.getenv('GEOFENCE_TTL', 300))
+GEOFENCE_MAX_USERS = int(os.getenv('GEOFENCE_MAX_USERS', 10000))
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+GEOFENCE_STATE_PATH = os.getenv('GEOFENCE_STATE_PATH', os.path.join(SPOOL_DIR, "geofence.db"))
+
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LNG = 111320.0
+# Cells are classified on a flat-earth approximation; the margin keeps it from contradicting haversine
+CLASSIFY_MARGIN = 0.02
+
+OUTSIDE, CROSSES, COVERS = 0, 1, 2
+
+# Version row bumped when a change may touch any user's fences
+ALL_USERS = "*"
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS geofence_members (
+        username TEXT PRIMARY KEY,
+        inside TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS geofence_versions (
+        username TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+'''
+
+
+class Fence:
+    """A circle (center and radius in meters) or a polygon of (lat, lng) vertices"""
+
+    __slots__ = ("id", "kind", "source_id", "name", "lat", "lng", "radius_m", "polygon", "bbox")
+
+    def __init__(self, kind, source_id, name, lat=None, lng=None, radius_m=None, polygon=None):
+        self.id = f"{kind}:{source_id}"
+        self.kind = kind
+        self.source_id = source_id
+        self.name = name
+        self.lat = lat
+        self.lng = lng
+        self.radius_m = radius_m
+        self.polygon = [(float(v[0]), float(v[1])) for v in polygon] if polygon else None
+        if self.polygon:
+            lats = [v[0] for v in self.polygon]
+            lngs = [v[1] for v in self.polygon]
+            self.bbox = (min(lats), min(lngs), max(lats), max(lngs))
+        else:
+            dlat = radius_m / METERS_PER_DEG_LAT
+            dlng = radius_m / (METERS_PER_DEG_LNG * max(math.cos(math.radians(lat)), 0.01))
+            self.bbox = (lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+
+    def contains(self, lat, lng):
+        min_lat, min_lng, max_lat, max_lng = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+            return False
+        if self.polygon:
+            return point_in_polygon(self.polygon, lat, lng)
+        return haversine_km(self.lat, self.lng, lat, lng) * 1000 <= self.radius_m
+
+    def classify(self, min_lat, min_lng, max_lat, max_lng):
+        """OUTSIDE, CROSSES or COVERS for a lat/lng cell"""
+        b = self.bbox
+        if b[0] > max_lat or b[2] < min_lat or b[1] > max_lng or b[3] < min_lng:
+            return OUTSIDE
+        if self.polygon:
+            return CROSSES
+        # Nearest and farthest points of the cell from the center, in local meters
+        kx = METERS_PER_DEG_LNG * math.cos(math.radians(self.lat))
+        near = math.hypot(max(min_lng - self.lng, 0.0, self.lng - max_lng) * kx,
+                          max(min_lat - self.lat, 0.0, self.lat - max_lat) * METERS_PER_DEG_LAT)
+        far = math.hypot(max(abs(min_lng - self.lng), abs(max_lng - self.lng)) * kx,
+                         max(abs(min_lat - self.lat), abs(max_lat - self.lat)) * METERS_PER_DEG_LAT)
+        if near > self.radius_m * (1 + CLASSIFY_MARGIN):
+            return OUTSIDE
+        if far < self.radius_m * (1 - CLASSIFY_MARGIN):
+            return COVERS
+        return CROSSES
+
+    def distance_m(self, lat, lng):
+        """Distance to a circle's center (None for polygons)"""
+        if self.polygon:
+            return None
+        return haversine_km(self.lat, self.lng, lat, lng) * 1000
+
+    def to_dict(self):
+        return {"id": self.id, "kind": self.kind, "name": self.name}
+
+
+def routine_fences(schedule, radius_m=GEOFENCE_ROUTINE_RADIUS_M):
+    """Circle fences around the located routines of a RoutineSchedule"""
+    fences = []
+    routines = {r["id"]: r for r in schedule.routines}
+    for routine_id, lat_rad, lng_rad in zip(schedule.located_ids, schedule.points.lat_rad.tolist(),
+                                            schedule.points.lng_rad.tolist()):
+        fences.append(Fence("routine", routine_id, routines[routine_id]["title"],
+                            math.degrees(lat_rad), math.degrees(lng_rad), radius_m))
+    return fences
+
+
+def place_fences(places):
+    """Fences for saved places (dicts from get_user_places)"""
+    fences = []
+    for place in places:
+        if place.get("polygon"):
+            fences.append(Fence("place", place["id"], place["name"], polygon=place["polygon"]))
+        elif place.get("latitude") is not None and place.get("radius"):
+            fences.append(Fence("place", place["id"], place["name"], float(place["latitude"]),
+                                float(place["longitude"]), float(place["radius"])))
+    return fences
+
+
+class FenceState:
+    """
+    Shared by the worker processes on a host: each user's fences at their last fix, and
+    fence versions that invalidation bumps (per user, and ALL_USERS for everyone)
+    """
+
+    def __init__(self, path=GEOFENCE_STATE_PATH):
+        self.path = path
+        self._pool = SQLitePool(self._connect)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def read(self, username):
+        """(fence ids at the last fix or None, fences version) in one query"""
+        with self._pool.connection() as conn:
+            inside, version, version_all = conn.execute(
+                'SELECT (SELECT inside FROM geofence_members WHERE username = ?), '
+                '(SELECT version FROM geofence_versions WHERE username = ?), '
+                '(SELECT version FROM geofence_versions WHERE username = ?)',
+                (username, username, ALL_USERS)).fetchone()
+        return (None if inside is None else set(json.loads(inside))), (version or 0, version_all or 0)
+
+    def swap(self, username, inside):
+        """Store this fix's fence ids; returns those of the previous fix (None if there was none)"""
+        with self._pool.transaction() as conn:
+            row = conn.execute('SELECT inside FROM geofence_members WHERE username = ?', (username,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO geofence_members (username, inside) VALUES (?, ?)',
+                         (username, json.dumps(sorted(inside))))
+        return None if row is None else set(json.loads(row[0]))
+
+    def bump(self, username=ALL_USERS):
+        with self._pool.connection() as conn:
+            conn.execute('INSERT INTO geofence_versions (username, version) VALUES (?, 1) '
+                         'ON CONFLICT (username) DO UPDATE SET version = version + 1', (username,))
+
+
+class UserFences:
+    """One user's fences, classified against the cell of their last fix"""
+
+    def __init__(self, schedule, places, fences, cell, version=None):
+        self.schedule = schedule
+        self.places = places
+        self.fences = fences
+        self.by_id = {fence.id: fence for fence in fences}
+        self.cell = cell
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.stale = False
+        self._cell_key = None
+        self._covers = []
+        self._crosses = []
+        self._lock = threading.Lock()
+
+    def evaluate(self, lat, lng):
+        """Returns (inside ids, exact tests, whether the cell changed)"""
+        key = (math.floor(lat / self.cell), math.floor(lng / self.cell))
+        with self._lock:
+            cell_changed = key != self._cell_key
+            if cell_changed:
+                bounds = (key[0] * self.cell, key[1] * self.cell, (key[0] + 1) * self.cell, (key[1] + 1) * self.cell)
+                self._covers, self._crosses = [], []
+                for fence in self.fences:
+                    kind = fence.classify(*bounds)
+                    if kind == COVERS:
+                        self._covers.append(fence.id)
+                    elif kind == CROSSES:
+                        self._crosses.append(fence)
+                self._cell_key = key
+            inside = set(self._covers)
+            inside.update(fence.id for fence in self._crosses if fence.contains(lat, lng))
+            return inside, len(self._crosses), cell_changed
+
+
+class GeofenceEngine:
+    """
+    In-memory fences for every active user.
+    load_schedule(username) returns the user's RoutineSchedule (the storage backend's
+    routine cache), load_places(username) their saved places. Both are only called on
+    a cache miss, so evaluating a fix normally costs one read of the shared state.
+    invalidate_schedule(username) (optional) drops this process's cached schedule when
+    another worker reports a change.
+    """
+
+    def __init__(self, load_schedule, load_places, invalidate_schedule=None, state=None, ttl=GEOFENCE_TTL,
+                 max_users=GEOFENCE_MAX_USERS, cell=GEOFENCE_CELL, routine_radius_m=GEOFENCE_ROUTINE_RADIUS_M):
+        self.load_schedule = load_schedule
+        self.load_places = load_places
+        self.invalidate_schedule = invalidate_schedule
+        self.state = state or FenceState()
+        self.ttl = ttl
+        self.max_users = max_users
+        self.cell = cell
+        self.routine_radius_m = routine_radius_m
+        self._users = {}
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with one is reloaded next time
+        self._generation = 0
+        self.fixes = 0
+        self.cell_changes = 0
+        self.exact_tests = 0
+        self.entered = 0
+        self.exited = 0
+        self.loads = 0
+
+    def cached(self, username, version):
+        """
+        (the user's fences if still fresh, else None; the generation to pass to build()).
+        The fences are only usable while the schedule they were built from is still the cached one.
+        """
+        with self._lock:
+            entry = self._users.get(username)
+            generation = self._generation
+        changed = entry is not None and entry.version != version
+        if changed and self.invalidate_schedule is not None:
+            # Another worker saw a routine or place change this process has not
+            self.invalidate_schedule(username)
+        fresh = entry is not None and not entry.stale and not changed and time.monotonic() - entry.loaded_at < self.ttl
+        return (entry if fresh else None), generation
+
+    def build(self, username, version, generation, schedule, places, reloaded=True):
+        """Fences from a loaded schedule and places; cached unless invalidated since cached() was called"""
+        if reloaded:
+            self.loads += 1
+        fences = routine_fences(schedule, self.routine_radius_m) + place_fences(places)
+        rebuilt = UserFences(schedule, places, fences, self.cell, version)
+        with self._lock:
+            rebuilt.stale = generation != self._generation
+            if len(self._users) >= self.max_users and username not in self._users:
+                # Evict the oldest entry (dicts keep insertion order)
+                self._users.pop(next(iter(self._users)))
+            self._users[username] = rebuilt
+        return rebuilt
+
+    def _user(self, username, version):
+        entry, generation = self.cached(username, version)
+        schedule = self.load_schedule(username)
+        if entry is not None and entry.schedule is schedule:
+            return entry
+        places = entry.places if entry is not None else self.load_places(username)
+        return self.build(username, version, generation, schedule, places, reloaded=entry is None)
+
+    def evaluate(self, username, lat, lng, when=None):
+        """
+        Evaluate one fix for a user.
+        Returns: dict with the fences the fix is inside, entered/exited events since the
+        previous fix, and the active routine's fence status (None without a located routine)
+        """
+        previous, version = self.state.read(username)
+        return self.check(username, self._user(username, version), previous, lat, lng, when)
+
+    def check(self, username, user, previous, lat, lng, when=None):
+        """evaluate() for fences already loaded (cached() / build()) and state already read"""
+        inside, tests, cell_changed = user.evaluate(lat, lng)
+        entered, exited = set(), set()
+        if previous != inside:
+            # The swap decides the events, so a change seen by two workers is reported once
+            previous = self.state.swap(username, inside)
+            if previous is not None:
+                # Fences deleted since the last fix are dropped, not reported as exits
+                previous &= set(user.by_id)
+                entered, exited = inside - previous, previous - inside
+        self.fixes += 1
+        self.exact_tests += tests
+        self.cell_changes += cell_changed
+        self.entered += len(entered)
+        self.exited += len(exited)
+        for fence_id in entered:
+            info("Geofence: %s entered %s (%s)", username, fence_id, user.by_id[fence_id].name)
+        for fence_id in exited:
+            info("Geofence: %s left %s (%s)", username, fence_id, user.by_id[fence_id].name)
+
+        routine = None
+        for active in user.schedule.active(when or datetime.now()):
+            fence = user.by_id.get(f"routine:{active['id']}")
+            if fence is None:
+                continue
+            distance = fence.distance_m(lat, lng)
+            routine = {
+                "routine_id": active["id"],
+                "title": active["title"],
+                "inside": fence.id in inside,
+                "distance_m": round(distance, 1)
+            }
+            break
+
+        return {
+            "inside": [user.by_id[fence_id].to_dict() for fence_id in sorted(inside)],
+            "entered": [user.by_id[fence_id].to_dict() for fence_id in sorted(entered)],
+            "exited": [user.by_id[fence_id].to_dict() for fence_id in sorted(exited)],
+            "routine": routine
+        }
+
+    def invalidate(self, username=ALL_USERS):
+        """Reload a user's fences (everyone's by default) on their next fix, in every worker; membership is kept"""
+        with self._lock:
+            self._generation += 1
+            for name, entry in self._users.items():
+                if username in (ALL_USERS, name):
+                    entry.stale = True
+        self.state.bump(username)
+
+    def stats(self):
+        return {
+            "users": len(self._users),
+            "fixes": self.fixes,
+            "cell_changes": self.cell_changes,
+            "exact_tests": self.exact_tests,
+            "entered": self.entered,
+            "exited": self.exited,
+            "loads": self.loads
+        }
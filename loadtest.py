@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+SAFEHER - Load test
+Drives concurrent requests at a running server and reports requests/second and
+p50/p95/p99 latency per endpoint. Run it once per SERVER_MODE to compare servers.
+Scenarios: mixed (default), pings, sos, history; bench_api.py reuses them against
+an in-process server.
+Usage: python loadtest.py --url http://localhost:5000 --concurrency 32 --duration 20 [--scenario pings] [--json out.json]
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+USERNAME = "loadtest_user"
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))]
+
+
+def _ping(username):
+    body = {"username": username, "lat": 12.9 + random.random() / 10,
+            "lng": 77.5 + random.random() / 10, "accuracy": 10}
+    return "POST /analyze", "POST", "/analyze", body
+
+
+def _ping_batch(username):
+    now = time.time()
+    fixes = [{"lat": 12.9 + random.random() / 10, "lng": 77.5 + random.random() / 10,
+              "accuracy": 10, "timestamp": now - i * 5} for i in range(20)]
+    return "POST /locations/batch", "POST", "/locations/batch", {"username": username, "locations": fixes}
+
+
+def _sos(username):
+    return "POST /sos", "POST", "/sos", {"username": username, "name": "Load Test"}
+
+
+def _history(username):
+    return "GET /locations", "GET", f"/locations/{username}?limit=50", None
+
+
+def _track(username):
+    return "GET /track", "GET", f"/locations/{username}/track?limit=500", None
+
+
+def _contacts(username):
+    return "GET /contacts", "GET", f"/contacts/{username}", None
+
+
+def mixed(username):
+    """Mostly pings, some SOS and history reads"""
+    roll = random.random()
+    if roll < 0.7:
+        return _ping(username)
+    if roll < 0.75:
+        return _sos(username)
+    if roll < 0.9:
+        return _history(username)
+    return _contacts(username)
+
+
+def pings(username):
+    """Location ping storm: single fixes with some 20-fix batches"""
+    return _ping(username) if random.random() < 0.9 else _ping_batch(username)
+
+
+def sos(username):
+    """SOS burst: every request is an alert"""
+    return _sos(username)
+
+
+def history(username):
+    """History reads: raw pages and downsampled tracks"""
+    return _history(username) if random.random() < 0.7 else _track(username)
+
+
+SCENARIOS = {"mixed": mixed, "pings": pings, "sos": sos, "history": history}
+
+
+def worker(url, deadline, results, lock, workload=mixed, users=(USERNAME,)):
+    """One client connection issuing requests back to back until the deadline"""
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+    local = {}
+    while time.perf_counter() < deadline:
+        label, method, path, body = workload(random.choice(users))
+        payload = json.dumps(body) if body is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+            status = "error"
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        entry = local.setdefault(label, {"latencies": [], "statuses": {}})
+        entry["latencies"].append(elapsed_ms)
+        entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+    conn.close()
+    with lock:
+        for label, entry in local.items():
+            merged = results.setdefault(label, {"latencies": [], "statuses": {}})
+            merged["latencies"].extend(entry["latencies"])
+            for status, count in entry["statuses"].items():
+                merged["statuses"][status] = merged["statuses"].get(status, 0) + count
+
+
+def summarize(results, duration):
+    """Per-endpoint throughput and latency percentiles"""
+    summary = {}
+    for label, entry in sorted(results.items()):
+        latencies = sorted(entry["latencies"])
+        summary[label] = {
+            "requests": len(latencies),
+            "rps": round(len(latencies) / duration, 1),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "statuses": entry["statuses"]
+        }
+    return summary
+
+
+def run(url, concurrency, duration, workload=mixed, users=(USERNAME,)):
+    """Run one workload; returns (per-endpoint summary, elapsed seconds)"""
+    results = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=worker, args=(url, deadline, results, lock, workload, users))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarize(results, elapsed), elapsed
+
+
+def report(title, summary, duration):
+    total = sum(s["requests"] for s in summary.values())
+    print(f"{title}  duration={duration:.1f}s  total={total / duration:,.1f} req/s")
+    print("=" * 86)
+    print(f"{'endpoint':<22} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for label, s in summary.items():
+        print(f"{label:<22} {s['requests']:>9} {s['rps']:>9} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9}  {s['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running SAFEHER server")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    summary, duration = run(args.url, args.concurrency, args.duration, SCENARIOS[args.scenario])
+    report(f"{args.url}  scenario={args.scenario}  concurrency={args.concurrency}", summary, duration)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"scenario": args.scenario, "concurrency": args.concurrency,
+                       "duration": round(duration, 2), "endpoints": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
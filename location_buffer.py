@@ -0,0 +1,143 @@
+"""
+Location Buffer - Write-behind queue that coalesces location inserts
+Rows are flushed as one multi-row commit when the batch size or flush interval is reached
+"""
+import atexit
+import os
+import threading
+import time
+from metrics import LatencyStats
+from logger import info, error
+
+LOCATION_BATCH_SIZE = int(os.getenv('LOCATION_BATCH_SIZE', 500))
+LOCATION_FLUSH_INTERVAL = float(os.getenv('LOCATION_FLUSH_INTERVAL', 1.0))
+LOCATION_QUEUE_MAX = int(os.getenv('LOCATION_QUEUE_MAX', 50000))
+
+
+class LocationBuffer:
+    """
+    Bounded in-process queue of location rows.
+    A background thread hands batches to flush_fn (e.g. database.insert_locations)
+    whenever batch_size rows are waiting or flush_interval seconds have passed.
+    """
+
+    def __init__(self, flush_fn, batch_size=LOCATION_BATCH_SIZE,
+                 flush_interval=LOCATION_FLUSH_INTERVAL, max_queue=LOCATION_QUEUE_MAX):
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.flush_latency = LatencyStats()
+        self._rows = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+        self.rows_flushed = 0
+        self.rows_dropped = 0
+        self.flush_failures = 0
+
+    def _ensure_started(self):
+        """Start the flusher thread lazily (and again in a forked child)"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="location-flusher", daemon=True)
+        self._thread.start()
+
+    def add(self, row):
+        """Queue one row; returns False if the buffer is full"""
+        return self.add_many([row]) == 1
+
+    def add_many(self, rows):
+        """Queue rows; returns how many were accepted before the buffer filled up"""
+        with self._cond:
+            self._ensure_started()
+            accepted = max(0, min(len(rows), self.max_queue - len(self._rows)))
+            self._rows.extend(rows[:accepted])
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        return accepted
+
+    def depth(self):
+        """Number of rows waiting to be written"""
+        with self._cond:
+            return len(self._rows)
+
+    def flush(self):
+        """Write everything currently queued, in batches of batch_size; returns False on a failed write"""
+        with self._flush_lock:
+            with self._cond:
+                rows, self._rows = self._rows, []
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                try:
+                    with self.flush_latency.time():
+                        self.flush_fn(batch)
+                    self.rows_flushed += len(batch)
+                except Exception as e:
+                    self.flush_failures += 1
+                    error("Location flush failed (%s rows): %s", len(batch), e)
+                    self._requeue(rows[start:])
+                    return False
+        return True
+
+    def _requeue(self, rows):
+        """Put unwritten rows back at the front of the queue, dropping the oldest on overflow"""
+        with self._cond:
+            merged = rows + self._rows
+            overflow = len(merged) - self.max_queue
+            if overflow > 0:
+                self.rows_dropped += overflow
+                error("Location buffer overflow, dropped %s oldest rows", overflow)
+                merged = merged[overflow:]
+            self._rows = merged
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Checked first: a stop() before the thread got here has already notified
+                if len(self._rows) < self.batch_size and not self._stopped:
+                    self._cond.wait(self.flush_interval)
+                if self._stopped:
+                    return
+                pending = len(self._rows)
+            if pending and not self.flush():
+                # Back off after a failed write instead of hammering the database
+                time.sleep(self.flush_interval)
+
+    def stop(self):
+        """Stop the flusher thread and write anything still queued"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        if self.depth():
+            error("Location buffer shut down with %s unwritten rows", self.depth())
+        else:
+            info("Location buffer flushed on shutdown")
+
+    def stats(self):
+        """Queue depth, throughput counters and flush latency"""
+        return {
+            "queue_depth": self.depth(),
+            "batch_size": self.batch_size,
+            "flush_interval_s": self.flush_interval,
+            "rows_flushed": self.rows_flushed,
+            "rows_dropped": self.rows_dropped,
+            "flush_failures": self.flush_failures,
+            "flush_latency": self.flush_latency.summary()
+        }
+
+
+def create_location_buffer(flush_fn):
+    """Create a buffer that is guaranteed to flush when the interpreter exits"""
+    buffer = LocationBuffer(flush_fn)
+    atexit.register(buffer.stop)
+    return buffer
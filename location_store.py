@@ -0,0 +1,383 @@
+"""
+Location Store - Month-rotated location history with rollup and retention
+New fixes land in the hot `location` table. A maintenance job moves each finished
+month into its own `location_YYYYMM` table (ids preserved), downsamples it into
+`location_rollup`, and drops monthly tables once they pass the retention window.
+MySQL partitioning is not an option because `location` has a foreign key.
+History reads query the hot table and the monthly tables in one UNION statement.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from database import dedicated_connection, execute
+from logger import info, error
+
+LOCATION_RETENTION_MONTHS = int(os.getenv('LOCATION_RETENTION_MONTHS', 6))
+LOCATION_ROLLUP_MINUTES = int(os.getenv('LOCATION_ROLLUP_MINUTES', 15))
+LOCATION_ROLLUP_RETENTION_MONTHS = int(os.getenv('LOCATION_ROLLUP_RETENTION_MONTHS', 24))
+LOCATION_MAINTENANCE_INTERVAL = float(os.getenv('LOCATION_MAINTENANCE_INTERVAL', 3600))
+LOCATION_ARCHIVE_CHUNK = int(os.getenv('LOCATION_ARCHIVE_CHUNK', 10000))
+# How long a worker may keep using its list of monthly tables before re-reading it
+LOCATION_TABLE_CACHE_TTL = float(os.getenv('LOCATION_TABLE_CACHE_TTL', 60))
+
+HOT_TABLE = 'location'
+ROLLUP_TABLE = 'location_rollup'
+COLUMNS = 'id, username, latitude, longitude, accuracy, timestamp'
+MAINTENANCE_LOCK = 'safeher_location_maintenance'
+
+SQL_LIST_LOCATION_TABLES = "SHOW TABLES LIKE 'location\\_%'"
+SQL_GET_TRACK = ('SELECT bucket, latitude, longitude, accuracy, fixes FROM location_rollup '
+                 'WHERE username = %s AND bucket < %s ORDER BY bucket DESC LIMIT %s')
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def archive_table(month):
+    return f"location_{month.year:04d}{month.month:02d}"
+
+
+def table_month(name):
+    """Month of a location_YYYYMM table name, or None for any other table"""
+    suffix = name[len('location_'):]
+    if not name.startswith('location_') or len(suffix) != 6 or not suffix.isdigit():
+        return None
+    year, month = int(suffix[:4]), int(suffix[4:])
+    return datetime(year, month, 1) if 1 <= month <= 12 else None
+
+
+class ArchiveTables:
+    """Per-process list of existing monthly tables, newest first, re-read every ttl seconds"""
+
+    def __init__(self, ttl=LOCATION_TABLE_CACHE_TTL):
+        self.ttl = ttl
+        self._months = []
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        # Generated SQL per (months, has_cursor), reused so prepared statements can be too
+        self._queries = {}
+
+    def months(self):
+        if self.expired():
+            self.refresh()
+        return self._months
+
+    def expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def refresh(self):
+        return self.update(execute('list_location_tables', SQL_LIST_LOCATION_TABLES, fetch="all"))
+
+    def update(self, rows):
+        """Replace the list from SQL_LIST_LOCATION_TABLES rows"""
+        months = sorted((m for m in (table_month(r[0]) for r in rows) if m), reverse=True)
+        with self._lock:
+            if months != self._months:
+                self._queries.clear()
+            self._months = months
+            self._loaded_at = time.monotonic()
+        return months
+
+    def history_query(self, months, has_cursor):
+        """One statement over the hot table and the given monthly tables, newest first"""
+        key = (tuple(months), has_cursor)
+        sql = self._queries.get(key)
+        if sql is None:
+            where = ' AND (timestamp < %s OR (timestamp = %s AND id < %s))' if has_cursor else ''
+            order = ' ORDER BY timestamp DESC, id DESC LIMIT %s'
+            parts = [
+                f'(SELECT id, latitude, longitude, accuracy, timestamp FROM `{table}` WHERE username = %s{where}{order})'
+                for table in [HOT_TABLE] + [archive_table(m) for m in months]
+            ]
+            # UNION (not UNION ALL): a month being moved briefly exists in both tables
+            sql = parts[0] if len(parts) == 1 else ' UNION '.join(parts) + order
+            with self._lock:
+                sql = self._queries.setdefault(key, sql)
+        return sql
+
+
+archive_tables = ArchiveTables()
+
+
+def history_statement(months, username, limit, before):
+    """(sql, params) for one keyset page over the hot table and the given monthly tables"""
+    if before is not None:
+        # Monthly tables only hold their own month, so newer ones cannot match the cursor
+        cutoff = month_start(before[0])
+        months = [m for m in months if m <= cutoff]
+    sql = archive_tables.history_query(months, before is not None)
+    per_table = (username,) if before is None else (username, before[0], before[0], before[1])
+    params = (per_table + (limit,)) * (len(months) + 1)
+    if months:
+        params += (limit,)
+    return sql, params
+
+
+def _history_page(username, limit, before):
+    """Raw (id, lat, lng, accuracy, timestamp) rows for one keyset page"""
+    sql, params = history_statement(archive_tables.months(), username, limit, before)
+    return execute('get_user_locations', sql, params, fetch="all")
+
+
+def _location_row(r):
+    return {"id": r[0], "latitude": r[1], "longitude": r[2], "accuracy": r[3], "timestamp": str(r[4])}
+
+
+def get_user_locations(username, limit=50, before=None):
+    """
+    Get one page of location history for a user, newest first, across the hot and monthly tables.
+    before is an optional (timestamp, id) keyset cursor from the previous page.
+    """
+    try:
+        return [_location_row(r) for r in _history_page(username, limit, before)]
+    except Exception as e:
+        error("Error getting locations: %s", e)
+        raise
+
+
+def iter_user_locations(username, before=None, batch_size=500):
+    """
+    Stream a user's full location history, newest first, in constant memory.
+    Walks keyset pages, so no connection is held between batches.
+    """
+    try:
+        while True:
+            rows = _history_page(username, batch_size, before)
+            for r in rows:
+                yield _location_row(r)
+            if len(rows) < batch_size:
+                return
+            before = (rows[-1][4], rows[-1][0])
+    except Exception as e:
+        error("Error streaming locations: %s", e)
+        raise
+
+
+def _track_row(r):
+    return {"timestamp": str(r[0]), "latitude": r[1], "longitude": r[2], "accuracy": r[3], "fixes": r[4]}
+
+
+def get_user_track(username, limit=500, before=None):
+    """Downsampled track points (one per LOCATION_ROLLUP_MINUTES bucket), newest first, before a bucket time"""
+    try:
+        rows = execute('get_user_track', SQL_GET_TRACK, (username, before or datetime(9999, 12, 31), limit), fetch="all")
+        return [_track_row(r) for r in rows]
+    except Exception as e:
+        error("Error getting track: %s", e)
+        raise
+
+
+def get_hot_locations(since, limit=1000):
+    """Busiest ~100 m squares in the hot table since a time: (lat, lng, fixes) rows, busiest first"""
+    try:
+        return execute(
+            'get_hot_locations',
+            'SELECT ROUND(latitude, 3) AS lat, ROUND(longitude, 3) AS lng, COUNT(*) AS fixes FROM location '
+            'WHERE timestamp >= %s GROUP BY lat, lng ORDER BY fixes DESC LIMIT %s',
+            (since, limit),
+            fetch="all"
+        )
+    except Exception as e:
+        error("Error getting hot locations: %s", e)
+        raise
+
+
+def _copy_month(month, delete):
+    """
+    Copy one month of the hot table into its monthly table in id-range chunks,
+    then (if delete) remove the copied rows from the hot table.
+    Returns: (rows_copied, rows_deleted)
+    """
+    table = archive_table(month)
+    bounds = (month, add_months(month, 1))
+    low, high = execute(
+        'location_month_ids',
+        f'SELECT MIN(id), MAX(id) FROM `{HOT_TABLE}` WHERE timestamp >= %s AND timestamp < %s',
+        bounds, fetch="one"
+    )
+    copied = deleted = 0
+    if low is None:
+        return copied, deleted
+    execute('create_location_table', f'CREATE TABLE IF NOT EXISTS `{table}` LIKE `{HOT_TABLE}`')
+    for start in range(low, high + 1, LOCATION_ARCHIVE_CHUNK):
+        chunk = (start, start + LOCATION_ARCHIVE_CHUNK - 1) + bounds
+        copied += execute(
+            'archive_locations',
+            f'INSERT IGNORE INTO `{table}` ({COLUMNS}) SELECT {COLUMNS} FROM `{HOT_TABLE}` '
+            'WHERE id BETWEEN %s AND %s AND timestamp >= %s AND timestamp < %s',
+            chunk
+        )
+        if delete:
+            # Only rows that are present in the monthly table are removed
+            deleted += execute(
+                'purge_hot_locations',
+                f'DELETE h FROM `{HOT_TABLE}` h JOIN `{table}` a ON a.id = h.id '
+                'WHERE h.id BETWEEN %s AND %s AND h.timestamp >= %s AND h.timestamp < %s',
+                chunk
+            )
+    return copied, deleted
+
+
+def _rollup_month(month):
+    """(Re)compute the downsampled track for one monthly table; returns the affected row count"""
+    bucket_seconds = LOCATION_ROLLUP_MINUTES * 60
+    return execute(
+        'rollup_locations',
+        f'INSERT INTO {ROLLUP_TABLE} (username, bucket, latitude, longitude, accuracy, fixes) '
+        f'SELECT username, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(timestamp) / {bucket_seconds}) * {bucket_seconds}) AS b, '
+        f'AVG(latitude), AVG(longitude), MIN(accuracy), COUNT(*) FROM `{archive_table(month)}` '
+        'GROUP BY username, b '
+        'ON DUPLICATE KEY UPDATE latitude = VALUES(latitude), longitude = VALUES(longitude), '
+        'accuracy = VALUES(accuracy), fixes = VALUES(fixes)'
+    )
+
+
+def rotate(now=None):
+    """
+    Move every finished month out of the hot table.
+    Rows are copied (and rolled up) on the pass that creates a monthly table but only
+    deleted from the hot table on a later pass, once every worker has had
+    LOCATION_TABLE_CACHE_TTL seconds to start reading the new table.
+    Returns: {month: {"copied", "deleted"}}
+    """
+    current = month_start(now or datetime.now())
+    existing = set(archive_tables.refresh())
+    oldest = execute('location_oldest', f'SELECT MIN(timestamp) FROM `{HOT_TABLE}`', fetch="one")[0]
+    result = {}
+    month = month_start(oldest) if oldest else current
+    while month < current:
+        copied, deleted = _copy_month(month, delete=month in existing)
+        if copied:
+            _rollup_month(month)
+        if copied or deleted:
+            result[archive_table(month)] = {"copied": copied, "deleted": deleted}
+            info("Location rotation %s: %s copied, %s removed from hot table", archive_table(month), copied, deleted)
+        month = add_months(month, 1)
+    archive_tables.refresh()
+    return result
+
+
+def expire(now=None):
+    """
+    Drop monthly tables older than LOCATION_RETENTION_MONTHS (their rollup stays)
+    and rollup rows older than LOCATION_ROLLUP_RETENTION_MONTHS.
+    Returns: {"dropped": [table, ...], "rollup_deleted": count}
+    """
+    current = month_start(now or datetime.now())
+    raw_cutoff = add_months(current, -LOCATION_RETENTION_MONTHS)
+    dropped = []
+    for month in archive_tables.refresh():
+        if month < raw_cutoff:
+            # Still in the hot table too? Then it is deleted there first, on the next rotation
+            remaining = execute(
+                'location_month_remaining',
+                f'SELECT COUNT(*) FROM `{HOT_TABLE}` WHERE timestamp >= %s AND timestamp < %s',
+                (month, add_months(month, 1)), fetch="one"
+            )[0]
+            if remaining:
+                continue
+            execute('drop_location_table', f'DROP TABLE IF EXISTS `{archive_table(month)}`')
+            dropped.append(archive_table(month))
+            info("Dropped expired location table %s", archive_table(month))
+
+    rollup_cutoff = add_months(current, -LOCATION_ROLLUP_RETENTION_MONTHS)
+    rollup_deleted = 0
+    while True:
+        count = execute(
+            'expire_rollup',
+            f'DELETE FROM {ROLLUP_TABLE} WHERE bucket < %s LIMIT {LOCATION_ARCHIVE_CHUNK}',
+            (rollup_cutoff,)
+        )
+        rollup_deleted += count
+        if count < LOCATION_ARCHIVE_CHUNK:
+            break
+    if dropped:
+        archive_tables.refresh()
+    return {"dropped": dropped, "rollup_deleted": rollup_deleted}
+
+
+def run_maintenance(now=None):
+    """
+    One rotation + retention pass. A MySQL named lock keeps it to one worker at a time.
+    The lock is held on a connection of its own rather than a pooled one, which would be
+    unavailable to request threads for the whole pass (rotate and expire use the pool).
+    Returns the pass summary, or None if another worker holds the lock.
+    """
+    with dedicated_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT GET_LOCK(%s, 0)', (MAINTENANCE_LOCK,))
+        if cursor.fetchone()[0] != 1:
+            cursor.close()
+            return None
+        try:
+            return {"rotated": rotate(now), "expired": expire(now)}
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (MAINTENANCE_LOCK,))
+            cursor.fetchall()
+            cursor.close()
+
+
+class LocationMaintenance:
+    """Background thread running run_maintenance every interval seconds"""
+
+    def __init__(self, interval=LOCATION_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._thread = None
+        self._pid = None
+        self._wake = threading.Event()
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_duration_ms = None
+        self.last_result = None
+
+    def start(self):
+        """Start the thread lazily (and again in a forked child); interval <= 0 disables it"""
+        if self.interval <= 0 or (self._thread is not None and self._pid == os.getpid()):
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="location-maintenance", daemon=True)
+        self._thread.start()
+
+    def run_once(self, now=None):
+        start = time.perf_counter()
+        try:
+            result = run_maintenance(now)
+            self.runs += 1
+            if result is not None:
+                self.last_result = result
+            return result
+        except Exception as e:
+            self.failures += 1
+            error("Location maintenance failed: %s", e)
+            return None
+        finally:
+            self.last_run = datetime.now().isoformat()
+            self.last_duration_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    def _run(self):
+        while not self._wake.wait(self.interval):
+            self.run_once()
+
+    def stats(self):
+        return {
+            "interval_s": self.interval,
+            "retention_months": LOCATION_RETENTION_MONTHS,
+            "rollup_minutes": LOCATION_ROLLUP_MINUTES,
+            "archive_months": [archive_table(m) for m in archive_tables._months],
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run": self.last_run,
+            "last_duration_ms": self.last_duration_ms,
+            "last_result": self.last_result
+        }
+
+
+location_maintenance = LocationMaintenance()
@@ -1,17 +1,46 @@
 """
 Logger Configuration - Centralized logging for the application
+Request threads only put records on a bounded queue; a listener thread formats them
+and writes the files, so disk I/O never blocks a request. Messages take %-style
+arguments (info("Saved %s", name)) that are only formatted if the record is kept.
+A single process rotates its own files at midnight; pre-fork workers share the files,
+so they only reopen them and the launcher alone renames them (rotate_files).
 """
+import atexit
+import glob
+import json
 import logging
 import os
-from datetime import datetime
+import queue
+import sys
+import threading
+from datetime import date, timedelta
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler, WatchedFileHandler
 
 # Create logs directory if it doesn't exist
-LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+LOG_DIR = os.getenv('LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs"))
 os.makedirs(LOG_DIR, exist_ok=True)
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+# LOG_ASYNC=0 writes from the calling thread (useful when debugging the logger itself)
+LOG_ASYNC = os.getenv('LOG_ASYNC', '1') != '0'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 14))
+# "internal": this process rotates at midnight. "watched": files are reopened when renamed by
+# someone else (the pre-fork launcher, or logrotate), so processes sharing a file never rotate it
+LOG_ROTATION = os.getenv('LOG_ROTATION', 'internal')
+# Files renamed to <name>.YYYY-MM-DD each day
+ROTATED_LOGS = ("safeher.log", "access.log")
+# Keep 1 in N DEBUG records per call site (1 keeps everything)
+LOG_DEBUG_SAMPLE = max(1, int(os.getenv('LOG_DEBUG_SAMPLE', 1)))
+# One JSON line per request in access.log (ACCESS_LOG=0 turns it off)
+ACCESS_LOG = os.getenv('ACCESS_LOG', '1') != '0'
+
 # Create logger
 logger = logging.getLogger("SAFEHER")
-logger.setLevel(logging.DEBUG)
+logger.propagate = False
+access_logger = logging.getLogger("SAFEHER.access")
+access_logger.propagate = False
 
 # Log format
 formatter = logging.Formatter(
@@ -19,50 +48,242 @@ formatter = logging.Formatter(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-# File handler (all logs)
-file_handler = logging.FileHandler(
-    os.path.join(LOG_DIR, f"safeher_{datetime.now().strftime('%Y%m%d')}.log")
-)
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
-# Error file handler (errors only)
-error_handler = logging.FileHandler(
-    os.path.join(LOG_DIR, "safeher_errors.log")
-)
-error_handler.setLevel(logging.ERROR)
-error_handler.setFormatter(formatter)
-logger.addHandler(error_handler)
-
-# Console handler (development)
-if os.getenv('FLASK_ENV') == 'development':
-    try:
-        import sys
-        import io
-        # Fix Windows encoding issues
-        if sys.platform == 'win32':
-            sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-    except:
-        pass
-    
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
-
-# Convenience functions
-def info(msg):
-    logger.info(msg)
-
-def debug(msg):
-    logger.debug(msg)
-
-def warning(msg):
-    logger.warning(msg)
-
-def error(msg):
-    logger.error(msg)
-
-def critical(msg):
-    logger.critical(msg)
+class JsonFormatter(logging.Formatter):
+    """Access log line: the record's field dict as one JSON object"""
+
+    def format(self, record):
+        fields = record.args if isinstance(record.args, dict) else {"message": record.getMessage()}
+        return json.dumps({"ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"), **fields}, separators=(",", ":"))
+
+
+# Argument types that can't change between the call and the listener formatting the record
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+
+class DebugSampler(logging.Filter):
+    """Keep the first and then every Nth DEBUG record from each call site"""
+
+    def __init__(self, every=LOG_DEBUG_SAMPLE):
+        super().__init__()
+        self.every = every
+        self.sampled_out = 0
+        self._counts = {}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.every <= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % self.every == 0:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Non-blocking handler: enqueues records for a QueueListener that owns the real handlers.
+    A full queue drops the record (and counts it) instead of blocking the request.
+    The listener is started lazily, and again with a fresh queue in a forked worker.
+    """
+
+    def __init__(self, handlers, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked: the parent's listener thread did not survive, and its queue lock may be held
+                self.queue = queue.Queue(self.maxsize)
+            self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Leave formatting to the listener; only resolve the message now if its arguments could change
+        if record.args and not all(isinstance(arg, _IMMUTABLE) for arg in _args(record)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks hold frames that keep request objects alive; render them now
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until every queued record has been written"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                self._listener.stop()
+                self._pid = None
+                self._listener = None
+
+    def close(self):
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+        super().close()
+
+
+def _args(record):
+    return record.args.values() if isinstance(record.args, dict) else record.args
+
+
+def _rotated_file_handler(filename, rotation):
+    """Handler for one of ROTATED_LOGS, rotated at midnight to <filename>.YYYY-MM-DD"""
+    path = os.path.join(LOG_DIR, filename)
+    if rotation == "watched":
+        return WatchedFileHandler(path, encoding="utf-8", delay=True)
+    return TimedRotatingFileHandler(path, when="midnight", backupCount=LOG_RETENTION_DAYS, encoding="utf-8", delay=True)
+
+
+def rotate_files(day=None, log_dir=LOG_DIR, names=ROTATED_LOGS, retention=LOG_RETENTION_DAYS):
+    """
+    Rename each log to <name>.<day> (default yesterday) and keep the newest retention copies (0 keeps all).
+    For "watched" handlers: call from one process only; writers reopen on their next record.
+    """
+    day = (day or date.today() - timedelta(days=1)).isoformat()
+    for name in names:
+        path = os.path.join(log_dir, name)
+        if not os.path.exists(path):
+            continue
+        # Only ever renamed, never copied: a record still being written lands in the renamed file
+        dated, n = f"{path}.{day}", 0
+        while os.path.exists(dated):
+            n += 1
+            dated = f"{path}.{day}.{n}"
+        os.rename(path, dated)
+        if retention:
+            for old in sorted(glob.glob(f"{glob.escape(path)}.????-??-??*"))[:-retention]:
+                os.remove(old)
+
+
+def _file_handlers(rotation):
+    # All logs: safeher.log
+    file_handler = _rotated_file_handler("safeher.log", rotation)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+
+    # Error file handler (errors only)
+    error_handler = logging.FileHandler(os.path.join(LOG_DIR, "safeher_errors.log"), encoding="utf-8", delay=True)
+    error_handler.setLevel(logging.ERROR)
+    error_handler.setFormatter(formatter)
+    handlers = [file_handler, error_handler]
+
+    # Console handler (development)
+    if os.getenv('FLASK_ENV') == 'development':
+        try:
+            import io
+            # Fix Windows encoding issues
+            if sys.platform == 'win32':
+                sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+        except Exception:
+            pass
+
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+    return handlers
+
+
+def _access_handlers(rotation):
+    handler = _rotated_file_handler("access.log", rotation)
+    handler.setFormatter(JsonFormatter())
+    return [handler]
+
+
+def _attach(target, handlers, use_async):
+    for handler in list(target.handlers):
+        target.removeHandler(handler)
+        handler.close()
+    if use_async:
+        queued = AsyncLogHandler(handlers)
+        target.addHandler(queued)
+        return queued
+    for handler in handlers:
+        target.addHandler(handler)
+    return None
+
+
+sampler = DebugSampler()
+logger.addFilter(sampler)
+async_handler = None
+access_handler = None
+
+
+def configure(level=LOG_LEVEL, use_async=LOG_ASYNC, access_log=ACCESS_LOG, rotation=LOG_ROTATION):
+    """(Re)build the handler chains; called on import, by the pre-fork launcher and by benchmarks"""
+    global async_handler, access_handler
+    logger.setLevel(level)
+    async_handler = _attach(logger, _file_handlers(rotation), use_async)
+    access_logger.setLevel(logging.INFO if access_log else logging.CRITICAL + 1)
+    access_handler = _attach(access_logger, _access_handlers(rotation) if access_log else [], use_async and access_log)
+
+
+def flush():
+    """Block until queued records are on disk"""
+    for handler in (async_handler, access_handler):
+        if handler is not None:
+            handler.flush()
+
+
+def _queue_stats(handler):
+    return {
+        "async": handler is not None,
+        "queued": handler.queue.qsize() if handler is not None else 0,
+        "dropped": handler.dropped if handler is not None else 0
+    }
+
+
+def stats():
+    return {
+        "level": logging.getLevelName(logger.level),
+        **_queue_stats(async_handler),
+        "debug_sample": sampler.every,
+        "sampled_out": sampler.sampled_out,
+        "access_log": {"enabled": access_logger.isEnabledFor(logging.INFO), **_queue_stats(access_handler)}
+    }
+
+
+configure()
+atexit.register(flush)
+
+# Convenience functions; stacklevel=2 reports the caller's file and line, not this module's
+def info(msg, *args):
+    logger.info(msg, *args, stacklevel=2)
+
+def debug(msg, *args):
+    logger.debug(msg, *args, stacklevel=2)
+
+def warning(msg, *args):
+    logger.warning(msg, *args, stacklevel=2)
+
+def error(msg, *args):
+    logger.error(msg, *args, stacklevel=2)
+
+def critical(msg, *args):
+    logger.critical(msg, *args, stacklevel=2)
+
+def access(fields):
+    """Write one access log entry; fields must be a flat dict of str/number/None values"""
+    access_logger.info("", fields)
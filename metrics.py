@@ -0,0 +1,355 @@
+"""
+Metrics - Lightweight in-process latency tracking
+Rolling percentile windows for /stats, and per-route histograms and sub-span
+timings exported in Prometheus text format on /metrics. Each worker process
+publishes its histograms to a SQLite file shared with the other workers, so
+/metrics reports the sum over all of them whichever worker answers the scrape.
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+def _pick(samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    return samples[min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))]
+
+
+class LatencyStats:
+    """Rolling window of latency samples (milliseconds) with percentile summary"""
+
+    def __init__(self, max_samples=2048):
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, ms):
+        """Record one latency sample in milliseconds"""
+        with self._lock:
+            self._samples.append(ms)
+            self.count += 1
+            self.total_ms += ms
+
+    @contextmanager
+    def time(self):
+        """Context manager that records the elapsed time of its block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record((time.perf_counter() - start) * 1000.0)
+
+    def percentile(self, pct):
+        """Return the given percentile (0-100) of the current window, or None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return _pick(samples, pct)
+
+    def summary(self):
+        """Return count, mean and p50/p99/max over the current window"""
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+            total = self.total_ms
+        if not samples:
+            return {"count": count, "mean_ms": None, "p50_ms": None, "p99_ms": None, "max_ms": None}
+        return {
+            "count": count,
+            "mean_ms": round(total / count, 3),
+            "p50_ms": round(_pick(samples, 50), 3),
+            "p99_ms": round(_pick(samples, 99), 3),
+            "max_ms": round(samples[-1], 3)
+        }
+
+
+# Histogram bucket upper bounds in seconds (Prometheus "le" labels)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+METRICS_PATH = os.getenv('METRICS_PATH', os.path.join(SPOOL_DIR, "metrics.db"))
+# Seconds between publications of a worker's histograms to METRICS_PATH
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', 5.0))
+# Snapshots of other servers sharing the spool (older runs) are deleted after this many seconds
+METRICS_RETENTION = float(os.getenv('METRICS_RETENTION', 86400))
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds; unlike LatencyStats it never forgets samples"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], ending with +Inf; plus sum and count"""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self.sum, self.count
+        running, rows = 0, []
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            running += n
+            rows.append((bound, running))
+        return rows, total, count
+
+    def snapshot(self):
+        """(per-bucket counts, sum) for merge()"""
+        with self._lock:
+            return list(self._counts), self.sum
+
+    def merge(self, counts, total):
+        """Add another histogram's snapshot() (same buckets) to this one"""
+        with self._lock:
+            for i, n in enumerate(counts):
+                self._counts[i] += n
+            self.count += sum(counts)
+            self.sum += total
+
+
+class Spans:
+    """Time spent in named sub-spans (db, fcm) during one request"""
+
+    def __init__(self, route):
+        self.route = route
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+
+# Per thread, and per task for requests handled on an event loop (asgi.py)
+_current = ContextVar("spans", default=None)
+
+
+def current_spans():
+    """Spans of the request being handled on this thread (or task), or None"""
+    return _current.get()
+
+
+def set_spans(spans):
+    """Make spans the current request's on this thread (None to clear); returns the previous ones"""
+    previous = current_spans()
+    _current.set(spans)
+    return previous
+
+
+@contextmanager
+def bind_spans(spans):
+    """Attribute spans recorded on this thread to spans (e.g. in a worker doing part of a request)"""
+    previous = set_spans(spans)
+    try:
+        yield spans
+    finally:
+        set_spans(previous)
+
+
+def record_span(name, seconds):
+    spans = current_spans()
+    if spans is not None:
+        spans.add(name, seconds)
+    request_metrics.observe_span(spans.route if spans is not None else "background", name, seconds)
+
+
+@contextmanager
+def span(name):
+    """Time a block as sub-span name of the current request ("background" outside requests)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RequestMetrics:
+    """Per-route request latency histograms, status counts and sub-span histograms"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.durations = {}
+        self.statuses = {}
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = table.setdefault(key, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, route, method, status, seconds):
+        self._histogram(self.durations, (route, method)).observe(seconds)
+        key = (route, method, status)
+        with self._lock:
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def observe_span(self, route, name, seconds):
+        self._histogram(self.spans, (route, name)).observe(seconds)
+
+    def snapshot(self):
+        """JSON-serializable copy of every series, for merge() in another process"""
+        with self._lock:
+            durations, statuses, spans = list(self.durations.items()), list(self.statuses.items()), list(self.spans.items())
+        return {
+            "buckets": list(self.buckets),
+            "durations": [[list(key), *histogram.snapshot()] for key, histogram in durations],
+            "statuses": [[list(key), count] for key, count in statuses],
+            "spans": [[list(key), *histogram.snapshot()] for key, histogram in spans]
+        }
+
+    def merge(self, snapshot):
+        """Add another RequestMetrics' snapshot(); one taken with other buckets is skipped"""
+        if tuple(snapshot["buckets"]) != tuple(self.buckets):
+            return
+        for key, counts, total in snapshot["durations"]:
+            self._histogram(self.durations, tuple(key)).merge(counts, total)
+        for key, count in snapshot["statuses"]:
+            key = tuple(key)
+            with self._lock:
+                self.statuses[key] = self.statuses.get(key, 0) + count
+        for key, counts, total in snapshot["spans"]:
+            self._histogram(self.spans, tuple(key)).merge(counts, total)
+
+    def prometheus(self, prefix="safeher"):
+        """Prometheus text exposition (format 0.0.4)"""
+        lines = []
+        self._histogram_lines(lines, f"{prefix}_http_request_duration_seconds",
+                              "HTTP request latency by route", ("route", "method"), self.durations)
+        lines.append(f"# HELP {prefix}_http_requests_total HTTP requests by route and status")
+        lines.append(f"# TYPE {prefix}_http_requests_total counter")
+        with self._lock:
+            statuses = sorted(self.statuses.items())
+        for (route, method, status), count in statuses:
+            lines.append(f'{prefix}_http_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {count}')
+        self._histogram_lines(lines, f"{prefix}_span_duration_seconds",
+                              "Time in DB / FCM sub-spans by route", ("route", "span"), self.spans)
+        return "\n".join(lines) + "\n"
+
+    def _histogram_lines(self, lines, name, help_text, label_names, table):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        with self._lock:
+            items = sorted(table.items())
+        for key, histogram in items:
+            labels = ",".join(f'{n}="{_label(v)}"' for n, v in zip(label_names, key))
+            rows, total, count = histogram.cumulative()
+            for bound, cumulative in rows:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+
+
+class SharedMetrics:
+    """
+    Every worker's RequestMetrics, summed. Each process publishes a snapshot of its own
+    metrics every METRICS_PUBLISH_INTERVAL seconds (and before answering a scrape) to a
+    row of the shared file; rows are grouped per server (METRICS_GROUP, set by the
+    pre-fork master), and those of exited workers are kept so the sums never go back.
+    """
+
+    def __init__(self, metrics, path=METRICS_PATH, group=None, interval=METRICS_PUBLISH_INTERVAL, worker=None):
+        self.metrics = metrics
+        self.path = path
+        self.group = group
+        self.interval = interval
+        self.publishes = 0
+        # Row this process publishes to (default: a new one per process)
+        self.worker = worker
+        self._worker = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS metrics_workers ('
+                         'worker TEXT PRIMARY KEY, grp TEXT NOT NULL, updated_at REAL NOT NULL, snapshot TEXT NOT NULL)')
+
+    @contextmanager
+    def _connection(self):
+        """A connection for one publication or scrape (each is seconds apart), committed on success"""
+        conn = sqlite3.connect(self.path, timeout=10.0)
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _identity(self):
+        """(worker, group) of this process; a forked child gets its own worker id"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._worker = self.worker or f"{self._pid}-{time.time_ns()}"
+            group = self.group or os.getenv('METRICS_GROUP') or self._worker
+            return self._worker, group
+
+    def start(self):
+        """Publish in the background from this process (call after the fork)"""
+        self._identity()
+        thread = threading.Thread(target=self._run, name="metrics-publisher", daemon=True)
+        thread.start()
+        atexit.register(self.publish)
+        return thread
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except sqlite3.Error:
+                # The next publication retries; a scrape meanwhile sees the previous snapshot
+                pass
+
+    def publish(self):
+        worker, group = self._identity()
+        snapshot = json.dumps(self.metrics.snapshot(), separators=(",", ":"))
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO metrics_workers (worker, grp, updated_at, snapshot) VALUES (?, ?, ?, ?)',
+                         (worker, group, now, snapshot))
+            conn.execute('DELETE FROM metrics_workers WHERE grp != ? AND updated_at < ?',
+                         (group, now - METRICS_RETENTION))
+        self.publishes += 1
+
+    def collect(self):
+        """A RequestMetrics holding the sum of every worker of this server"""
+        self.publish()
+        _, group = self._identity()
+        with self._connection() as conn:
+            rows = conn.execute('SELECT snapshot FROM metrics_workers WHERE grp = ?', (group,)).fetchall()
+        total = RequestMetrics(self.metrics.buckets)
+        for (snapshot,) in rows:
+            total.merge(json.loads(snapshot))
+        return total
+
+    def prometheus(self, prefix="safeher"):
+        return self.collect().prometheus(prefix)
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,48 @@
+"""
+MySQL Backend - Storage interface over database.py and location_store.py
+"""
+from database import (
+    insert_user,
+    insert_contact,
+    insert_location,
+    insert_locations,
+    insert_sos,
+    get_user,
+    get_user_contacts,
+    insert_routine,
+    get_user_routines,
+    get_routine_owner,
+    delete_routine,
+    check_location_against_routine,
+    get_routine_schedule,
+    invalidate_routine_schedule,
+    insert_place,
+    get_user_places,
+    get_place_owner,
+    delete_place,
+    insert_device_token,
+    get_device_tokens,
+    delete_device_tokens,
+    start_pool,
+    ping_database,
+    pool_stats,
+    query_stats
+)
+from location_store import get_user_locations, iter_user_locations, get_user_track, get_hot_locations, location_maintenance
+
+name = "mysql"
+
+def start():
+    """Prewarm the connection pool and start the location maintenance job"""
+    start_pool()
+    location_maintenance.start()
+
+def ping():
+    ping_database()
+
+def stats():
+    return {
+        "db_pool": pool_stats(),
+        "db_queries": query_stats(),
+        "location_store": location_maintenance.stats()
+    }
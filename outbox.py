@@ -0,0 +1,272 @@
+"""
+Outbox - Durable queue of outbound notifications
+Notifications that could not be sent right away are written to a local SQLite file
+(committed with synchronous=FULL before enqueue returns), so a restart does not lose
+them. A pool of worker threads drains due jobs in priority order (SOS before
+informational), retrying failures with exponential backoff and jitter until
+OUTBOX_MAX_ATTEMPTS. A dedup key (the SOS id) keeps one job per alert however
+often it is enqueued. Workers claim a job by pushing its due time past a lease, so
+a job held by a worker that died is picked up again, by this or another process.
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from db_pool import SQLitePool
+from metrics import LatencyStats
+from logger import info, error, warning
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', os.path.join(SPOOL_DIR, "outbox.db"))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+# Backoff before retry n is OUTBOX_BASE_DELAY * 2**(n-1) seconds, capped, of which a random half is jitter
+OUTBOX_BASE_DELAY = float(os.getenv('OUTBOX_BASE_DELAY', 2.0))
+OUTBOX_MAX_DELAY = float(os.getenv('OUTBOX_MAX_DELAY', 300.0))
+# How long a claimed job may take before another worker may retry it
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 60.0))
+# Sent and dead jobs are deleted after this many seconds (their dedup keys go with them)
+OUTBOX_RETENTION = float(os.getenv('OUTBOX_RETENTION', 86400))
+OUTBOX_POLL_INTERVAL = 1.0
+
+PRIORITY_SOS = 0
+PRIORITY_INFO = 10
+
+PENDING = "pending"
+SENT = "sent"
+DEAD = "dead"
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        dedup_key TEXT UNIQUE,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        due_at REAL NOT NULL,
+        created_at REAL NOT NULL,
+        finished_at REAL,
+        last_error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, priority, due_at);
+'''
+
+
+def backoff(attempt, base=OUTBOX_BASE_DELAY, cap=OUTBOX_MAX_DELAY):
+    """Delay before retrying after a failed attempt: exponential, capped, half of it random"""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Outbox:
+    """
+    Durable notification queue. senders maps a job kind to fn(payload), which must
+    raise if the notification was not sent; register() adds more.
+    """
+
+    def __init__(self, path=OUTBOX_PATH, senders=None, workers=OUTBOX_WORKERS, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 base_delay=OUTBOX_BASE_DELAY, max_delay=OUTBOX_MAX_DELAY, lease=OUTBOX_LEASE,
+                 retention=OUTBOX_RETENTION):
+        self.path = path
+        self.senders = dict(senders or {})
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.retention = retention
+        self.delivery_latency = LatencyStats()
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        # One connection per worker thread, plus a couple for request threads enqueueing
+        self._pool = SQLitePool(self._connect, workers + 2, timeout=10.0)
+        self._wakeup = threading.Condition()
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def register(self, kind, send_fn):
+        self.senders[kind] = send_fn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        # A job must be on disk when enqueue returns
+        conn.execute('PRAGMA synchronous = FULL')
+        return conn
+
+    def _execute(self, query, params=()):
+        """Run one statement on a pooled connection; returns the row count"""
+        with self._pool.connection() as conn:
+            return conn.execute(query, params).rowcount
+
+    def _fetchone(self, query, params=()):
+        with self._pool.connection() as conn:
+            return conn.execute(query, params).fetchone()
+
+    def enqueue(self, kind, payload, priority=PRIORITY_INFO, dedup_key=None, now=None):
+        """
+        Durably queue one notification for the workers.
+        Returns: (job id, True) when queued, or (existing job id, False) for a duplicate dedup_key
+        """
+        now = time.time() if now is None else now
+        with self._pool.connection() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO outbox (kind, priority, dedup_key, payload, status, due_at, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, priority, dedup_key, json.dumps(payload), PENDING, now, now)
+            )
+            if cursor.rowcount == 0:
+                self.deduplicated += 1
+                row = conn.execute('SELECT id FROM outbox WHERE dedup_key = ?', (dedup_key,)).fetchone()
+                return row[0], False
+        self.enqueued += 1
+        with self._wakeup:
+            self._wakeup.notify()
+        return cursor.lastrowid, True
+
+    def enqueue_many(self, kind, jobs, priority=PRIORITY_INFO, now=None):
+        """
+        Durably queue (payload, dedup_key) pairs in one transaction.
+        Returns: the number queued (the rest were duplicates)
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return 0
+        now = time.time() if now is None else now
+        with self._pool.transaction() as conn:
+            queued = conn.executemany(
+                'INSERT OR IGNORE INTO outbox (kind, priority, dedup_key, payload, status, due_at, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(kind, priority, dedup_key, json.dumps(payload), PENDING, now, now) for payload, dedup_key in jobs]
+            ).rowcount
+        self.enqueued += queued
+        self.deduplicated += len(jobs) - queued
+        with self._wakeup:
+            self._wakeup.notify(queued)
+        return queued
+
+    def claim(self, now=None):
+        """Take the most urgent due job, leasing it to this worker; returns (id, kind, payload, attempt, created_at) or None"""
+        now = time.time() if now is None else now
+        with self._pool.transaction() as conn:
+            row = conn.execute(
+                'SELECT id, kind, payload, attempts, created_at FROM outbox WHERE status = ? AND due_at <= ? '
+                'ORDER BY priority, due_at, id LIMIT 1',
+                (PENDING, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute('UPDATE outbox SET attempts = attempts + 1, due_at = ? WHERE id = ?',
+                             (now + self.lease, row[0]))
+        if row is None:
+            return None
+        job_id, kind, payload, attempts, created_at = row
+        return job_id, kind, json.loads(payload), attempts + 1, created_at
+
+    def process_once(self, now=None):
+        """Claim and send one due job; returns False when none was due"""
+        job = self.claim(now)
+        if job is None:
+            return False
+        job_id, kind, payload, attempt, created_at = job
+        try:
+            sender = self.senders.get(kind)
+            if sender is None:
+                raise LookupError(f"No sender registered for '{kind}'")
+            sender(payload)
+        except Exception as e:
+            self._failed(job_id, kind, attempt, e, now)
+            return True
+        finished = time.time() if now is None else now
+        self._execute('UPDATE outbox SET status = ?, finished_at = ?, last_error = NULL WHERE id = ?',
+                      (SENT, finished, job_id))
+        self.sent += 1
+        self.delivery_latency.record((finished - created_at) * 1000.0)
+        if attempt > 1:
+            info("Outbox job %s (%s) sent on attempt %s", job_id, kind, attempt)
+        return True
+
+    def _failed(self, job_id, kind, attempt, e, now=None):
+        now = time.time() if now is None else now
+        if attempt >= self.max_attempts:
+            self._execute('UPDATE outbox SET status = ?, finished_at = ?, last_error = ? WHERE id = ?',
+                          (DEAD, now, str(e), job_id))
+            self.dead += 1
+            error("❌ Outbox job %s (%s) failed after %s attempts: %s", job_id, kind, attempt, e)
+            return
+        delay = backoff(attempt, self.base_delay, self.max_delay)
+        self._execute('UPDATE outbox SET due_at = ?, last_error = ? WHERE id = ?', (now + delay, str(e), job_id))
+        self.retried += 1
+        warning("Outbox job %s (%s) attempt %s failed, retrying in %.1fs: %s", job_id, kind, attempt, delay, e)
+
+    def next_due_in(self, now=None):
+        """Seconds until the next pending job is due (None if there is none)"""
+        now = time.time() if now is None else now
+        row = self._fetchone('SELECT MIN(due_at) FROM outbox WHERE status = ?', (PENDING,))
+        return None if row[0] is None else max(0.0, row[0] - now)
+
+    def purge(self, now=None):
+        """Delete sent and dead jobs older than the retention period"""
+        now = time.time() if now is None else now
+        return self._execute('DELETE FROM outbox WHERE status != ? AND finished_at < ?',
+                             (PENDING, now - self.retention))
+
+    def start(self):
+        """Start the worker threads (lazily, and again after a fork)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True).start()
+            pending = self._fetchone('SELECT COUNT(*) FROM outbox WHERE status = ?', (PENDING,))[0]
+            if pending:
+                info("Outbox started with %s pending notifications", pending)
+
+    def _worker(self):
+        last_purge = time.monotonic()
+        while True:
+            try:
+                if self.process_once():
+                    continue
+                if time.monotonic() - last_purge > 3600:
+                    self.purge()
+                    last_purge = time.monotonic()
+                wait = self.next_due_in()
+            except Exception as e:
+                error("Outbox worker error: %s", e)
+                wait = OUTBOX_POLL_INTERVAL
+            with self._wakeup:
+                self._wakeup.wait(OUTBOX_POLL_INTERVAL if wait is None else min(wait, OUTBOX_POLL_INTERVAL))
+
+    def stats(self, now=None):
+        """Backlog by priority, oldest pending age and time-to-delivery"""
+        now = time.time() if now is None else now
+        backlog = {PRIORITY_SOS: 0, PRIORITY_INFO: 0}
+        with self._pool.connection() as conn:
+            for priority, count in conn.execute(
+                    'SELECT priority, COUNT(*) FROM outbox WHERE status = ? GROUP BY priority', (PENDING,)):
+                backlog[priority] = count
+            oldest = conn.execute('SELECT MIN(created_at) FROM outbox WHERE status = ?', (PENDING,)).fetchone()[0]
+        return {
+            "backlog": {"sos": backlog.pop(PRIORITY_SOS), "info": backlog.pop(PRIORITY_INFO), "other": sum(backlog.values())},
+            "oldest_pending_s": round(now - oldest, 1) if oldest is not None else None,
+            "enqueued": self.enqueued,
+            "deduplicated": self.deduplicated,
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead,
+            "time_to_delivery": self.delivery_latency.summary()
+        }
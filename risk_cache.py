@@ -0,0 +1,138 @@
+"""
+Risk Cache - Memoized risk results per geohash cell and hour of day
+A risk result only depends on the coordinates and the hour, so users in the same area
+share one answer. Results are kept in an LRU keyed by (geohash cell, hour, model version);
+reloading the risk grid or the zones changes the version, so a stale result is never served.
+A cell is cached as a whole only when its result provably cannot vary inside it (it lies
+in one risk grid cell, and each zone near it either misses it or is a rectangle covering
+all of it), so its center's result is exact for every point. Other cells, e.g. one with
+a zone smaller than the cell, are remembered as mixed and scored exactly per point.
+Busy cells from recent location history are precomputed at startup.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+from ai_engine import is_uniform, model_version, run_ai_risk_check, run_ai_risk_check_batch
+from cache import MemoryBackend, MISSING
+from geo import geohash_cell, geohash_cell_bbox
+from logger import info, error
+
+# Geohash length: 6 is ~1.2 km x 0.6 km, 7 is ~150 x 150 m, 8 is ~40 x 20 m
+RISK_CACHE_PRECISION = int(os.getenv('RISK_CACHE_PRECISION', 7))
+RISK_CACHE_MAX_ENTRIES = int(os.getenv('RISK_CACHE_MAX_ENTRIES', 100000))
+RISK_CACHE_TTL = float(os.getenv('RISK_CACHE_TTL', 86400))
+# Busiest cells to precompute at startup (0 disables), from this many days of history
+RISK_CACHE_WARM_CELLS = int(os.getenv('RISK_CACHE_WARM_CELLS', 1000))
+RISK_CACHE_WARM_DAYS = float(os.getenv('RISK_CACHE_WARM_DAYS', 7))
+
+MIXED = "mixed"
+
+
+def _center_if_uniform(cell, precision):
+    """The cell's center as (lat, lng) if every point in the cell scores the same, else None"""
+    min_lat, min_lng, max_lat, max_lng = geohash_cell_bbox(*cell, precision)
+    if not is_uniform(min_lat, min_lng, max_lat, max_lng):
+        return None
+    return (min_lat + max_lat) / 2, (min_lng + max_lng) / 2
+
+
+class RiskCache:
+    """LRU of (risk_level, reason) per cell and hour, with hit/miss counters"""
+
+    def __init__(self, precision=RISK_CACHE_PRECISION, max_entries=RISK_CACHE_MAX_ENTRIES, ttl=RISK_CACHE_TTL):
+        self.precision = precision
+        self.ttl = ttl
+        self.backend = MemoryBackend(max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.mixed = 0
+        self.hot = []
+        self.warm_ms = None
+
+    def check(self, lat, lng, hour=None):
+        """(risk_level, reason) for a point, as run_ai_risk_check would return it"""
+        lat, lng = float(lat), float(lng)
+        hour = datetime.now().hour if hour is None else hour % 24
+        cell = geohash_cell(lat, lng, self.precision)
+        key = (cell, hour, model_version())
+        result = self.backend.get(key)
+        if result is MISSING:
+            self.misses += 1
+            center = _center_if_uniform(cell, self.precision)
+            result = MIXED if center is None else run_ai_risk_check(*center, hour)
+            self.backend.set(key, result, self.ttl)
+        else:
+            self.hits += 1
+        if result == MIXED:
+            self.mixed += 1
+            return run_ai_risk_check(lat, lng, hour)
+        return result
+
+    def warm(self, cells, hours=range(24)):
+        """Precompute every hour for a list of geohash cells in one batch; returns the number of entries"""
+        cells = list(cells)
+        hours = list(hours)
+        if not cells:
+            return 0
+        version = model_version()
+        uniform = []
+        for cell in cells:
+            center = _center_if_uniform(cell, self.precision)
+            if center is None:
+                for hour in hours:
+                    self.backend.set((cell, hour, version), MIXED, self.ttl)
+            else:
+                uniform.append((cell, center))
+        if uniform:
+            lats = [center[0] for _, center in uniform for _ in hours]
+            lngs = [center[1] for _, center in uniform for _ in hours]
+            results = iter(run_ai_risk_check_batch(lats, lngs, hours * len(uniform)))
+            for cell, _ in uniform:
+                for hour in hours:
+                    self.backend.set((cell, hour, version), next(results), self.ttl)
+        return len(cells) * len(hours)
+
+    def warm_from(self, load_hot_locations, cells=RISK_CACHE_WARM_CELLS, days=RISK_CACHE_WARM_DAYS):
+        """Precompute the busiest cells; load_hot_locations(since, limit) returns (lat, lng, fixes) rows"""
+        if cells <= 0:
+            return 0
+        start = time.perf_counter()
+        try:
+            rows = load_hot_locations(datetime.now() - timedelta(days=days), cells * 4)
+        except Exception as e:
+            error("Risk cache warm-up skipped, hot locations unavailable: %s", e)
+            return 0
+        hot = []
+        seen = set()
+        for lat, lng, _ in rows:
+            cell = geohash_cell(float(lat), float(lng), self.precision)
+            if cell not in seen:
+                seen.add(cell)
+                hot.append(cell)
+        self.hot = hot[:cells]
+        entries = self.rewarm()
+        self.warm_ms = round((time.perf_counter() - start) * 1000, 1)
+        info("Risk cache warmed with %s cells (%s entries) in %s ms", len(self.hot), entries, self.warm_ms)
+        return entries
+
+    def rewarm(self):
+        """Precompute the hot cells again, e.g. after the zones were reloaded"""
+        return self.warm(self.hot)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "precision": self.precision,
+            "model_version": model_version(),
+            "entries": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "mixed": self.mixed,
+            "evictions": self.backend.evictions,
+            "hot_cells": len(self.hot),
+            "warm_ms": self.warm_ms
+        }
+
+
+risk_cache = RiskCache()
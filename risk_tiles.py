@@ -0,0 +1,102 @@
+"""
+Risk Tiles - Read-only risk heatmap tiles for the dashboard map
+A tile is a standard XYZ (Web Mercator) map tile divided into a size x size grid; every
+cell center is scored in one vectorized ai_engine.score_points pass. Tiles are cached by
+(tile, size, hour, model version), and the same key is the tile's ETag, so a client that
+already has a tile gets 304 Not Modified without it being looked up or recomputed.
+Encodings:
+  json    levels and scores (0-255) as run-length [value, count, ...] lists, rows north to south
+  binary  b"SHR" + version byte (1), uint16 size (little-endian), size*size level bytes,
+          size*size score bytes
+"""
+import hashlib
+import math
+import os
+import struct
+import numpy as np
+from ai_engine import model_version, score_points
+from cache import Cache, MemoryBackend
+from metrics import LatencyStats
+
+RISK_TILE_SIZE = int(os.getenv('RISK_TILE_SIZE', 32))
+RISK_TILE_CACHE_ENTRIES = int(os.getenv('RISK_TILE_CACHE_ENTRIES', 5000))
+RISK_TILE_TTL = float(os.getenv('RISK_TILE_TTL', 3600))
+# How long browsers may reuse a tile before revalidating it with its ETag
+RISK_TILE_MAX_AGE = int(os.getenv('RISK_TILE_MAX_AGE', 60))
+
+MAGIC = b"SHR"
+VERSION = 1
+HEADER = MAGIC + bytes([VERSION])
+CONTENT_TYPE = "application/vnd.safeher.risktile+binary"
+
+
+def tile_bbox(zoom, x, y):
+    """(min_lat, min_lng, max_lat, max_lng) of an XYZ tile"""
+    n = 2 ** zoom
+    max_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    min_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return min_lat, x / n * 360.0 - 180.0, max_lat, (x + 1) / n * 360.0 - 180.0
+
+
+def compute_tile(zoom, x, y, size, hour):
+    """Score the tile's cell centers; returns (levels, scores) uint8 arrays of shape (size, size)"""
+    n = 2 ** zoom
+    offsets = (np.arange(size) + 0.5) / size
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    lngs = (x + offsets) / n * 360.0 - 180.0
+    lat_grid, lng_grid = np.meshgrid(lats, lngs, indexing="ij")
+    scores, level_index, _, _ = score_points(lat_grid, lng_grid, hour)
+    return level_index.astype(np.uint8), np.rint(scores * 255).astype(np.uint8)
+
+
+def rle_encode(values):
+    """Run-length encode an array in row-major order as a flat [value, count, ...] list"""
+    flat = np.ravel(values)
+    if flat.size == 0:
+        return []
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    counts = np.diff(np.append(starts, flat.size))
+    return np.column_stack((flat[starts], counts)).ravel().tolist()
+
+
+def rle_decode(runs):
+    """Inverse of rle_encode (for clients and tests)"""
+    return np.repeat(np.asarray(runs[0::2], dtype=np.uint8), runs[1::2])
+
+
+def encode_binary(levels, scores):
+    return HEADER + struct.pack("<H", levels.shape[0]) + levels.tobytes() + scores.tobytes()
+
+
+class RiskTiles:
+    """Computed tiles in an LRU, with compute timings and 304 counts"""
+
+    def __init__(self, max_entries=RISK_TILE_CACHE_ENTRIES, ttl=RISK_TILE_TTL):
+        self.cache = Cache(MemoryBackend(max_entries), default_ttl=ttl)
+        self.compute_latency = LatencyStats()
+        self.not_modified = 0
+
+    def etag(self, zoom, x, y, size, hour):
+        """Identifies the tile's content: same tile, grid, hour and model means the same scores"""
+        key = f"{zoom}/{x}/{y}:{size}:{hour}:{model_version()}"
+        return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def get(self, zoom, x, y, size, hour, etag=None):
+        """(levels, scores) for a tile, computed on a cache miss"""
+        etag = etag or self.etag(zoom, x, y, size, hour)
+
+        def load():
+            with self.compute_latency.time():
+                return compute_tile(zoom, x, y, size, hour)
+
+        return self.cache.get_or_load(etag, load)
+
+    def stats(self):
+        return {
+            **self.cache.stats(),
+            "not_modified": self.not_modified,
+            "compute": self.compute_latency.summary()
+        }
+
+
+risk_tiles = RiskTiles()
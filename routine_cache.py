@@ -0,0 +1,225 @@
+"""
+Routine Cache - In-memory per-user routine schedules
+Each user's routines are expanded into a sorted list of week-time segments so the
+routine active at a given moment is found with one bisect instead of a DB query
+"""
+import bisect
+import os
+import threading
+import time
+from datetime import datetime, timedelta, time as dtime
+from geo import PointSet, parse_coordinates
+from logger import warning
+
+ROUTINE_CACHE_TTL = float(os.getenv('ROUTINE_CACHE_TTL', 300))
+ROUTINE_CACHE_MAX_USERS = int(os.getenv('ROUTINE_CACHE_MAX_USERS', 10000))
+
+DAY_SECONDS = 86400
+WEEK_SECONDS = 7 * DAY_SECONDS
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+DAY_ALIASES = {
+    "daily": range(7),
+    "everyday": range(7),
+    "weekdays": range(5),
+    "weekends": range(5, 7)
+}
+
+
+def to_seconds(value):
+    """
+    Seconds since midnight for a MySQL TIME (timedelta), datetime.time or "HH:MM[:SS]" string.
+    Raises ValueError for anything else.
+    """
+    if isinstance(value, timedelta):
+        return int(value.total_seconds()) % DAY_SECONDS
+    if isinstance(value, dtime):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    parts = [int(p) for p in str(value).strip().split(":")]
+    if len(parts) > 3 or min(parts) < 0:
+        raise ValueError(f"Invalid time of day: {value!r}")
+    parts += [0] * (3 - len(parts))
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]) % DAY_SECONDS
+
+
+def parse_days(days):
+    """Weekday numbers (Mon=0) from a days string like "Mon,Wed,Fri"; empty means every day"""
+    if not days or not str(days).strip():
+        return list(range(7))
+    result = set()
+    for token in str(days).replace(";", ",").replace(" ", ",").split(","):
+        token = token.strip().lower()
+        if not token:
+            continue
+        if token in DAY_ALIASES:
+            result.update(DAY_ALIASES[token])
+        elif token[:3] in DAY_NAMES:
+            result.add(DAY_NAMES.index(token[:3]))
+    return sorted(result) if result else list(range(7))
+
+
+class RoutineSchedule:
+    """
+    Week-long timeline for one user's routines.
+    Routines are dicts with at least id, time_from, time_to and days; routines whose
+    end is not after their start wrap past midnight into the following day.
+    Routine coordinates (latitude/longitude, or a "lat,lng" location for rows saved
+    before those columns existed) are resolved once into a PointSet.
+    """
+
+    def __init__(self, routines):
+        # A row with unreadable times is left out rather than failing the whole schedule
+        self.routines = []
+        for routine in routines:
+            try:
+                to_seconds(routine["time_from"]), to_seconds(routine["time_to"])
+            except (KeyError, TypeError, ValueError):
+                warning("Skipping routine %s with invalid times %r-%r", routine.get("id"),
+                        routine.get("time_from"), routine.get("time_to"))
+                continue
+            self.routines.append(routine)
+        self.routine_ids = {r["id"] for r in self.routines}
+
+        located = []
+        for routine in self.routines:
+            if routine.get("latitude") is not None and routine.get("longitude") is not None:
+                located.append((routine["id"], float(routine["latitude"]), float(routine["longitude"])))
+            else:
+                coordinates = parse_coordinates(routine.get("location"))
+                if coordinates:
+                    located.append((routine["id"], coordinates[0], coordinates[1]))
+        self.located_ids = [r[0] for r in located]
+        self.points = PointSet([r[1] for r in located], [r[2] for r in located])
+
+        intervals = []
+        for routine in self.routines:
+            start_s = to_seconds(routine["time_from"])
+            # The old check was inclusive of time_to, so the interval ends one second later
+            end_s = to_seconds(routine["time_to"]) + 1
+            length = end_s - start_s if end_s > start_s else end_s + DAY_SECONDS - start_s
+            for day in parse_days(routine.get("days")):
+                start = day * DAY_SECONDS + start_s
+                end = start + length
+                if end > WEEK_SECONDS:
+                    # Sunday night routines continue into Monday morning
+                    intervals.append((start, WEEK_SECONDS, routine))
+                    intervals.append((0, end - WEEK_SECONDS, routine))
+                else:
+                    intervals.append((start, end, routine))
+
+        # Cut the week at every interval boundary; each segment lists the routines active in it
+        self.boundaries = sorted({0, WEEK_SECONDS} | {i[0] for i in intervals} | {i[1] for i in intervals})
+        self.segments = [[] for _ in self.boundaries]
+        for start, end, routine in sorted(intervals, key=lambda i: (to_seconds(i[2]["time_from"]), i[0])):
+            for index in range(bisect.bisect_left(self.boundaries, start), bisect.bisect_left(self.boundaries, end)):
+                self.segments[index].append(routine)
+
+    def active(self, when=None):
+        """Routines active at the given datetime (default now), earliest start first"""
+        when = when or datetime.now()
+        offset = when.weekday() * DAY_SECONDS + when.hour * 3600 + when.minute * 60 + when.second
+        return self.segments[bisect.bisect_right(self.boundaries, offset) - 1]
+
+    def distances_km(self, lat, lng):
+        """Distance from one point to every routine location, as {routine_id: km}"""
+        if not self.located_ids:
+            return {}
+        return dict(zip(self.located_ids, self.points.distances_km(lat, lng).tolist()))
+
+    def check_location(self, lat, lng, when=None):
+        """
+        Check a position against the routines active at when (default now).
+        Returns: (is_at_correct_location, routine_info, distance_km)
+        """
+        active = self.active(when)
+        distances = self.distances_km(lat, lng) if active else {}
+        for routine in active:
+            routine_location = routine["location"]
+            distance = distances.get(routine["id"])
+            
+            # If routine has specific location and user is far (>1km), it's a mismatch
+            if routine_location and distance is not None and distance > 1.0:
+                return False, {
+                    "routine_id": routine["id"],
+                    "title": routine["title"],
+                    "location": routine_location,
+                    "time_from": str(routine["time_from"]),
+                    "time_to": str(routine["time_to"])
+                }, distance
+            elif routine_location and distance is not None:
+                return True, {
+                    "routine_id": routine["id"],
+                    "title": routine["title"],
+                    "location": routine_location,
+                    "distance_km": round(distance, 2)
+                }, distance
+        
+        # No active routine at this time
+        return True, None, 0
+
+
+class RoutineCache:
+    """Per-user RoutineSchedule cache with TTL expiry and explicit invalidation"""
+
+    def __init__(self, loader, ttl=ROUTINE_CACHE_TTL, max_users=ROUTINE_CACHE_MAX_USERS):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = {}
+        self._lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with one is not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        """Cached schedule for the user, loading it through loader(username) on a miss"""
+        schedule, miss = self.lookup(username)
+        if schedule is None:
+            schedule = self.store(username, self.loader(username), miss)
+        return schedule
+
+    def lookup(self, username):
+        """(cached schedule, None) on a hit; (None, miss) on a miss, to pass to store() with the loaded rows"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry and now - entry[1] < self.ttl:
+                self.hits += 1
+                return entry[0], None
+            self.misses += 1
+            return None, (self._generation, now)
+
+    def store(self, username, routines, miss):
+        """Schedule for routines loaded after lookup(); cached unless an invalidation came in between"""
+        generation, now = miss
+        schedule = RoutineSchedule(routines)
+        with self._lock:
+            if generation != self._generation:
+                return schedule
+            if len(self._entries) >= self.max_users and username not in self._entries:
+                # Evict the oldest entry (dicts keep insertion order)
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[username] = (schedule, now)
+        return schedule
+
+    def invalidate(self, username):
+        """Drop a user's schedule after one of their routines changed"""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(username, None)
+
+    def invalidate_routine(self, routine_id):
+        """Drop whichever cached schedule holds this routine (if any)"""
+        with self._lock:
+            self._generation += 1
+            for username, (schedule, _) in list(self._entries.items()):
+                if routine_id in schedule.routine_ids:
+                    del self._entries[username]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
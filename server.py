@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Server - Production entry point for the SAFEHER API
+SERVER_MODE selects how the app is served:
+  dev       Werkzeug development server (same as `python app.py`)
+  threaded  waitress multi-threaded WSGI server
+  asgi      uvicorn event loop; /analyze, /sos and history as async views, the rest of
+            Flask bridged by asgiref with at most SERVER_THREADS requests (asgi.py)
+With --workers N (or SERVER_WORKERS) the process becomes a pre-fork master: it binds
+the listening socket, forks N workers that import the app (and build their DB pool)
+after the fork, restarts crashed workers and does a graceful reload on SIGHUP. The
+workers share the log files, so the master is the one process that rotates them.
+Usage: SERVER_MODE=asgi python server.py --workers 4
+"""
+import argparse
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from datetime import date, datetime, time as dtime, timedelta
+import logger
+from logger import info, error, warning
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'dev')
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', 5000))
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', 32))
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 1))
+# Read here rather than imported from asgi.py, which imports the app
+ASGI_ASYNC_VIEWS = os.getenv('ASGI_ASYNC_VIEWS', '1') == '1'
+
+# Total MySQL connections shared by all workers (keep below max_connections)
+DB_CONNECTION_BUDGET = int(os.getenv('DB_CONNECTION_BUDGET', 40))
+
+WORKER_BOOT_TIMEOUT = float(os.getenv('WORKER_BOOT_TIMEOUT', 60))
+GRACEFUL_TIMEOUT = float(os.getenv('GRACEFUL_TIMEOUT', 30))
+
+
+def run_dev():
+    from app import app
+    app.run(debug=False, host=SERVER_HOST, port=SERVER_PORT, threaded=True)
+
+
+def run_threaded():
+    try:
+        from waitress import serve
+    except ImportError:
+        raise RuntimeError("SERVER_MODE=threaded requires waitress (pip install waitress)")
+    from app import app
+    serve(app, host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS)
+
+
+def run_asgi():
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("SERVER_MODE=asgi requires uvicorn (pip install uvicorn)")
+    from asgi import asgi_app
+    # A WSGI app has no startup or shutdown hooks to run
+    uvicorn.run(asgi_app, host=SERVER_HOST, port=SERVER_PORT, lifespan="off", log_level="warning")
+
+
+SERVERS = {
+    "dev": run_dev,
+    "threaded": run_threaded,
+    "asgi": run_asgi
+}
+
+
+def pool_size_per_worker(workers, budget=DB_CONNECTION_BUDGET, pools=1):
+    """
+    Split the global connection budget across workers (and across each worker's pools).
+    During a reload the old and new generations run side by side, so the budget has to
+    cover twice the workers.
+    """
+    return max(1, budget // (2 * max(1, workers) * pools))
+
+
+def pools_per_worker(mode=SERVER_MODE):
+    """asgi workers with async views (asgi.py) have an async pool next to the sync one"""
+    return 2 if mode == "asgi" and ASGI_ASYNC_VIEWS else 1
+
+
+def next_midnight():
+    return datetime.combine(date.today() + timedelta(days=1), dtime.min).timestamp()
+
+
+def serve_dev_on(sock):
+    from werkzeug.serving import make_server
+    from app import app
+    server = make_server(SERVER_HOST, SERVER_PORT, app, threaded=True, fd=sock.fileno())
+    # Stop accepting on SIGTERM; shutdown() must be called off the serving thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+
+
+def serve_threaded_on(sock):
+    try:
+        from waitress.server import create_server
+    except ImportError:
+        raise RuntimeError("SERVER_MODE=threaded requires waitress (pip install waitress)")
+    from app import app
+    server = create_server(app, sockets=[sock], threads=SERVER_THREADS)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.run()
+
+
+def serve_asgi_on(sock):
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("SERVER_MODE=asgi requires uvicorn (pip install uvicorn)")
+    from asgi import asgi_app
+    # uvicorn installs its own SIGTERM handler and drains in-flight requests
+    uvicorn.Server(uvicorn.Config(asgi_app, fd=sock.fileno(), lifespan="off", log_level="warning")).run()
+
+
+WORKER_SERVERS = {
+    "dev": serve_dev_on,
+    "threaded": serve_threaded_on,
+    "asgi": serve_asgi_on
+}
+
+
+class Launcher:
+    """Pre-fork master that supervises a generation of workers sharing one socket"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pools = pools_per_worker()
+        self.pool_size = pool_size_per_worker(workers, pools=self.pools)
+        self.generation = 0
+        self.children = {}
+        # Workers (of every generation) publish /metrics snapshots under this server's group
+        os.environ['METRICS_GROUP'] = f"{os.getpid()}-{time.time_ns()}"
+        self.reload_requested = False
+        self.stop_requested = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Inherited by accepted connections: uvicorn sends a response's headers and body as
+        # separate writes, which Nagle would hold back until the client's delayed ACK
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.bind((SERVER_HOST, SERVER_PORT))
+        self.sock.listen(1024)
+        self.sock.set_inheritable(True)
+
+    def spawn(self):
+        """Fork one worker of the current generation; returns its ready-pipe read end"""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            self._worker_main(ready_w)
+        os.close(ready_w)
+        self.children[pid] = self.generation
+        return ready_r
+
+    def _worker_main(self, ready_w):
+        """Runs in the child: configure, import the app, report ready, serve"""
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        os.environ['DB_POOL_SIZE'] = str(self.pool_size)
+        os.environ['ASYNC_DB_POOL_SIZE'] = str(self.pool_size)
+        code = 0
+        try:
+            serve = WORKER_SERVERS[SERVER_MODE]
+            # Importing here (not in the master) means a reload picks up new code
+            import app  # noqa: F401
+            try:
+                os.write(ready_w, b"1")
+            except BrokenPipeError:
+                # Nobody is waiting (a replacement for a crashed worker)
+                pass
+            os.close(ready_w)
+            serve(self.sock)
+        except Exception as e:
+            error("Worker %s failed: %s", os.getpid(), e)
+            code = 1
+        # sys.exit (not os._exit) so atexit hooks flush buffered writes
+        sys.exit(code)
+
+    def spawn_generation(self):
+        """Start a full set of workers and wait until each has imported the app"""
+        pending = [self.spawn() for _ in range(self.workers)]
+        deadline = time.monotonic() + WORKER_BOOT_TIMEOUT
+        ready = 0
+        while pending and time.monotonic() < deadline:
+            readable, _, _ = select.select(pending, [], [], max(0.0, deadline - time.monotonic()))
+            for fd in readable:
+                ready += os.read(fd, 1) == b"1"
+                os.close(fd)
+                pending.remove(fd)
+        for fd in pending:
+            os.close(fd)
+        return ready
+
+    def signal_generation(self, generation, signum):
+        for pid, gen in list(self.children.items()):
+            if gen == generation:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def reap(self):
+        """Collect exited workers; restart current-generation ones that died unexpectedly"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            if generation == self.generation and not self.stop_requested:
+                warning("Worker %s exited with status %s, restarting", pid, status)
+                # Nobody waits for a replacement to boot; its ready pipe is not needed
+                os.close(self.spawn())
+
+    def reload(self):
+        """Graceful reload: boot a new generation, then drain the old one"""
+        old_generation = self.generation
+        self.generation += 1
+        info("Reloading: starting worker generation %s", self.generation)
+        ready = self.spawn_generation()
+        if ready < self.workers:
+            error("Only %s/%s new workers booted, keeping generation %s", ready, self.workers, old_generation)
+            self.signal_generation(self.generation, signal.SIGTERM)
+            self.generation = old_generation
+            return
+        self.signal_generation(old_generation, signal.SIGTERM)
+
+    def stop(self):
+        """Ask every worker to finish in-flight requests, then force the stragglers"""
+        for generation in set(self.children.values()):
+            self.signal_generation(generation, signal.SIGTERM)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            warning("Worker %s did not stop in time, killing", pid)
+            os.kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+    def run(self):
+        if DB_CONNECTION_BUDGET < 2 * self.workers * self.pools:
+            warning("DB_CONNECTION_BUDGET=%s is below one connection per worker pool across a reload; "
+                    "%s connections may be open at once", DB_CONNECTION_BUDGET,
+                    2 * self.workers * self.pools * self.pool_size)
+        info("Pre-fork master %s: %s x %s workers on %s:%s, %s DB pool(s) of %s per worker",
+             os.getpid(), self.workers, SERVER_MODE, SERVER_HOST, SERVER_PORT, self.pools, self.pool_size)
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, "reload_requested", True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, "stop_requested", True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, "stop_requested", True))
+        # Workers inherit handlers that reopen the files after the rotation below
+        logger.configure(rotation="watched")
+        rotate_at = next_midnight()
+        self.spawn_generation()
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            if time.time() >= rotate_at:
+                rotate_at = next_midnight()
+                try:
+                    logger.rotate_files()
+                except OSError as e:
+                    error("Log rotation failed: %s", e)
+            time.sleep(0.2)
+        info("Shutting down workers")
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SAFEHER API")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="number of pre-forked worker processes (1 = single process)")
+    args = parser.parse_args()
+
+    if SERVER_MODE not in SERVERS:
+        error("Unknown SERVER_MODE '%s', expected one of %s", SERVER_MODE, ', '.join(SERVERS))
+        sys.exit(2)
+
+    if args.workers > 1:
+        Launcher(args.workers).run()
+        return
+
+    info("Starting SAFEHER API (%s) on %s:%s", SERVER_MODE, SERVER_HOST, SERVER_PORT)
+    # Turn SIGTERM into a normal exit so atexit hooks flush buffered writes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    SERVERS[SERVER_MODE]()
+
+
+if __name__ == "__main__":
+    main()
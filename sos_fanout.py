@@ -0,0 +1,233 @@
+"""
+SOS Fanout - Push an SOS to the devices of the user's emergency contacts
+Recipients (contacts with their FCM tokens) come from a cached lookup, so a repeat SOS
+costs no query. Tokens go out as FCM multicast chunks of up to SOS_FANOUT_CHUNK, at most
+SOS_FANOUT_CONCURRENCY chunks at a time, and every contact gets a delivery status.
+Tokens FCM reports as unregistered are removed so later alerts skip them; a token whose
+send failed otherwise is queued in the outbox and retried on its own. Journey alerts
+(events with "type": "trip_alert") take the same path at informational priority.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import LatencyStats, bind_spans, current_spans, span
+from outbox import PRIORITY_SOS, PRIORITY_INFO
+from logger import info, error, warning
+
+# FCM accepts at most 500 tokens per multicast
+FCM_MULTICAST_LIMIT = 500
+SOS_FANOUT_CHUNK = min(FCM_MULTICAST_LIMIT, int(os.getenv('SOS_FANOUT_CHUNK', FCM_MULTICAST_LIMIT)))
+SOS_FANOUT_CONCURRENCY = int(os.getenv('SOS_FANOUT_CONCURRENCY', 4))
+
+# Per-token error code for a token that no longer belongs to an app install
+UNREGISTERED = "unregistered"
+
+DELIVERED = "delivered"
+PARTIAL = "partial"
+FAILED = "failed"
+NO_DEVICE = "no_device"
+
+
+def fcm_multicast_sender(messaging):
+    """
+    send_fn for SOSFanout over firebase_admin.messaging (or a stand-in with the same names).
+    Returns one error code per token: None if delivered, UNREGISTERED, or the error text.
+    """
+    def send(tokens, event):
+        if event.get("type") == "trip_alert":
+            notification = messaging.Notification(title="⚠️ SAFEHER Journey Alert", body=event["message"])
+            data = {"type": "trip_alert", "username": event["username"], "timestamp": event["timestamp"],
+                    "trip_id": event["trip_id"], "alert": event["alert"]}
+        else:
+            notification = messaging.Notification(
+                title="🚨 SAFEHER EMERGENCY",
+                body=f"{event['name']} needs immediate help!"
+            )
+            data = {"type": "sos", "username": event["username"], "timestamp": event["timestamp"]}
+        message = messaging.MulticastMessage(
+            tokens=tokens,
+            notification=notification,
+            data=data,
+            android=messaging.AndroidConfig(priority="high")
+        )
+        with span("fcm"):
+            batch = messaging.send_each_for_multicast(message)
+        return [
+            None if response.success
+            else UNREGISTERED if isinstance(response.exception, messaging.UnregisteredError)
+            else str(response.exception)
+            for response in batch.responses
+        ]
+    return send
+
+
+class SOSFanout:
+    """
+    Sends an SOS event to each recipient's devices.
+    resolve_fn(username) returns [{"name", "phone", "tokens"}]; send_fn(tokens, event) sends one
+    chunk and returns an error code per token (None = delivered); remove_fn(tokens) drops
+    unregistered tokens from storage. With an outbox, each token whose send failed is queued
+    there (once per alert and token) and resent alone.
+    """
+
+    def __init__(self, resolve_fn, send_fn, remove_fn=None, outbox=None, chunk_size=SOS_FANOUT_CHUNK,
+                 concurrency=SOS_FANOUT_CONCURRENCY):
+        self.resolve_fn = resolve_fn
+        self.send_fn = send_fn
+        self.remove_fn = remove_fn
+        self.outbox = outbox
+        if outbox is not None:
+            outbox.register("sos_device", self._resend)
+        self.chunk_size = max(1, min(chunk_size, FCM_MULTICAST_LIMIT))
+        self.concurrency = max(1, concurrency)
+        self.latency = LatencyStats()
+        self.fanouts = 0
+        self.chunks = 0
+        self.delivered = 0
+        self.failed = 0
+        self.removed = 0
+        self.queued = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Create the chunk pool lazily (and again after a fork)"""
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="sos-fanout")
+
+    def _send_chunk(self, tokens, event, spans=None):
+        """Send one chunk; a chunk that raises counts as failed for each of its tokens"""
+        with bind_spans(spans):
+            try:
+                results = list(self.send_fn(tokens, event))
+            except Exception as e:
+                warning("SOS fan-out chunk of %s tokens failed: %s", len(tokens), e)
+                return [str(e)] * len(tokens)
+        if len(results) != len(tokens):
+            return ["missing result"] * len(tokens)
+        return results
+
+    def _remove(self, tokens):
+        if not tokens or self.remove_fn is None:
+            return
+        try:
+            self.remove_fn(tokens)
+            self.removed += len(tokens)
+        except Exception as e:
+            error("Removing %s unregistered tokens failed: %s", len(tokens), e)
+
+    def _resend(self, job):
+        """Outbox sender for one queued token; raises while the send keeps failing"""
+        result = list(self.send_fn([job["token"]], job["event"]))[0]
+        if result == UNREGISTERED:
+            # The device is gone; there is nothing left to retry
+            self._remove([job["token"]])
+        elif result is not None:
+            raise RuntimeError(result)
+
+    def _queue_retries(self, tokens, event):
+        """Queue failed tokens for retry; returns how many were newly queued"""
+        if not tokens or self.outbox is None:
+            return 0
+        # SOS events carry a sos_id, journey alerts their own alert_id
+        alert_id = f"sos:{event['sos_id']}" if event.get("sos_id") else event.get("alert_id")
+        jobs = [({"token": token, "event": event}, f"{alert_id}:{token}" if alert_id else None) for token in tokens]
+        priority = PRIORITY_INFO if event.get("type") == "trip_alert" else PRIORITY_SOS
+        try:
+            queued = self.outbox.enqueue_many("sos_device", jobs, priority)
+        except Exception as e:
+            error("❌ %s failed SOS devices for %s could not be queued for retry: %s",
+                  len(tokens), event['username'], e)
+            return 0
+        self.outbox.start()
+        self.queued += queued
+        return queued
+
+    def send(self, event):
+        """
+        Fan one SOS event out to the user's contacts.
+        Returns: dict with recipient, token and delivery counts and a status per contact
+        """
+        start = time.perf_counter()
+        return self.deliver(event, self.resolve_fn(event["username"]) or [], start)
+
+    def deliver(self, event, recipients, start=None):
+        """send() to recipients already resolved"""
+        start = time.perf_counter() if start is None else start
+        # A device shared by two contacts is only notified once
+        tokens = list(dict.fromkeys(token for recipient in recipients for token in recipient["tokens"]))
+        chunks = [tokens[i:i + self.chunk_size] for i in range(0, len(tokens), self.chunk_size)]
+
+        if len(chunks) == 1:
+            # The common case (dozens of contacts) needs no thread hand-off
+            outcomes = [self._send_chunk(chunks[0], event)]
+        elif chunks:
+            self._ensure_started()
+            spans = current_spans()
+            outcomes = list(self._executor.map(lambda chunk: self._send_chunk(chunk, event, spans), chunks))
+        else:
+            outcomes = []
+        results = {token: result for chunk, outcome in zip(chunks, outcomes) for token, result in zip(chunk, outcome)}
+
+        self._remove([token for token, result in results.items() if result == UNREGISTERED])
+        queued = self._queue_retries(
+            [token for token, result in results.items() if result not in (None, UNREGISTERED)], event)
+
+        failures = sorted({result for result in results.values() if result not in (None, UNREGISTERED)})
+        if failures:
+            warning("SOS fan-out for %s: device sends failed: %s", event['username'], "; ".join(failures))
+
+        statuses = []
+        for recipient in recipients:
+            delivered = sum(1 for token in recipient["tokens"] if results.get(token, "not sent") is None)
+            # Clients get a short code; the error text (hosts, retry details) stays in the log
+            errors = [results.get(token, "not sent") for token in recipient["tokens"]]
+            errors = [UNREGISTERED if result == UNREGISTERED else FAILED for result in errors if result is not None]
+            if not recipient["tokens"]:
+                status = NO_DEVICE
+            elif not errors:
+                status = DELIVERED
+            else:
+                status = PARTIAL if delivered else FAILED
+            statuses.append({
+                "name": recipient["name"],
+                "status": status,
+                "devices": len(recipient["tokens"]),
+                "delivered": delivered,
+                "error": errors[0] if errors else None
+            })
+
+        delivered = sum(1 for result in results.values() if result is None)
+        self.fanouts += 1
+        self.chunks += len(chunks)
+        self.delivered += delivered
+        self.failed += len(results) - delivered
+        self.latency.record((time.perf_counter() - start) * 1000.0)
+        if tokens:
+            info("SOS fan-out for %s: %s/%s devices of %s contacts in %s chunks",
+                 event['username'], delivered, len(tokens), len(recipients), len(chunks))
+        return {
+            "recipients": len(recipients),
+            "reached": sum(1 for status in statuses if status["delivered"]),
+            "devices": len(tokens),
+            "delivered": delivered,
+            "failed": len(results) - delivered,
+            "queued_for_retry": queued,
+            "statuses": statuses
+        }
+
+    def stats(self):
+        return {
+            "fanouts": self.fanouts,
+            "chunks": self.chunks,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "removed_tokens": self.removed,
+            "queued_for_retry": self.queued,
+            "latency": self.latency.summary()
+        }
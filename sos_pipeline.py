@@ -0,0 +1,259 @@
+"""
+SOS Pipeline - Concurrent SOS dispatch
+The FCM send, the fan-out to the user's contacts and the sos_logs write run in parallel;
+failed sends go to the durable outbox for retry and SOS events that cannot reach MySQL
+are spooled to a local file shared by the worker processes
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from metrics import LatencyStats, bind_spans, current_spans
+from outbox import Outbox, PRIORITY_SOS
+from logger import info, error, warning
+
+try:
+    import fcntl
+except ImportError:
+    # No fork() either, so there is only ever one process using the spool
+    fcntl = None
+
+# Three stages per SOS (db, topic send, contact fan-out) share this pool
+SOS_WORKERS = int(os.getenv('SOS_WORKERS', 12))
+SOS_SPOOL_REPLAY_INTERVAL = float(os.getenv('SOS_SPOOL_REPLAY_INTERVAL', 30.0))
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+
+
+class SOSSpool:
+    """
+    Append-only JSON-lines file holding SOS events that could not be written to MySQL.
+    Pre-fork workers share the file: appends and replays hold an exclusive flock on a
+    sidecar lock file, so a replay never drops an event another worker appended meanwhile
+    and no two workers replay the same events. Lines that don't parse (a write cut short
+    by a crash) are moved to a .bad file instead of blocking the replay.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.quarantine_path = path + ".bad"
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path + ".lock", 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def append(self, event):
+        """Durably append one event (fsync'd before returning)"""
+        with self._locked():
+            with open(self.path, 'a+b') as f:
+                # After a write cut short by a crash, start a new line rather than extend the broken one
+                f.seek(0, os.SEEK_END)
+                prefix = b""
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    prefix = b"" if f.read(1) == b"\n" else b"\n"
+                f.write(prefix + (json.dumps(event) + "\n").encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def depth(self):
+        """Number of spooled events"""
+        if not os.path.exists(self.path):
+            return 0
+        with self._locked():
+            if not os.path.exists(self.path):
+                return 0
+            with open(self.path, encoding='utf-8') as f:
+                return sum(1 for line in f if line.strip())
+
+    def _read(self):
+        """Spooled events; lines that don't parse are appended to the quarantine file"""
+        events, bad = [], []
+        with open(self.path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = None
+                if isinstance(event, dict):
+                    events.append(event)
+                else:
+                    bad.append(line.rstrip("\n") + "\n")
+        if bad:
+            with open(self.quarantine_path, 'a', encoding='utf-8') as f:
+                f.writelines(bad)
+                f.flush()
+                os.fsync(f.fileno())
+            error("❌ Moved %s unreadable SOS spool lines to %s", len(bad), self.quarantine_path)
+        return events
+
+    def replay(self, write_fn):
+        """
+        Hand each spooled event to write_fn(event), keeping the ones that fail.
+        Returns the number of events replayed.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        with self._locked():
+            if not os.path.exists(self.path):
+                return 0
+            events = self._read()
+
+            remaining = []
+            for index, event in enumerate(events):
+                try:
+                    write_fn(event)
+                except Exception as e:
+                    warning("SOS spool replay stopped: %s", e)
+                    remaining = events[index:]
+                    break
+
+            if remaining:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.writelines(json.dumps(event) + "\n" for event in remaining)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            else:
+                os.remove(self.path)
+            return len(events) - len(remaining)
+
+
+class SOSPipeline:
+    """
+    Dispatches an SOS by running log_fn(event), send_fn(event) and fanout_fn(event) concurrently.
+    log_fn must raise if the event was not stored; send_fn must raise if the alert was not sent.
+    fanout_fn (optional) returns the per-contact delivery summary. Failed sends are retried
+    from outbox (by default the one at OUTBOX_PATH).
+    """
+
+    def __init__(self, log_fn, send_fn, fanout_fn=None, spool_path=None, outbox=None, workers=SOS_WORKERS):
+        self.log_fn = log_fn
+        self.send_fn = send_fn
+        self.fanout_fn = fanout_fn
+        self.spool = SOSSpool(spool_path or os.path.join(SPOOL_DIR, "sos_spool.jsonl"))
+        self.outbox = outbox or Outbox()
+        # Looked up on every attempt, so a replaced send_fn also applies to queued alerts
+        self.outbox.register("sos", lambda event: self.send_fn(event))
+        self.workers = workers
+        self.timings = {stage: LatencyStats() for stage in ("db", "fcm", "fanout", "total")}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Create the worker pool and background threads lazily (and again after a fork)"""
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sos")
+            threading.Thread(target=self._replay_loop, name="sos-spool", daemon=True).start()
+        self.outbox.start()
+
+    def start(self):
+        """Start the spool replay loop and the outbox (dispatch() does this on first use)"""
+        self._ensure_started()
+
+    def dispatch(self, username, name, sos_id=None):
+        """
+        Store, send and fan out one SOS concurrently.
+        sos_id identifies the alert (generated if not given); a failed send is queued once per id.
+        Returns: dict with the sos_id, logged, spooled, sent and queued_for_retry flags and the
+        contacts fan-out summary (None without a fanout_fn)
+        """
+        self._ensure_started()
+        event = self.new_event(username, name, sos_id)
+        start = time.perf_counter()
+
+        # Sub-spans recorded by the workers count towards this request
+        spans = current_spans()
+        db_future = self._executor.submit(self._timed, "db", self.log_fn, event, spans)
+        fcm_future = self._executor.submit(self._timed, "fcm", self.send_fn, event, spans)
+        fanout_future = self._executor.submit(self._timed, "fanout", self.fanout_fn, event, spans) \
+            if self.fanout_fn is not None else None
+
+        logged, db_error = db_future.result()
+        sent, fcm_error = fcm_future.result()
+        fanout = fanout_future.result() if fanout_future is not None else None
+        self.timings["total"].record((time.perf_counter() - start) * 1000.0)
+        return self.finish(event, (logged, db_error), (sent, fcm_error), fanout)
+
+    def new_event(self, username, name, sos_id=None):
+        return {"sos_id": sos_id or uuid.uuid4().hex, "username": username, "name": name,
+                "timestamp": datetime.now().isoformat()}
+
+    def finish(self, event, db, fcm, fanout=None):
+        """
+        Spool an event that was not stored and queue an alert that was not sent.
+        db, fcm and fanout are the (ok, result or error) outcomes of the three stages.
+        Returns: the dispatch() result
+        """
+        username = event["username"]
+        logged, db_error = db
+        sent, fcm_error = fcm
+        contacts = None
+        if fanout is not None:
+            fanned_out, contacts = fanout
+            if not fanned_out:
+                error("SOS fan-out failed for %s: %s", username, contacts)
+                # The error text stays in the log; clients only learn that it failed
+                contacts = {"error": "failed"}
+
+        spooled = False
+        if not logged:
+            error("SOS logging failed for %s, spooling locally: %s", username, db_error)
+            try:
+                self.spool.append(event)
+                spooled = True
+            except Exception as e:
+                error("SOS spool write failed for %s: %s", username, e)
+
+        queued = False
+        if not sent:
+            warning("Firebase error: %s", fcm_error)
+            try:
+                self.outbox.enqueue("sos", event, PRIORITY_SOS, dedup_key=f"sos:{event['sos_id']}")
+                queued = True
+            except Exception as e:
+                error("❌ SOS alert for %s could not be queued for retry: %s", username, e)
+
+        return {"sos_id": event["sos_id"], "logged": logged, "spooled": spooled, "sent": sent,
+                "queued_for_retry": queued, "contacts": contacts}
+
+    def _timed(self, stage, fn, event, spans=None):
+        """Run one stage, returning (True, its result) or (False, the error) and recording its latency"""
+        with bind_spans(spans), self.timings[stage].time():
+            try:
+                return True, fn(event)
+            except Exception as e:
+                return False, e
+
+    def _replay_loop(self):
+        while True:
+            time.sleep(SOS_SPOOL_REPLAY_INTERVAL)
+            try:
+                replayed = self.spool.replay(self.log_fn)
+                if replayed:
+                    info("Replayed %s spooled SOS events into MySQL", replayed)
+            except Exception as e:
+                error("SOS spool replay error: %s", e)
+
+    def stats(self):
+        """Per-stage p50/p99 timings and spool depth (the retry queue is reported by the outbox)"""
+        return {
+            "timings": {stage: stats.summary() for stage, stats in self.timings.items()},
+            "spool_depth": self.spool.depth()
+        }
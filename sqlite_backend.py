@@ -0,0 +1,547 @@
+"""
+SQLite Backend - Embedded single-file storage for small deployments and test runs
+Same functions and result shapes as the MySQL backend. The database runs in WAL mode
+(readers never block the writer); request threads share a small pool of connections
+and location batches are written in a single transaction.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from db_pool import SQLitePool, SQLITE_POOL_SIZE
+from logger import info, error
+from metrics import LatencyStats, span
+from routine_cache import RoutineCache, to_seconds
+from geo import parse_coordinates
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'safeher.db'))
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', 64))
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', 256))
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 5.0))
+LOCATION_ROLLUP_MINUTES = int(os.getenv('LOCATION_ROLLUP_MINUTES', 15))
+
+PRAGMAS = (
+    # WAL commits only fsync at checkpoints with synchronous=NORMAL; still crash-safe
+    'PRAGMA synchronous = NORMAL',
+    f'PRAGMA cache_size = -{SQLITE_CACHE_MB * 1024}',
+    f'PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA foreign_keys = ON'
+)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS user_details (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        email TEXT NOT NULL,
+        pin TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS contact_details (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL REFERENCES user_details(username),
+        name TEXT NOT NULL,
+        relation TEXT,
+        contact TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS emergency_contacts (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        "contact-name" TEXT NOT NULL,
+        "contact-phone" INTEGER NOT NULL,
+        "contact-relation" TEXT
+    );
+    CREATE TABLE IF NOT EXISTS location (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL REFERENCES user_details(username),
+        latitude REAL,
+        longitude REAL,
+        accuracy REAL,
+        timestamp TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_location_user_time ON location (username, timestamp, id);
+    CREATE INDEX IF NOT EXISTS idx_location_time ON location (timestamp);
+    CREATE TABLE IF NOT EXISTS sos_logs (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL REFERENCES user_details(username),
+        timestamp TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS routines (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL REFERENCES user_details(username) ON DELETE CASCADE,
+        title TEXT NOT NULL,
+        time_from TEXT NOT NULL,
+        time_to TEXT NOT NULL,
+        location TEXT,
+        days TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        latitude REAL,
+        longitude REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_routines_user ON routines (username);
+    CREATE TABLE IF NOT EXISTS places (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL REFERENCES user_details(username) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        latitude REAL,
+        longitude REAL,
+        radius REAL,
+        polygon TEXT,
+        created_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_places_user ON places (username);
+    CREATE TABLE IF NOT EXISTS device_tokens (
+        token TEXT PRIMARY KEY,
+        phone TEXT NOT NULL,
+        username TEXT,
+        platform TEXT,
+        updated_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_device_tokens_phone ON device_tokens (phone);
+'''
+
+name = "sqlite"
+
+# Per-statement latency, keyed by query name
+query_latency = {}
+_query_latency_lock = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(SQLITE_PATH, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# Autocommit connections shared by all threads; a thread waits for a free one up to the busy timeout
+_pool = SQLitePool(_connect, SQLITE_POOL_SIZE, SQLITE_BUSY_TIMEOUT)
+
+
+def init_db():
+    """Create tables and switch the database file to WAL mode"""
+    conn = _connect()
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.executescript(SCHEMA)
+        # Contacts saved before they had an owner keep NULL and are not returned to anyone
+        _add_column_if_missing(conn, 'emergency_contacts', 'username', 'TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_emergency_contacts_user ON emergency_contacts (username)')
+    finally:
+        conn.close()
+
+
+def _add_column_if_missing(conn, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists"""
+    if column not in [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]:
+        conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')
+        info("Added column %s.%s", table, column)
+
+
+def _latency(query_name):
+    stats = query_latency.get(query_name)
+    if stats is None:
+        with _query_latency_lock:
+            stats = query_latency.setdefault(query_name, LatencyStats())
+    return stats
+
+
+def query_stats():
+    return {query_name: stats.summary() for query_name, stats in sorted(query_latency.items())}
+
+
+def execute(query_name, sql, params=(), fetch=None):
+    """
+    Run one statement and time it under query_name.
+    fetch: None (returns rowcount), "one" or "all"
+    """
+    with span("db"), _latency(query_name).time():
+        with _pool.connection() as conn:
+            cursor = conn.execute(sql, params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            return cursor.rowcount
+
+
+def transaction():
+    """Explicit write transaction; BEGIN IMMEDIATE takes the write lock up front"""
+    return _pool.transaction()
+
+
+def _ts(value):
+    """DATETIME text as MySQL renders it ('YYYY-MM-DD HH:MM:SS')"""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def _time_of_day(value):
+    seconds = to_seconds(value)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def start():
+    """Open a pooled connection up front"""
+    with _pool.connection():
+        pass
+
+
+def ping():
+    execute('ping', 'SELECT 1', fetch="one")
+
+
+def stats():
+    with _pool.connection() as conn:
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        wal_autocheckpoint = conn.execute('PRAGMA wal_autocheckpoint').fetchone()[0]
+    return {
+        "sqlite": {
+            "path": SQLITE_PATH,
+            "journal_mode": journal_mode,
+            "wal_autocheckpoint": wal_autocheckpoint,
+            "pool": _pool.stats()
+        },
+        "db_queries": query_stats()
+    }
+
+
+def insert_user(username, password, email, pin):
+    """Insert a new user into user_details table"""
+    try:
+        execute('insert_user', 'INSERT INTO user_details (username, password, email, pin) VALUES (?, ?, ?, ?)',
+                (username, password, email, pin))
+    except Exception as e:
+        error("Error inserting user: %s", e)
+        raise
+
+
+def insert_contact(username, name, relation, contact):
+    """Insert a contact for a user"""
+    try:
+        # Same INT-sized phone column as the MySQL schema: keep the last 9 digits
+        phone_str = str(contact).replace('+', '').replace('-', '').replace(' ', '')
+        phone_int = int(phone_str[-9:]) if len(phone_str) > 9 else int(phone_str)
+        execute('insert_contact',
+                'INSERT INTO emergency_contacts (username, "contact-name", "contact-phone", "contact-relation") VALUES (?, ?, ?, ?)',
+                (username, name, phone_int, relation))
+    except Exception as e:
+        error("Error inserting contact: %s", e)
+        raise
+
+
+def insert_location(username, latitude, longitude, accuracy):
+    """Insert location data for a user"""
+    try:
+        execute('insert_location',
+                'INSERT INTO location (username, latitude, longitude, accuracy, timestamp) VALUES (?, ?, ?, ?, ?)',
+                (username, latitude, longitude, accuracy, _ts(datetime.now())))
+    except Exception as e:
+        error("Error inserting location: %s", e)
+        raise
+
+
+def insert_locations(rows):
+    """Insert many (username, latitude, longitude, accuracy, timestamp) rows in one transaction"""
+    if not rows:
+        return
+    try:
+        with span("db"), _latency('insert_locations').time(), transaction() as conn:
+            conn.executemany(
+                'INSERT INTO location (username, latitude, longitude, accuracy, timestamp) VALUES (?, ?, ?, ?, ?)',
+                [(u, lat, lng, acc, _ts(ts)) for u, lat, lng, acc, ts in rows]
+            )
+    except Exception as e:
+        error("Error inserting %s locations: %s", len(rows), e)
+        raise
+
+
+def insert_sos(username, timestamp=None):
+    """Log an SOS call (at the given time, or now)"""
+    try:
+        execute('insert_sos', 'INSERT INTO sos_logs (username, timestamp) VALUES (?, ?)',
+                (username, _ts(timestamp or datetime.now())))
+    except Exception as e:
+        error("Error logging SOS: %s", e)
+        raise
+
+
+def get_user(username):
+    """Get user details by username"""
+    try:
+        return execute('get_user', 'SELECT * FROM user_details WHERE username = ?', (username,), fetch="one")
+    except Exception as e:
+        error("Error getting user: %s", e)
+        raise
+
+
+def get_user_contacts(username):
+    """Get all contacts for a user"""
+    try:
+        results = execute('get_user_contacts',
+                          'SELECT "contact-name", "contact-relation", "contact-phone" FROM emergency_contacts '
+                          'WHERE username = ? ORDER BY id', (username,), fetch="all")
+        return [{"name": r[0], "relation": r[1], "contact": str(r[2])} for r in results]
+    except Exception as e:
+        error("Error getting contacts: %s", e)
+        raise
+
+
+def _location_row(r):
+    return {"id": r[0], "latitude": r[1], "longitude": r[2], "accuracy": r[3], "timestamp": r[4]}
+
+
+def _history_page(username, limit, before):
+    sql = 'SELECT id, latitude, longitude, accuracy, timestamp FROM location WHERE username = ?'
+    params = (username,)
+    if before is not None:
+        sql += ' AND (timestamp < ? OR (timestamp = ? AND id < ?))'
+        params += (_ts(before[0]), _ts(before[0]), before[1])
+    return execute('get_user_locations', sql + ' ORDER BY timestamp DESC, id DESC LIMIT ?', params + (limit,), fetch="all")
+
+
+def get_user_locations(username, limit=50, before=None):
+    """
+    Get one page of location history for a user, newest first.
+    before is an optional (timestamp, id) keyset cursor from the previous page.
+    """
+    try:
+        return [_location_row(r) for r in _history_page(username, limit, before)]
+    except Exception as e:
+        error("Error getting locations: %s", e)
+        raise
+
+
+def iter_user_locations(username, before=None, batch_size=500):
+    """Stream a user's full location history, newest first, one keyset page at a time"""
+    try:
+        while True:
+            rows = _history_page(username, batch_size, before)
+            for r in rows:
+                yield _location_row(r)
+            if len(rows) < batch_size:
+                return
+            before = (rows[-1][4], rows[-1][0])
+    except Exception as e:
+        error("Error streaming locations: %s", e)
+        raise
+
+
+def get_user_track(username, limit=500, before=None):
+    """Downsampled track (one point per LOCATION_ROLLUP_MINUTES bucket), aggregated on the fly"""
+    bucket_seconds = LOCATION_ROLLUP_MINUTES * 60
+    try:
+        rows = execute(
+            'get_user_track',
+            f"SELECT datetime(CAST(strftime('%s', timestamp) AS INTEGER) / {bucket_seconds} * {bucket_seconds}, 'unixepoch') AS bucket, "
+            'AVG(latitude), AVG(longitude), MIN(accuracy), COUNT(*) FROM location WHERE username = ? '
+            'GROUP BY bucket HAVING bucket < ? ORDER BY bucket DESC LIMIT ?',
+            (username, _ts(before) or '9999-12-31', limit),
+            fetch="all"
+        )
+        return [{"timestamp": r[0], "latitude": r[1], "longitude": r[2], "accuracy": r[3], "fixes": r[4]} for r in rows]
+    except Exception as e:
+        error("Error getting track: %s", e)
+        raise
+
+
+def get_hot_locations(since, limit=1000):
+    """Busiest ~100 m squares since a time across all users: (lat, lng, fixes) rows, busiest first"""
+    try:
+        return execute(
+            'get_hot_locations',
+            'SELECT ROUND(latitude, 3) AS lat, ROUND(longitude, 3) AS lng, COUNT(*) AS fixes FROM location '
+            'WHERE timestamp >= ? GROUP BY lat, lng ORDER BY fixes DESC LIMIT ?',
+            (_ts(since), limit),
+            fetch="all"
+        )
+    except Exception as e:
+        error("Error getting hot locations: %s", e)
+        raise
+
+
+def insert_routine(username, title, time_from, time_to, location, days):
+    """Insert a routine for a user; "lat,lng" locations are also stored as numeric coordinates"""
+    try:
+        coordinates = parse_coordinates(location) or (None, None)
+        now = _ts(datetime.now())
+        execute(
+            'insert_routine',
+            'INSERT INTO routines (username, title, time_from, time_to, location, days, latitude, longitude, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (username, title, _time_of_day(time_from), _time_of_day(time_to), location, days,
+             coordinates[0], coordinates[1], now, now)
+        )
+        routine_cache.invalidate(username)
+        return True, "Routine saved successfully"
+    except Exception as e:
+        error("Error inserting routine: %s", e)
+        return False, str(e)
+
+
+def get_user_routines(username):
+    """Get all routines for a user"""
+    try:
+        results = execute(
+            'get_user_routines',
+            'SELECT id, title, time_from, time_to, location, days FROM routines WHERE username = ? ORDER BY time_from ASC',
+            (username,), fetch="all"
+        )
+        return [{"id": r[0], "title": r[1], "timeFrom": r[2], "timeTo": r[3], "location": r[4], "days": r[5]} for r in results]
+    except Exception as e:
+        error("Error getting routines: %s", e)
+        return []
+
+
+def get_routine_owner(routine_id):
+    """Username a routine belongs to (None if there is no such routine)"""
+    row = execute('get_routine_owner', 'SELECT username FROM routines WHERE id = ?', (routine_id,), fetch="one")
+    return row[0] if row else None
+
+
+def delete_routine(routine_id):
+    """Delete a routine by ID"""
+    try:
+        execute('delete_routine', 'DELETE FROM routines WHERE id = ?', (routine_id,))
+        routine_cache.invalidate_routine(routine_id)
+        return True, "Routine deleted successfully"
+    except Exception as e:
+        error("Error deleting routine: %s", e)
+        return False, str(e)
+
+
+def _load_routines(username):
+    """Fetch a user's routines for the routine cache"""
+    results = execute(
+        'load_routines',
+        'SELECT id, title, time_from, time_to, location, days, latitude, longitude FROM routines WHERE username = ?',
+        (username,), fetch="all"
+    )
+    return [{"id": r[0], "title": r[1], "time_from": r[2], "time_to": r[3], "location": r[4], "days": r[5],
+             "latitude": r[6], "longitude": r[7]} for r in results]
+
+
+routine_cache = RoutineCache(_load_routines)
+
+
+def get_routine_schedule(username):
+    """The user's cached RoutineSchedule"""
+    return routine_cache.get(username)
+
+
+def invalidate_routine_schedule(username):
+    """Drop this process's cached schedule (another worker changed the user's routines)"""
+    routine_cache.invalidate(username)
+
+
+def check_location_against_routine(username, current_lat, current_lon):
+    """
+    Check if user's current location matches their routine location for current time.
+    Returns: (is_at_correct_location, routine_info, distance_km)
+    """
+    try:
+        return routine_cache.get(username).check_location(float(current_lat), float(current_lon))
+    except Exception as e:
+        error("Error checking location against routine: %s", e)
+        return None, None, None
+
+
+def _place_row(r):
+    return {"id": r[0], "name": r[1], "latitude": r[2], "longitude": r[3], "radius": r[4],
+            "polygon": json.loads(r[5]) if r[5] else None}
+
+
+def insert_place(username, name, latitude, longitude, radius=None, polygon=None):
+    """Save a place fence: a circle of radius meters, or a polygon of [lat, lng] vertices"""
+    try:
+        execute('insert_place',
+                'INSERT INTO places (username, name, latitude, longitude, radius, polygon, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (username, name, latitude, longitude, radius, json.dumps(polygon) if polygon else None, _ts(datetime.now())))
+        return True, "Place saved successfully"
+    except Exception as e:
+        error("Error inserting place: %s", e)
+        return False, str(e)
+
+
+def get_user_places(username):
+    """Get all saved places for a user"""
+    try:
+        rows = execute('get_user_places',
+                       'SELECT id, name, latitude, longitude, radius, polygon FROM places WHERE username = ? ORDER BY id',
+                       (username,), fetch="all")
+        return [_place_row(r) for r in rows]
+    except Exception as e:
+        error("Error getting places: %s", e)
+        raise
+
+
+def get_place_owner(place_id):
+    """Username a saved place belongs to (None if there is no such place)"""
+    row = execute('get_place_owner', 'SELECT username FROM places WHERE id = ?', (place_id,), fetch="one")
+    return row[0] if row else None
+
+
+def delete_place(place_id):
+    """Delete a saved place by ID"""
+    try:
+        execute('delete_place', 'DELETE FROM places WHERE id = ?', (place_id,))
+        return True, "Place deleted successfully"
+    except Exception as e:
+        error("Error deleting place: %s", e)
+        return False, str(e)
+
+
+def insert_device_token(token, phone, username=None, platform=None):
+    """Register (or move) a device's FCM token under a phone number key (validators.phone_key)"""
+    try:
+        execute('insert_device_token',
+                'INSERT INTO device_tokens (token, phone, username, platform, updated_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(token) DO UPDATE SET phone = excluded.phone, username = excluded.username, '
+                'platform = excluded.platform, updated_at = excluded.updated_at',
+                (token, phone, username, platform, _ts(datetime.now())))
+        return True, "Device registered successfully"
+    except Exception as e:
+        error("Error registering device token: %s", e)
+        return False, str(e)
+
+
+def get_device_tokens(phones):
+    """FCM tokens for a list of phone keys: {phone: [tokens]}"""
+    phones = list(phones)
+    if not phones:
+        return {}
+    try:
+        rows = execute('get_device_tokens',
+                       f'SELECT phone, token FROM device_tokens WHERE phone IN ({", ".join("?" * len(phones))})',
+                       tuple(phones), fetch="all")
+        tokens = {}
+        for phone, token in rows:
+            tokens.setdefault(phone, []).append(token)
+        return tokens
+    except Exception as e:
+        error("Error getting device tokens: %s", e)
+        raise
+
+
+def delete_device_tokens(tokens):
+    """Remove tokens FCM reported as unregistered"""
+    tokens = list(tokens)
+    if not tokens:
+        return True, "No tokens to delete"
+    try:
+        execute('delete_device_tokens', f'DELETE FROM device_tokens WHERE token IN ({", ".join("?" * len(tokens))})',
+                tuple(tokens))
+        return True, f"Deleted {len(tokens)} device tokens"
+    except Exception as e:
+        error("Error deleting device tokens: %s", e)
+        return False, str(e)
+
+
+# Initialize database on import
+try:
+    init_db()
+    info("SQLite database initialized at %s", SQLITE_PATH)
+except Exception as e:
+    error("SQLite initialization error: %s", e)
@@ -0,0 +1,43 @@
+"""
+Storage - Selects the database engine behind db_adapter and app.py
+  mysql   database.py + location_store.py (default)
+  sqlite  sqlite_backend.py, a single-file embedded database for small deployments and tests
+Only the selected engine's module (and driver) is imported.
+"""
+import importlib
+import os
+from logger import info
+
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql').lower()
+
+BACKENDS = {
+    'mysql': 'mysql_backend',
+    'sqlite': 'sqlite_backend'
+}
+
+# Functions every backend module provides
+INTERFACE = (
+    'insert_user', 'insert_contact', 'insert_location', 'insert_locations', 'insert_sos',
+    'get_user', 'get_user_contacts',
+    'get_user_locations', 'iter_user_locations', 'get_user_track', 'get_hot_locations',
+    'insert_routine', 'get_user_routines', 'get_routine_owner', 'delete_routine', 'check_location_against_routine',
+    'get_routine_schedule', 'invalidate_routine_schedule', 'insert_place', 'get_user_places', 'get_place_owner',
+    'delete_place',
+    'insert_device_token', 'get_device_tokens', 'delete_device_tokens',
+    'start', 'ping', 'stats'
+)
+
+
+def load_backend(name=DB_BACKEND):
+    """Import and check the backend module for name"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown DB_BACKEND '{name}' (expected one of: {', '.join(BACKENDS)})")
+    backend = importlib.import_module(BACKENDS[name])
+    missing = [fn for fn in INTERFACE if not callable(getattr(backend, fn, None))]
+    if missing:
+        raise ImportError(f"Storage backend '{name}' is missing: {', '.join(missing)}")
+    info("Storage backend: %s", name)
+    return backend
+
+
+backend = load_backend()
@@ -0,0 +1,152 @@
+"""
+SAFEHER - ASGI async view tests
+Runs without Firebase or MySQL: the app is served in-process through httpx against a
+throwaway SQLite database, with stand-ins for the FCM sends
+Usage: python -m pytest test_asgi.py  (or python test_asgi.py)
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+# Select the embedded backend and keep the shared spool files out of the project tree
+_workdir = tempfile.mkdtemp()
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_workdir, "safeher_test.db")
+os.environ["SPOOL_DIR"] = os.path.join(_workdir, "spool")
+
+import httpx
+import app as api
+from asgi import BoundedWsgiToAsgi, create_asgi_app
+from async_views import AsyncViews
+from db_adapter import log_user, log_contact, register_device, location_buffer
+
+USERNAME = "asgi_tester"
+log_user(USERNAME, "secret", "asgi_tester@example.com", "1234")
+log_contact(USERNAME, "Mum", "Mother", "9845012345")
+register_device("asgi_test_token_" + "x" * 120, "9845012345")
+
+
+class FakeFCM:
+    """Stand-in for the topic send and the multicast send, each taking delay seconds"""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.topic = []
+        self.multicast = []
+
+    def send(self, event):
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("FCM unreachable")
+        self.topic.append(event["sos_id"])
+
+    def send_multicast(self, tokens, event):
+        time.sleep(self.delay)
+        self.multicast.append(tokens)
+        return [None] * len(tokens)
+
+
+def use_fcm(fcm):
+    api.sos_pipeline.send_fn = fcm.send
+    api.sos_fanout.send_fn = fcm.send_multicast
+
+
+def run(requests, asgi_app=None):
+    """Send (method, path, json) requests concurrently; returns the responses in order"""
+    async def main():
+        transport = httpx.ASGITransport(app=asgi_app or create_asgi_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://safeher") as client:
+            return await asyncio.gather(*[client.request(method, path, json=body) for method, path, body in requests])
+    return asyncio.run(main())
+
+
+def test_analyze_answers_like_the_flask_view():
+    body = {"username": USERNAME, "lat": 12.97, "lng": 77.59, "accuracy": 8}
+    response, = run([("POST", "/analyze", body)])
+    expected = api.app.test_client().post("/analyze", json=body)
+    assert response.status_code == expected.status_code == 200
+    result, flask_result = response.json(), expected.get_json()
+    result.pop("time"), flask_result.pop("time")
+    assert result == flask_result and result["location_logged"]
+
+    for bad in ({"lat": 12.9, "lng": 77.5}, {"username": USERNAME}, {"username": USERNAME, "lat": 95, "lng": 0}):
+        response, = run([("POST", "/analyze", bad)])
+        assert response.json() == api.app.test_client().post("/analyze", json=bad).get_json()
+        assert response.status_code == 400
+
+
+def test_body_that_is_not_a_json_object_gets_flasks_error():
+    async def main():
+        transport = httpx.ASGITransport(app=create_asgi_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://safeher") as client:
+            return await client.post("/analyze", content=b"{not json", headers={"Content-Type": "application/json"})
+    response = asyncio.run(main())
+    assert response.status_code == 400 and response.json()["error"] == "Bad Request"
+
+
+def test_sos_waits_hold_no_request_thread():
+    fcm = FakeFCM(delay=0.2)
+    use_fcm(fcm)
+    # One thread for the bridged Flask views: an SOS that needed one would have to queue
+    asgi_app = AsyncViews(api, BoundedWsgiToAsgi(api.app, threads=1))
+    # Warm up the pools and the pipeline so the timing covers only the waits
+    run([("POST", "/sos", {"username": USERNAME})], asgi_app)
+    fcm.topic.clear(), fcm.multicast.clear()
+    start = time.perf_counter()
+    responses = run([("POST", "/sos", {"username": USERNAME, "name": "Tester"}) for _ in range(10)], asgi_app)
+    elapsed = time.perf_counter() - start
+    assert [r.status_code for r in responses] == [200] * 10
+    # Queued on one thread they would take 2 s
+    assert elapsed < 1.5, f"10 SOS with 0.2 s sends took {elapsed:.2f} s"
+    result = responses[0].json()
+    assert result["logged"] and result["sent"] and result["contacts"]["delivered"] == 1
+    assert len(fcm.topic) == 10 and len(fcm.multicast) == 10
+
+
+def test_failed_sos_send_is_queued_for_retry():
+    use_fcm(FakeFCM(fail=True))
+    response, = run([("POST", "/sos", {"username": USERNAME, "sos_id": "asgi-alert-0001"})])
+    assert response.status_code == 202
+    result = response.json()
+    assert result["queued_for_retry"] and result["logged"] and result["sos_id"] == "asgi-alert-0001"
+    response, = run([("POST", "/sos", {"username": USERNAME, "sos_id": "bad id"})])
+    assert response.status_code == 400
+
+
+def test_history_pages_and_stream_match_the_flask_views():
+    fixes = [{"username": USERNAME, "lat": 12.9 + i / 1000, "lng": 77.5, "accuracy": 5} for i in range(12)]
+    run([("POST", "/analyze", fix) for fix in fixes])
+    location_buffer.flush()
+    flask = api.app.test_client()
+
+    for path in (f"/locations/{USERNAME}?limit=5", f"/locations/{USERNAME}/track", f"/locations/{USERNAME}?limit=0"):
+        response, = run([("GET", path, None)])
+        expected = flask.get(path)
+        assert (response.status_code, response.json()) == (expected.status_code, expected.get_json())
+
+    page, = run([("GET", f"/locations/{USERNAME}?limit=5", None)])
+    cursor = page.json()["next_cursor"]
+    response, = run([("GET", f"/locations/{USERNAME}?limit=5&before={cursor}", None)])
+    assert response.json() == flask.get(f"/locations/{USERNAME}?limit=5&before={cursor}").get_json()
+
+    response, = run([("GET", f"/locations/{USERNAME}?format=ndjson", None)])
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows == [json.loads(line) for line in flask.get(f"/locations/{USERNAME}?format=ndjson").data.splitlines()]
+    assert len(rows) >= 12
+
+
+def test_other_routes_are_served_by_flask():
+    response, = run([("GET", "/ping", None)])
+    assert response.status_code == 200 and response.json()["database"] == "Connected"
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
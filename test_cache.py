@@ -0,0 +1,130 @@
+"""
+SAFEHER - Cache tests
+Runs without MySQL or Redis: the Redis backend is exercised against a local stand-in
+Usage: python -m pytest test_cache.py  (or python test_cache.py)
+"""
+
+import fnmatch
+import time
+from cache import Cache, MemoryBackend, RedisBackend
+
+
+class LocalRedis:
+    """In-process stand-in for the redis.Redis methods RedisBackend uses"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (value.encode(), time.monotonic() + ex if ex else None)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match="*"):
+        return [k for k in list(self.data) if fnmatch.fnmatch(k, match)]
+
+
+def counting_loader(value):
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return value
+    return loader, calls
+
+
+def test_read_through_hits_after_first_load():
+    cache = Cache(MemoryBackend())
+    loader, calls = counting_loader({"username": "sarah_doe"})
+    assert cache.get_or_load("user:sarah_doe", loader) == {"username": "sarah_doe"}
+    assert cache.get_or_load("user:sarah_doe", loader) == {"username": "sarah_doe"}
+    assert len(calls) == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_none_is_not_cached():
+    cache = Cache(MemoryBackend())
+    loader, calls = counting_loader(None)
+    cache.get_or_load("user:ghost", loader)
+    cache.get_or_load("user:ghost", loader)
+    assert len(calls) == 2
+
+
+def test_ttl_expiry():
+    cache = Cache(MemoryBackend(), default_ttl=0.05)
+    loader, calls = counting_loader([1])
+    cache.get_or_load("contacts:a", loader)
+    time.sleep(0.1)
+    cache.get_or_load("contacts:a", loader)
+    assert len(calls) == 2
+
+
+def test_lru_eviction_counts():
+    cache = Cache(MemoryBackend(max_entries=2))
+    for key in ("a", "b"):
+        cache.get_or_load(key, lambda: key)
+    cache.get_or_load("a", lambda: "a")  # a becomes most recently used
+    cache.get_or_load("c", lambda: "c")  # evicts b
+    assert cache.stats()["evictions"] == 1
+    loader, calls = counting_loader("b")
+    cache.get_or_load("b", loader)
+    assert len(calls) == 1
+
+
+def test_invalidation():
+    cache = Cache(MemoryBackend())
+    cache.get_or_load("contacts:a", lambda: [1])
+    cache.get_or_load("contacts:b", lambda: [2])
+    cache.get_or_load("user:a", lambda: {"username": "a"})
+    cache.invalidate_prefix("contacts:")
+    cache.invalidate("user:a")
+    assert cache.backend.size() == 0
+
+
+def test_load_racing_an_invalidation_is_not_cached():
+    cache = Cache(MemoryBackend())
+
+    def load_then_raced():
+        # The contact list changes (and is invalidated) while this load is in flight
+        cache.invalidate("contacts:a")
+        return ["old"]
+
+    assert cache.get_or_load("contacts:a", load_then_raced) == ["old"]
+    assert cache.get_or_load("contacts:a", lambda: ["new"]) == ["new"]
+
+
+def test_redis_backend_round_trips_json():
+    cache = Cache(RedisBackend(LocalRedis()))
+    loader, calls = counting_loader([{"name": "Mom", "contact": "9876543210"}])
+    first = cache.get_or_load("contacts:sarah_doe", loader)
+    second = cache.get_or_load("contacts:sarah_doe", loader)
+    assert first == second and len(calls) == 1
+    cache.invalidate_prefix("contacts:")
+    cache.get_or_load("contacts:sarah_doe", loader)
+    assert len(calls) == 2
+
+
+def test_backend_errors_fall_through_to_loader():
+    class BrokenRedis(LocalRedis):
+        def get(self, key):
+            raise ConnectionError("redis down")
+
+    cache = Cache(RedisBackend(BrokenRedis()))
+    assert cache.get_or_load("user:a", lambda: {"username": "a"}) == {"username": "a"}
+    assert cache.stats()["errors"] == 1
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,259 @@
+"""
+SAFEHER - Connection pool tests
+Runs without MySQL: connections come from a local stand-in server that can be
+taken down and brought back, and SQLite pools use a throwaway file
+Usage: python -m pytest test_db_pool.py  (or python test_db_pool.py)
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import pytest
+from db_pool import ConnectionPool, SQLitePool, PoolExhaustedError, PoolUnavailableError
+
+
+class LocalMySQL:
+    """Stand-in server: hands out FakeConnections and can simulate an outage"""
+
+    def __init__(self):
+        self.up = True
+        self.connections = []
+
+    def connect(self):
+        if not self.up:
+            raise ConnectionRefusedError("Can't connect to MySQL server")
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+    def restart(self):
+        """Drop every open connection, as a server restart would"""
+        for conn in self.connections:
+            conn.dead = True
+
+    def open_count(self):
+        return sum(1 for c in self.connections if not c.closed)
+
+
+class FakeConnection:
+    """The parts of a mysql.connector connection the pool touches"""
+
+    def __init__(self, server):
+        self.server = server
+        self.dead = False
+        self.closed = False
+        self.in_transaction = False
+        self.pings = 0
+        self.rollbacks = 0
+
+    def ping(self):
+        self.pings += 1
+        if self.dead or not self.server.up:
+            raise ConnectionError("Lost connection to MySQL server")
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(server, **kwargs):
+    options = {"min_size": 2, "max_size": 4, "timeout": 0.2, "validate_after": 60,
+               "idle_timeout": 60, "check_interval": 60, "background": False}
+    options.update(kwargs)
+    return ConnectionPool(server.connect, **options)
+
+
+def test_prewarm_opens_min_size():
+    server = LocalMySQL()
+    pool = make_pool(server)
+    assert pool.prewarm() == 2
+    assert pool.stats()["idle"] == 2
+    assert server.open_count() == 2
+
+
+def test_connections_are_reused():
+    server = LocalMySQL()
+    pool = make_pool(server)
+    for _ in range(10):
+        conn = pool.acquire()
+        conn.close()
+    assert pool.stats()["created"] == 1
+    assert pool.stats()["wait"]["count"] == 10
+
+
+def test_open_transaction_is_rolled_back_on_release():
+    server = LocalMySQL()
+    pool = make_pool(server)
+    conn = pool.acquire()
+    conn.in_transaction = True
+    conn.close()
+    assert not server.connections[0].in_transaction
+    assert server.connections[0].rollbacks == 1
+
+
+def test_exhaustion_times_out_and_is_counted():
+    server = LocalMySQL()
+    pool = make_pool(server, max_size=2)
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(PoolExhaustedError):
+        pool.acquire(timeout=0.05)
+    stats = pool.stats()
+    assert stats["exhausted"] == 1 and stats["in_use"] == 2 and stats["peak_in_use"] == 2
+    for conn in held:
+        conn.close()
+
+
+def test_waiter_gets_released_connection():
+    server = LocalMySQL()
+    pool = make_pool(server, max_size=1, timeout=2)
+    held = pool.acquire()
+    threading.Timer(0.05, held.close).start()
+    conn = pool.acquire()
+    assert conn._conn is server.connections[0]
+    assert pool.stats()["wait"]["max_ms"] >= 40
+    conn.close()
+
+
+def test_stale_idle_connection_is_validated_and_replaced():
+    server = LocalMySQL()
+    pool = make_pool(server, validate_after=0)
+    pool.acquire().close()
+    server.restart()
+    conn = pool.acquire()
+    assert conn._conn is server.connections[1]
+    assert server.connections[0].closed
+    assert pool.stats()["validation_failures"] == 1
+    conn.close()
+
+
+def test_outage_fails_fast_without_connecting():
+    server = LocalMySQL()
+    pool = make_pool(server)
+    server.up = False
+    with pytest.raises(PoolUnavailableError):
+        pool.acquire()
+    attempts = len(server.connections)
+    for _ in range(5):
+        with pytest.raises(PoolUnavailableError):
+            pool.acquire()
+    # No per-request reconnects while the pool is down
+    assert len(server.connections) == attempts
+    stats = pool.stats()
+    assert stats["state"] == "down" and stats["outages"] == 1 and stats["unavailable"] == 5
+
+
+def test_maintenance_recovers_and_prewarms_after_outage():
+    server = LocalMySQL()
+    pool = make_pool(server, validate_after=0)
+    pool.prewarm()
+    server.up = False
+    time.sleep(0.01)
+    with pytest.raises(PoolUnavailableError):
+        pool.acquire()
+    assert pool.maintain() is None
+    server.up = True
+    assert pool.maintain() == pool.check_interval
+    stats = pool.stats()
+    assert stats["state"] == "up" and stats["idle"] == 2
+    pool.acquire().close()
+
+
+def test_background_validation_drops_dead_idle_connections():
+    server = LocalMySQL()
+    pool = make_pool(server, validate_after=0)
+    pool.prewarm()
+    server.restart()
+    time.sleep(0.01)
+    pool.maintain()
+    assert pool.stats()["validation_failures"] == 2
+    assert server.open_count() == 2 and pool.stats()["idle"] == 2
+
+
+def test_idle_surplus_shrinks_back_to_min_size():
+    server = LocalMySQL()
+    pool = make_pool(server, idle_timeout=0)
+    held = [pool.acquire() for _ in range(4)]
+    for conn in held:
+        conn.close()
+    time.sleep(0.01)
+    pool.maintain()
+    assert pool.stats()["open"] == 2
+    assert server.open_count() == 2
+
+
+def test_background_thread_prewarms():
+    server = LocalMySQL()
+    pool = make_pool(server, background=True)
+    pool.start()
+    deadline = time.monotonic() + 2
+    while pool.stats()["idle"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.stats()["idle"] == 2
+    pool.close()
+    assert server.open_count() == 0
+
+
+def sqlite_pool(size, timeout=0.2):
+    path = os.path.join(tempfile.mkdtemp(), "pool.db")
+    opened = []
+
+    def connect():
+        conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        opened.append(conn)
+        return conn
+
+    return SQLitePool(connect, size, timeout), opened
+
+
+def test_sqlite_pool_shares_connections_across_threads():
+    pool, opened = sqlite_pool(2, timeout=5)
+
+    def request():
+        with pool.connection() as conn:
+            conn.execute('SELECT 1')
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=request) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(opened) == 2
+    assert pool.stats()["idle"] == 2 and pool.stats()["exhausted"] == 0
+
+
+def test_sqlite_pool_exhaustion_times_out():
+    pool, _ = sqlite_pool(1, timeout=0.05)
+    with pool.connection():
+        with pytest.raises(PoolExhaustedError):
+            with pool.connection():
+                pass
+    assert pool.stats()["exhausted"] == 1
+    with pool.connection() as conn:
+        assert conn.execute('SELECT 1').fetchone() == (1,)
+
+
+def test_sqlite_pool_transaction_rolls_back_on_error():
+    pool, _ = sqlite_pool(1)
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE t (x INTEGER)')
+    with pytest.raises(ValueError):
+        with pool.transaction() as conn:
+            conn.execute('INSERT INTO t VALUES (1)')
+            raise ValueError("abort")
+    with pool.transaction() as conn:
+        conn.execute('INSERT INTO t VALUES (2)')
+    with pool.connection() as conn:
+        assert conn.execute('SELECT x FROM t').fetchall() == [(2,)] and not conn.in_transaction
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
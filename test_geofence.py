@@ -0,0 +1,102 @@
+"""
+SAFEHER - Geofence tests
+Runs without a database: fences come from in-memory loaders, and two engines on the same
+state file stand in for two pre-fork worker processes
+Usage: python -m pytest test_geofence.py  (or python test_geofence.py)
+"""
+
+import os
+import tempfile
+from datetime import datetime
+from geofence import GeofenceEngine, FenceState
+from routine_cache import RoutineSchedule
+
+HOME = {"id": 1, "name": "Home", "latitude": 12.97, "longitude": 77.59, "radius": 200}
+OFFICE = {"id": 2, "name": "Office", "latitude": 12.93, "longitude": 77.62, "radius": 200}
+AWAY = (12.99, 77.70)
+
+
+class Places:
+    """Saved places per user, with a count of loads"""
+
+    def __init__(self, places):
+        self.places = list(places)
+        self.loads = 0
+
+    def __call__(self, username):
+        self.loads += 1
+        return list(self.places)
+
+
+def worker_pair(places):
+    path = os.path.join(tempfile.mkdtemp(), "geofence.db")
+    schedule = RoutineSchedule([])
+    return [GeofenceEngine(lambda username: schedule, places, state=FenceState(path)) for _ in range(2)]
+
+
+def ids(events):
+    return [fence["id"] for fence in events]
+
+
+def test_enter_and_exit_are_reported_once_across_workers():
+    first, second = worker_pair(Places([HOME]))
+    assert ids(first.evaluate("sarah_doe", *AWAY)["entered"]) == []
+    # Each fix lands on whichever worker; every transition is reported exactly once
+    assert ids(second.evaluate("sarah_doe", 12.97, 77.59)["entered"]) == ["place:1"]
+    assert ids(first.evaluate("sarah_doe", 12.9701, 77.5901)["entered"]) == []
+    assert ids(second.evaluate("sarah_doe", *AWAY)["exited"]) == ["place:1"]
+    assert ids(first.evaluate("sarah_doe", *AWAY)["exited"]) == []
+    assert first.entered + second.entered == 1 and first.exited + second.exited == 1
+
+
+def test_invalidation_reaches_the_other_worker():
+    places = Places([HOME])
+    first, second = worker_pair(places)
+    second.evaluate("sarah_doe", *AWAY)
+    loads = places.loads
+    places.places.append(OFFICE)
+    # The write was handled by the first worker; the second reloads on its next fix
+    first.invalidate("sarah_doe")
+    assert ids(second.evaluate("sarah_doe", 12.93, 77.62)["entered"]) == ["place:2"]
+    assert places.loads == loads + 1
+
+
+def test_deleted_place_is_not_reported_as_exited():
+    places = Places([HOME])
+    first, second = worker_pair(places)
+    first.evaluate("sarah_doe", 12.97, 77.59)
+    places.places = []
+    first.invalidate("sarah_doe")
+    result = second.evaluate("sarah_doe", 12.97, 77.59)
+    assert result["inside"] == [] and result["exited"] == []
+
+
+def test_invalidating_one_user_leaves_the_others_cached():
+    places = Places([HOME])
+    first, second = worker_pair(places)
+    for username in ("sarah_doe", "anna_roy", "mia_khan"):
+        second.evaluate(username, *AWAY)
+    loads = places.loads
+    first.invalidate("sarah_doe")
+    for username in ("sarah_doe", "anna_roy", "mia_khan"):
+        second.evaluate(username, *AWAY)
+    assert places.loads == loads + 1
+
+
+def test_routine_with_invalid_times_is_skipped():
+    commute = {"id": 1, "title": "Commute", "time_from": "08:00", "time_to": "09:00", "days": "", "latitude": 12.97,
+               "longitude": 77.59}
+    schedule = RoutineSchedule([{"id": 2, "title": "Gym", "time_from": "9am", "time_to": "", "days": ""}, commute,
+                                {"id": 3, "title": "Class", "time_from": None, "time_to": "10:00", "days": ""}])
+    assert schedule.routine_ids == {1}
+    assert schedule.active(datetime(2026, 1, 5, 8, 30)) == [commute]
+    state = FenceState(os.path.join(tempfile.mkdtemp(), "geofence.db"))
+    engine = GeofenceEngine(lambda username: schedule, Places([]), state=state)
+    assert ids(engine.evaluate("sarah_doe", 12.97, 77.59, when=datetime(2026, 1, 5, 8, 30))["inside"]) == ["routine:1"]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,105 @@
+"""
+SAFEHER - Location buffer tests
+Runs without a database: batches go to a fake writer that can be made to fail
+Usage: python -m pytest test_location_buffer.py  (or python test_location_buffer.py)
+"""
+
+import threading
+import time
+from location_buffer import LocationBuffer
+
+
+class FakeWriter:
+    """Records written batches; fails the first `failures` calls"""
+
+    def __init__(self, failures=0, on_call=None):
+        self.failures = failures
+        self.on_call = on_call
+        self.batches = []
+        self.calls = 0
+        self.written = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self._lock:
+            self.calls += 1
+            if self.on_call is not None:
+                self.on_call(batch)
+            if self.calls <= self.failures:
+                raise ConnectionError("Can't connect to MySQL server")
+            self.batches.append(list(batch))
+        self.written.set()
+
+    def rows(self):
+        return [row for batch in self.batches for row in batch]
+
+
+def rows(start, count):
+    return [("sarah_doe", 12.97, 77.59, 5, i) for i in range(start, start + count)]
+
+
+def test_full_batch_is_written_without_waiting_for_the_interval():
+    writer = FakeWriter()
+    buffer = LocationBuffer(writer, batch_size=10, flush_interval=60)
+    assert buffer.add_many(rows(0, 10)) == 10
+    assert writer.written.wait(2)
+    assert writer.batches == [rows(0, 10)] and buffer.depth() == 0
+    buffer.stop()
+
+
+def test_partial_batch_is_written_after_the_interval():
+    writer = FakeWriter()
+    buffer = LocationBuffer(writer, batch_size=100, flush_interval=0.1)
+    start = time.perf_counter()
+    buffer.add_many(rows(0, 3))
+    assert writer.written.wait(2)
+    assert writer.rows() == rows(0, 3) and time.perf_counter() - start >= 0.05
+    buffer.stop()
+
+
+def test_failed_write_is_requeued_in_order():
+    writer = FakeWriter(failures=1)
+    buffer = LocationBuffer(writer, batch_size=100, flush_interval=60)
+    buffer.add_many(rows(0, 3))
+    assert not buffer.flush()
+    assert buffer.depth() == 3 and buffer.stats()["flush_failures"] == 1
+    buffer.add_many(rows(3, 2))
+    assert buffer.flush()
+    assert writer.rows() == rows(0, 5)
+    buffer.stop()
+
+
+def test_overflow_after_a_failed_write_drops_the_oldest_rows():
+    buffer = None
+
+    def fill(batch):
+        # Fixes keep arriving while the write is failing
+        if len(batch) == 4:
+            buffer.add_many(rows(4, 3))
+
+    writer = FakeWriter(failures=1, on_call=fill)
+    buffer = LocationBuffer(writer, batch_size=100, flush_interval=60, max_queue=5)
+    assert buffer.add_many(rows(0, 4)) == 4
+    assert not buffer.flush()
+    assert buffer.stats()["rows_dropped"] == 2
+    # A full buffer refuses new rows rather than dropping queued ones
+    assert not buffer.add(rows(7, 1)[0])
+    assert buffer.flush()
+    assert writer.rows() == rows(2, 5)
+    buffer.stop()
+
+
+def test_stop_writes_what_is_still_queued():
+    writer = FakeWriter()
+    buffer = LocationBuffer(writer, batch_size=100, flush_interval=60)
+    buffer.add_many(rows(0, 3))
+    buffer.stop()
+    assert writer.rows() == rows(0, 3) and buffer.depth() == 0
+    assert buffer.stats()["rows_flushed"] == 3
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
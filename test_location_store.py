@@ -0,0 +1,154 @@
+"""
+SAFEHER - Location rotation tests
+Runs without MySQL: location_store's statements run on a throwaway SQLite database
+through a stand-in for database.execute that adapts the few MySQL-only ones
+Usage: python -m pytest test_location_store.py  (or python test_location_store.py)
+"""
+
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+import location_store
+from location_store import ArchiveTables, LOCATION_ROLLUP_MINUTES
+
+COLUMNS = 'id INTEGER PRIMARY KEY, username TEXT, latitude REAL, longitude REAL, accuracy REAL, timestamp TEXT'
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+
+
+class MySQLOnSQLite:
+    """Stand-in for database.execute: runs each statement on SQLite, rewriting the MySQL-only ones by name"""
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", isolation_level=None)
+        self.conn.execute(f'CREATE TABLE location ({COLUMNS})')
+        self.conn.execute('CREATE TABLE location_rollup (username TEXT, bucket TEXT, latitude REAL, longitude REAL, '
+                          'accuracy REAL, fixes INTEGER, PRIMARY KEY (username, bucket))')
+
+    def __call__(self, name, sql, params=(), fetch=None):
+        rewrite = getattr(self, name, None)
+        if rewrite is not None:
+            sql = rewrite(sql)
+        params = tuple(p.isoformat(" ") if isinstance(p, datetime) else p for p in params)
+        cursor = self.conn.execute(sql.replace('%s', '?'), params)
+        if fetch is None:
+            return cursor.rowcount
+        rows = [tuple(datetime.fromisoformat(v) if isinstance(v, str) and TIMESTAMP.match(v) else v for v in row)
+                for row in cursor.fetchall()]
+        return (rows[0] if rows else None) if fetch == "one" else rows
+
+    def list_location_tables(self, sql):
+        return "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'location\\_%' ESCAPE '\\'"
+
+    def create_location_table(self, sql):
+        return re.sub(r'LIKE `location`$', f'({COLUMNS})', sql)
+
+    def archive_locations(self, sql):
+        return sql.replace('INSERT IGNORE', 'INSERT OR IGNORE')
+
+    def purge_hot_locations(self, sql):
+        table = re.search(r'JOIN `(\w+)` a', sql).group(1)
+        return (f'DELETE FROM location WHERE id IN (SELECT id FROM `{table}`) '
+                'AND id BETWEEN %s AND %s AND timestamp >= %s AND timestamp < %s')
+
+    def rollup_locations(self, sql):
+        table = re.search(r'FROM `(\w+)`', sql).group(1)
+        seconds = LOCATION_ROLLUP_MINUTES * 60
+        return ('INSERT OR REPLACE INTO location_rollup (username, bucket, latitude, longitude, accuracy, fixes) '
+                f"SELECT username, datetime(CAST(strftime('%s', timestamp) AS INTEGER) / {seconds} * {seconds}, "
+                f"'unixepoch') AS b, AVG(latitude), AVG(longitude), MIN(accuracy), COUNT(*) FROM `{table}` "
+                'GROUP BY username, b').replace("'%s'", "'%' || 's'")
+
+    def get_user_locations(self, sql):
+        # SQLite has no parenthesized UNION members; a subquery per table keeps each ORDER BY/LIMIT
+        return sql.replace('(SELECT ', 'SELECT * FROM (SELECT ')
+
+    def expire_rollup(self, sql):
+        return re.sub(r' LIMIT \d+$', '', sql)
+
+
+@contextmanager
+def mysql_stand_in(rows):
+    """location_store against a fresh stand-in holding rows of (id, username, timestamp)"""
+    db = MySQLOnSQLite()
+    for row_id, username, timestamp in rows:
+        db.conn.execute('INSERT INTO location VALUES (?, ?, 12.97, 77.59, 5, ?)', (row_id, username, timestamp))
+    previous = location_store.execute, location_store.archive_tables
+    location_store.execute, location_store.archive_tables = db, ArchiveTables(ttl=0)
+    try:
+        yield db
+    finally:
+        location_store.execute, location_store.archive_tables = previous
+
+
+def table_ids(db, table):
+    return [row[0] for row in db.conn.execute(f'SELECT id FROM `{table}` ORDER BY id')]
+
+
+# Either side of the January/February boundary, plus this month's fixes
+FIXES = [
+    (1, "sarah_doe", "2026-01-31 23:59:59"),
+    (2, "sarah_doe", "2026-02-01 00:00:00"),
+    (3, "sarah_doe", "2026-02-14 09:30:00"),
+    (4, "anna_roy", "2026-02-14 09:30:00"),
+    (5, "sarah_doe", "2026-03-02 08:00:00"),
+    (6, "sarah_doe", "2026-03-02 08:00:00"),
+]
+NOW = datetime(2026, 3, 10)
+
+
+def test_rotation_splits_months_at_the_boundary():
+    with mysql_stand_in(FIXES) as db:
+        result = location_store.rotate(NOW)
+        assert result == {"location_202601": {"copied": 1, "deleted": 0},
+                          "location_202602": {"copied": 3, "deleted": 0}}
+        assert table_ids(db, "location_202601") == [1] and table_ids(db, "location_202602") == [2, 3, 4]
+        # Copied but not yet removed: a read in between sees each fix once
+        assert [r["id"] for r in location_store.get_user_locations("sarah_doe", 10)] == [6, 5, 3, 2, 1]
+
+        result = location_store.rotate(NOW)
+        assert result == {"location_202601": {"copied": 0, "deleted": 1},
+                          "location_202602": {"copied": 0, "deleted": 3}}
+        assert table_ids(db, "location") == [5, 6]
+        buckets = db.conn.execute('SELECT bucket, fixes FROM location_rollup WHERE username = ? ORDER BY bucket',
+                                  ("sarah_doe",)).fetchall()
+        assert buckets == [("2026-01-31 23:45:00", 1), ("2026-02-01 00:00:00", 1), ("2026-02-14 09:30:00", 1)]
+
+
+def test_before_cursor_crosses_tables():
+    with mysql_stand_in(FIXES) as db:
+        location_store.rotate(NOW)
+        location_store.rotate(NOW)
+        pages, before = [], None
+        while True:
+            page = location_store.get_user_locations("sarah_doe", 2, before)
+            if not page:
+                break
+            pages.append([r["id"] for r in page])
+            before = (datetime.fromisoformat(page[-1]["timestamp"]), page[-1]["id"])
+        # Hot table, then across into February, then into January; same timestamps split by id
+        assert pages == [[6, 5], [3, 2], [1]]
+        assert [r["id"] for r in location_store.iter_user_locations("sarah_doe", batch_size=2)] == [6, 5, 3, 2, 1]
+        # A cursor on the boundary still reads January; one in January skips February's table
+        assert [r["id"] for r in location_store.get_user_locations("sarah_doe", 2, (datetime(2026, 2, 1), 2))] == [1]
+        sql, _ = location_store.history_statement(location_store.archive_tables.months(), "sarah_doe", 2,
+                                                  (datetime(2026, 1, 31, 23, 59, 59), 1))
+        assert "location_202601" in sql and "location_202602" not in sql
+
+
+def test_expired_month_is_dropped_only_once_out_of_the_hot_table():
+    with mysql_stand_in(FIXES) as db:
+        later = datetime(2026, 8, 1)
+        location_store.rotate(later)
+        # January is past retention but still in the hot table until the next rotation
+        assert location_store.expire(later)["dropped"] == []
+        location_store.rotate(later)
+        assert location_store.expire(later)["dropped"] == ["location_202601"]
+        assert [r["id"] for r in location_store.get_user_locations("sarah_doe", 10)] == [6, 5, 3, 2]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,86 @@
+"""
+SAFEHER - Location batch validation tests
+Runs without MySQL: fixes are stored in a throwaway SQLite database
+Usage: python -m pytest test_locations.py  (or python test_locations.py)
+"""
+
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Select the embedded backend before db_adapter loads storage
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "safeher_test.db")
+
+from db_adapter import log_user, log_locations, log_location_array
+from validators import MAX_EPOCH_SECONDS
+from wire import decode_fixes, encode_fixes, validate_fixes, MAX_TIMESTAMP_MS
+
+USERNAME = "tz_tester"
+log_user(USERNAME, "secret", "tz_tester@example.com", "1234")
+
+
+@contextmanager
+def time_zone(name):
+    """Run with the process's local time zone set to name"""
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = name
+    time.tzset()
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = previous
+        time.tzset()
+
+
+def fix(timestamp):
+    return {"lat": 12.97, "lng": 77.59, "accuracy": 10, "timestamp": timestamp}
+
+
+def test_largest_epoch_is_accepted_east_of_utc():
+    for zone in ("Asia/Kolkata", "Pacific/Kiritimati", "America/Los_Angeles"):
+        with time_zone(zone):
+            accepted, errors = log_locations(USERNAME, [fix(MAX_EPOCH_SECONDS)])
+        assert accepted == 1 and errors == [], zone
+
+
+def test_epoch_past_the_bound_is_an_invalid_row():
+    with time_zone("Asia/Kolkata"):
+        accepted, errors = log_locations(USERNAME, [fix(1700000000), fix(253402300799), fix(MAX_EPOCH_SECONDS + 1)])
+    assert accepted == 1
+    assert [e["index"] for e in errors] == [1, 2]
+    assert all(e["error"].startswith("Timestamp error") for e in errors)
+
+
+def test_nan_timestamp_is_an_invalid_row():
+    accepted, errors = log_locations(USERNAME, [fix(float("nan")), fix(None)])
+    assert accepted == 1
+    assert errors == [{"index": 0, "error": "Timestamp error: Timestamp must be epoch seconds or ISO 8601"}]
+
+
+def binary_batch(timestamps_ms):
+    count = len(timestamps_ms)
+    return decode_fixes(encode_fixes([12.97] * count, [77.59] * count, [10.0] * count, timestamps_ms))
+
+
+def test_binary_timestamps_are_bounded():
+    fixes = binary_batch([0, MAX_TIMESTAMP_MS, MAX_TIMESTAMP_MS + 1, 253402300799000, 2 ** 62, -1])
+    assert validate_fixes(fixes).tolist() == [True, True, False, False, False, False]
+
+
+def test_binary_batch_rejects_rows_instead_of_failing():
+    with time_zone("Asia/Kolkata"):
+        accepted, rejected, message = log_location_array(
+            USERNAME, binary_batch([1700000000000, 253402300799000, MAX_TIMESTAMP_MS, 2 ** 62]))
+    assert accepted == 2 and rejected == [1, 3] and message is None
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,68 @@
+"""
+SAFEHER - Log rotation tests
+Runs in a throwaway directory: two watched file handlers stand in for two pre-fork
+workers sharing a log file, and rotate_files plays the launcher
+Usage: python -m pytest test_logger.py  (or python test_logger.py)
+"""
+
+import logging
+import os
+import tempfile
+from datetime import date
+from logging.handlers import WatchedFileHandler
+from logger import rotate_files
+
+
+def worker_pair(directory):
+    workers = []
+    for i in range(2):
+        worker = logging.getLogger(f"SAFEHER.test.{directory}.{i}")
+        worker.propagate = False
+        worker.addHandler(WatchedFileHandler(os.path.join(directory, "safeher.log"), delay=True))
+        workers.append(worker)
+    return workers
+
+
+def read(path):
+    with open(path) as f:
+        return f.read().split()
+
+
+def test_rotation_keeps_every_workers_records():
+    directory = tempfile.mkdtemp()
+    first, second = worker_pair(directory)
+    first.error("a1")
+    second.error("b1")
+    rotate_files(date(2026, 1, 5), directory, ("safeher.log",))
+    # Both workers reopen the new file instead of writing to the rotated one
+    first.error("a2")
+    second.error("b2")
+    assert read(os.path.join(directory, "safeher.log.2026-01-05")) == ["a1", "b1"]
+    assert read(os.path.join(directory, "safeher.log")) == ["a2", "b2"]
+
+
+def test_rotating_twice_for_one_day_never_overwrites():
+    directory = tempfile.mkdtemp()
+    first, _ = worker_pair(directory)
+    first.error("morning")
+    rotate_files(date(2026, 1, 5), directory, ("safeher.log",))
+    first.error("evening")
+    rotate_files(date(2026, 1, 5), directory, ("safeher.log",))
+    assert read(os.path.join(directory, "safeher.log.2026-01-05")) == ["morning"]
+    assert read(os.path.join(directory, "safeher.log.2026-01-05.1")) == ["evening"]
+
+
+def test_only_the_newest_days_are_kept():
+    directory = tempfile.mkdtemp()
+    first, _ = worker_pair(directory)
+    for day in range(1, 6):
+        first.error(f"day{day}")
+        rotate_files(date(2026, 1, day), directory, ("safeher.log",), retention=2)
+    assert sorted(os.listdir(directory)) == ["safeher.log.2026-01-04", "safeher.log.2026-01-05"]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
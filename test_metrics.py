@@ -0,0 +1,62 @@
+"""
+SAFEHER - Shared metrics tests
+Runs in a throwaway directory: two request metrics publishing to the same file stand in
+for two pre-fork workers answering scrapes in turn
+Usage: python -m pytest test_metrics.py  (or python test_metrics.py)
+"""
+
+import os
+import re
+import tempfile
+from metrics import RequestMetrics, SharedMetrics
+
+
+def worker_pair(path, group="server-1"):
+    return [SharedMetrics(RequestMetrics(), path, group=group, worker=f"worker-{i}") for i in range(2)]
+
+
+def requests_total(text, route):
+    return sum(int(n) for n in re.findall(rf'safeher_http_requests_total{{route="{route}"[^}}]*}} (\d+)', text))
+
+
+def test_every_worker_answers_a_scrape_with_the_same_totals():
+    first, second = worker_pair(os.path.join(tempfile.mkdtemp(), "metrics.db"))
+    for _ in range(3):
+        first.metrics.observe("/sos", "POST", 200, 0.05)
+    second.metrics.observe("/sos", "POST", 200, 0.2)
+    second.metrics.observe("/sos", "POST", 500, 0.01)
+    first.publish()
+    second.publish()
+    scrapes = [first.prometheus(), second.prometheus()]
+    assert [requests_total(text, "/sos") for text in scrapes] == [5, 5]
+    assert scrapes[0] == scrapes[1]
+    assert 'safeher_http_request_duration_seconds_count{route="/sos",method="POST"} 5' in scrapes[0]
+    assert 'safeher_http_request_duration_seconds_bucket{route="/sos",method="POST",le="0.1"} 4' in scrapes[0]
+
+
+def test_counts_of_an_exited_worker_are_kept():
+    path = os.path.join(tempfile.mkdtemp(), "metrics.db")
+    first, second = worker_pair(path)
+    first.metrics.observe("/analyze", "POST", 200, 0.01)
+    first.publish()
+    # The first worker is replaced after exiting; its last snapshot still counts
+    replacement = SharedMetrics(RequestMetrics(), path, group="server-1", worker="worker-2")
+    replacement.metrics.observe("/analyze", "POST", 200, 0.01)
+    assert requests_total(second.prometheus(), "/analyze") == 1
+    assert requests_total(replacement.prometheus(), "/analyze") == 2
+
+
+def test_other_servers_are_not_counted():
+    path = os.path.join(tempfile.mkdtemp(), "metrics.db")
+    first, _ = worker_pair(path, group="server-1")
+    other, _ = worker_pair(path, group="server-2")
+    other.metrics.observe("/ping", "GET", 200, 0.001)
+    other.publish()
+    assert requests_total(first.prometheus(), "/ping") == 0
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
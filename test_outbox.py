@@ -0,0 +1,175 @@
+"""
+SAFEHER - Notification outbox tests
+Runs without Firebase or a database: notifications go to a fake sender, and time is passed
+in explicitly so backoff is checked without sleeping
+Usage: python -m pytest test_outbox.py  (or python test_outbox.py)
+"""
+
+import os
+import tempfile
+import threading
+import time
+from outbox import Outbox, backoff, PRIORITY_SOS, PRIORITY_INFO
+from sos_pipeline import SOSPipeline
+
+
+class FakeSender:
+    """Records sent payloads; fails the first `failures` calls"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, payload):
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise ConnectionError("FCM unavailable")
+            self.sent.append(payload)
+
+
+def new_outbox(**kwargs):
+    return Outbox(os.path.join(tempfile.mkdtemp(), "outbox.db"), **kwargs)
+
+
+def drain(outbox, now):
+    while outbox.process_once(now):
+        pass
+
+
+def test_queued_notification_is_sent():
+    sender = FakeSender()
+    outbox = new_outbox(senders={"sos": sender})
+    job_id, queued = outbox.enqueue("sos", {"username": "sarah_doe"}, PRIORITY_SOS, now=100.0)
+    assert queued
+    drain(outbox, 101.0)
+    assert sender.sent == [{"username": "sarah_doe"}]
+    stats = outbox.stats(now=101.0)
+    assert stats["sent"] == 1 and stats["backlog"]["sos"] == 0
+    assert stats["time_to_delivery"]["count"] == 1
+
+
+def test_duplicate_sos_id_is_queued_once():
+    sender = FakeSender()
+    outbox = new_outbox(senders={"sos": sender})
+    first, queued = outbox.enqueue("sos", {"n": 1}, PRIORITY_SOS, dedup_key="sos:abc")
+    again, queued_again = outbox.enqueue("sos", {"n": 2}, PRIORITY_SOS, dedup_key="sos:abc")
+    assert queued and not queued_again and again == first
+    drain(outbox, time.time() + 1)
+    assert sender.sent == [{"n": 1}]
+    assert outbox.stats()["deduplicated"] == 1
+
+
+def test_sos_drains_before_informational():
+    sender = FakeSender()
+    outbox = new_outbox(senders={"sos": sender, "info": sender})
+    outbox.enqueue("info", {"n": "info-1"}, PRIORITY_INFO, now=100.0)
+    outbox.enqueue("info", {"n": "info-2"}, PRIORITY_INFO, now=101.0)
+    outbox.enqueue("sos", {"n": "sos"}, PRIORITY_SOS, now=102.0)
+    assert outbox.stats(now=103.0)["backlog"] == {"sos": 1, "info": 2, "other": 0}
+    drain(outbox, 103.0)
+    assert [payload["n"] for payload in sender.sent] == ["sos", "info-1", "info-2"]
+
+
+def test_failed_send_backs_off_exponentially():
+    sender = FakeSender(failures=2)
+    outbox = new_outbox(senders={"sos": sender})
+    outbox.enqueue("sos", {"n": 1}, PRIORITY_SOS, now=0.0)
+
+    assert outbox.process_once(0.0)
+    first_delay = outbox.next_due_in(0.0)
+    assert 1.0 <= first_delay <= 2.0
+    # Not due yet
+    assert not outbox.process_once(first_delay / 2)
+
+    now = first_delay
+    assert outbox.process_once(now)
+    second_delay = outbox.next_due_in(now)
+    assert 2.0 <= second_delay <= 4.0
+
+    now += second_delay
+    assert outbox.process_once(now)
+    assert sender.sent == [{"n": 1}]
+    assert outbox.stats(now)["retried"] == 2
+
+
+def test_backoff_is_capped_and_jittered():
+    delays = [backoff(20, base=2.0, cap=60.0) for _ in range(200)]
+    assert all(30.0 <= delay <= 60.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_gives_up_after_max_attempts():
+    sender = FakeSender(failures=100)
+    outbox = new_outbox(senders={"sos": sender}, max_attempts=3)
+    outbox.enqueue("sos", {"n": 1}, PRIORITY_SOS, now=0.0)
+    now = 0.0
+    for _ in range(3):
+        assert outbox.process_once(now)
+        now += 1000.0
+    assert not outbox.process_once(now)
+    stats = outbox.stats(now)
+    assert sender.calls == 3 and stats["dead"] == 1 and stats["backlog"]["sos"] == 0
+
+
+def test_queue_survives_a_restart():
+    path = os.path.join(tempfile.mkdtemp(), "outbox.db")
+    Outbox(path).enqueue("sos", {"username": "sarah_doe"}, PRIORITY_SOS, dedup_key="sos:1")
+
+    sender = FakeSender()
+    reopened = Outbox(path, senders={"sos": sender})
+    assert reopened.stats()["backlog"]["sos"] == 1
+    drain(reopened, time.time() + 1)
+    assert sender.sent == [{"username": "sarah_doe"}]
+
+
+def test_job_of_a_crashed_worker_is_retried_after_its_lease():
+    outbox = new_outbox(lease=30.0)
+    outbox.enqueue("sos", {"n": 1}, PRIORITY_SOS, now=0.0)
+    assert outbox.claim(0.0) is not None
+    # The worker died mid-send; nobody else may take the job until the lease runs out
+    assert outbox.claim(10.0) is None
+    job = outbox.claim(31.0)
+    assert job is not None and job[3] == 2
+
+
+def test_background_workers_deliver():
+    sender = FakeSender(failures=1)
+    outbox = new_outbox(senders={"sos": sender}, workers=2, base_delay=0.05, max_delay=0.05)
+    outbox.start()
+    outbox.enqueue("sos", {"n": 1}, PRIORITY_SOS)
+    deadline = time.time() + 5
+    while not sender.sent and time.time() < deadline:
+        time.sleep(0.02)
+    assert sender.sent == [{"n": 1}] and sender.calls == 2
+
+
+def test_pipeline_queues_failed_alert_once_per_sos_id():
+    directory = tempfile.mkdtemp()
+
+    def send(event):
+        raise ConnectionError("FCM unavailable")
+
+    # No outbox workers, so the test decides when queued alerts are sent
+    pipeline = SOSPipeline(lambda event: None, send, spool_path=os.path.join(directory, "spool.jsonl"),
+                           outbox=Outbox(os.path.join(directory, "outbox.db"), workers=0))
+    first = pipeline.dispatch("sarah_doe", "Sarah", sos_id="alert-0001")
+    again = pipeline.dispatch("sarah_doe", "Sarah", sos_id="alert-0001")
+    assert not first["sent"] and first["queued_for_retry"] and again["queued_for_retry"]
+    stats = pipeline.outbox.stats()
+    assert stats["enqueued"] == 1 and stats["deduplicated"] == 1
+
+    # Once FCM is back the queued alert goes out through the pipeline's current send_fn
+    sender = FakeSender()
+    pipeline.send_fn = sender
+    drain(pipeline.outbox, time.time() + 3600)
+    assert [event["sos_id"] for event in sender.sent] == ["alert-0001"]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
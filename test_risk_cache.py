@@ -0,0 +1,108 @@
+"""
+SAFEHER - Risk cache tests
+Runs without a database: zones are swapped in memory and every cached answer is compared
+with the exact per-point check
+Usage: python -m pytest test_risk_cache.py  (or python test_risk_cache.py)
+"""
+
+import json
+import os
+import random
+import tempfile
+import zones
+from ai_engine import run_ai_risk_check
+from geo import geohash_cell, geohash_cell_bbox
+from risk_cache import RiskCache, MIXED
+from zones import Zone, ZoneIndex
+
+PRECISION = 7
+NOON = 12
+
+
+def with_zones(zone_list, test):
+    previous = zones.zone_index
+    zones.zone_index = ZoneIndex(zone_list)
+    try:
+        test()
+    finally:
+        zones.zone_index = previous
+
+
+def test_zone_smaller_than_a_cell_is_not_cached_for_the_whole_cell():
+    cell = geohash_cell(12.9716, 77.5946, PRECISION)
+    min_lat, min_lng, max_lat, max_lng = geohash_cell_bbox(*cell, PRECISION)
+    height, width = max_lat - min_lat, max_lng - min_lng
+    # A ~20 m square away from the cell's center and corners
+    bbox = [min_lat + 0.3 * height, min_lng + 0.3 * width, min_lat + 0.4 * height, min_lng + 0.4 * width]
+    tiny = Zone.from_dict({"id": "tiny", "weight": 0.9, "reason": "Tiny zone", "bbox": bbox})
+    inside = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+    outside = (min_lat + 0.8 * height, min_lng + 0.8 * width)
+
+    def test():
+        cache = RiskCache(PRECISION)
+        # Whichever point is seen first, neither may decide the other's answer
+        assert cache.check(*outside, NOON) == run_ai_risk_check(*outside, NOON)
+        assert cache.check(*inside, NOON) == ("High", "Tiny zone")
+        assert cache.backend.get((cell, NOON, cache.stats()["model_version"])) == MIXED
+        cache.warm([cell])
+        assert cache.check(*inside, NOON) == ("High", "Tiny zone")
+
+    with_zones([tiny], test)
+
+
+def test_cell_inside_a_rectangle_zone_is_cached_whole():
+    big = Zone.from_dict({"id": "big", "weight": 0.5, "reason": "Big zone", "bbox": [12.0, 77.0, 13.0, 78.0]})
+
+    def test():
+        cache = RiskCache(PRECISION)
+        assert cache.check(12.9716, 77.5946, NOON) == ("Medium", "Big zone")
+        assert cache.check(12.97161, 77.59461, NOON) == ("Medium", "Big zone")
+        assert cache.stats()["hits"] == 1 and cache.stats()["mixed"] == 0
+
+    with_zones([big], test)
+
+
+def test_cached_results_match_exact_scoring():
+    rng = random.Random(7)
+    zone_list = []
+    for i in range(50):
+        lat, lng = rng.uniform(12.8, 13.1), rng.uniform(77.4, 77.8)
+        size = rng.choice((0.0002, 0.002, 0.02))
+        zone_list.append(Zone.from_dict({"id": f"z{i}", "weight": rng.uniform(0.1, 0.9), "reason": f"Zone {i}",
+                                         "bbox": [lat, lng, lat + size, lng + size]}))
+
+    def test():
+        cache = RiskCache(PRECISION)
+        points = [(rng.uniform(12.8, 13.1), rng.uniform(77.4, 77.8), rng.randrange(24)) for _ in range(5000)]
+        cache.warm({geohash_cell(lat, lng, PRECISION) for lat, lng, _ in points[:500]})
+        for lat, lng, hour in points:
+            assert cache.check(lat, lng, hour) == run_ai_risk_check(lat, lng, hour), (lat, lng, hour)
+
+    with_zones(zone_list, test)
+
+
+def test_zone_reload_reaches_the_other_workers():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "risk_zones.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"zones": [{"id": "park", "weight": 0.8, "bbox": [12.9, 77.5, 13.0, 77.6]}]}, f)
+    previous, previous_path, previous_generation = zones.zone_index, zones.ZONES_GENERATION_PATH, dict(zones._generation)
+    zones.ZONES_GENERATION_PATH = os.path.join(directory, "zones.generation")
+    try:
+        index = zones.reload_zones(path)
+        # Another worker: still on the old zones and yet to check the generation file
+        zones.zone_index = previous
+        zones._generation["seen"] = previous_generation["seen"]
+        zones.sync_zones(now=zones._generation["checked"] + zones.ZONES_CHECK_INTERVAL)
+        assert zones.zone_index is not index and zones.zone_index.version == index.version
+        assert zones.zone_index.lookup(12.95, 77.55)[0].id == "park"
+    finally:
+        zones.zone_index, zones.ZONES_GENERATION_PATH = previous, previous_path
+        zones._generation.update(previous_generation)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
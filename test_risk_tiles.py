@@ -0,0 +1,105 @@
+"""
+SAFEHER - Risk tile tests
+Runs without Firebase or MySQL: tiles are requested through Flask's test client against a
+throwaway SQLite database, and the encodings are decoded again here
+Usage: python -m pytest test_risk_tiles.py  (or python test_risk_tiles.py)
+"""
+
+import math
+import os
+import struct
+import tempfile
+
+# Select the embedded backend and keep the shared spool files out of the project tree
+_workdir = tempfile.mkdtemp()
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_workdir, "safeher_test.db")
+os.environ["SPOOL_DIR"] = os.path.join(_workdir, "spool")
+
+import numpy as np
+import app as api
+import zones
+from risk_tiles import HEADER, compute_tile, encode_binary, rle_decode, rle_encode, tile_bbox
+from zones import Zone, ZoneIndex
+
+# The XYZ tile holding central Bangalore at zoom 12
+ZOOM, X, Y = 12, 2930, 1899
+
+
+def test_rle_round_trip():
+    rng = np.random.default_rng(7)
+    for values in (rng.integers(0, 3, (32, 32)), np.full((16, 16), 200), rng.integers(0, 256, (8, 8)),
+                   np.zeros((0, 0))):
+        values = values.astype(np.uint8)
+        runs = rle_encode(values)
+        assert np.array_equal(rle_decode(runs).reshape(values.shape), values) if values.size else runs == []
+    assert rle_encode(np.array([[1, 1, 2], [2, 2, 0]], dtype=np.uint8)) == [1, 2, 2, 3, 0, 1]
+
+
+def test_binary_encoding_layout():
+    levels, scores = compute_tile(ZOOM, X, Y, 16, 12)
+    body = encode_binary(levels, scores)
+    assert body[:4] == HEADER and struct.unpack("<H", body[4:6]) == (16,)
+    assert len(body) == 6 + 2 * 16 * 16
+    assert np.array_equal(np.frombuffer(body[6:6 + 256], dtype=np.uint8).reshape(16, 16), levels)
+    assert np.array_equal(np.frombuffer(body[6 + 256:], dtype=np.uint8).reshape(16, 16), scores)
+
+
+def test_tile_bbox():
+    min_lat, min_lng, max_lat, max_lng = tile_bbox(0, 0, 0)
+    assert (min_lng, max_lng) == (-180.0, 180.0)
+    assert math.isclose(max_lat, 85.0511287798, abs_tol=1e-9) and math.isclose(min_lat, -max_lat)
+    # Neighbouring tiles share their edges
+    assert tile_bbox(ZOOM, X, Y)[0] == tile_bbox(ZOOM, X, Y + 1)[2]
+    assert tile_bbox(ZOOM, X, Y)[3] == tile_bbox(ZOOM, X + 1, Y)[1]
+    min_lat, min_lng, max_lat, max_lng = tile_bbox(ZOOM, X, Y)
+    assert min_lat <= 12.9716 <= max_lat and min_lng <= 77.5946 <= max_lng
+
+
+def test_tile_is_revalidated_with_its_etag():
+    client = api.app.test_client()
+    path = f"/risk/tile/{ZOOM}/{X}/{Y}?size=16&hour=23"
+    first = client.get(path)
+    assert first.status_code == 200 and first.headers["ETag"]
+    body = first.get_json()
+    assert np.array_equal(rle_decode(body["levels"]).reshape(16, 16), compute_tile(ZOOM, X, Y, 16, 23)[0])
+
+    not_modified = api.tile_cache.not_modified
+    again = client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.data == b""
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert api.tile_cache.not_modified == not_modified + 1
+
+    # The binary encoding of the same tile has its own ETag
+    binary = client.get(path + "&format=binary", headers={"If-None-Match": first.headers["ETag"]})
+    assert binary.status_code == 200 and binary.data[:4] == HEADER
+    assert binary.headers["ETag"] != first.headers["ETag"]
+
+
+def test_new_zones_change_the_etag():
+    client = api.app.test_client()
+    path = f"/risk/tile/{ZOOM}/{X}/{Y}?size=16&hour=12"
+    before = client.get(path)
+    previous = zones.zone_index
+    min_lat, min_lng, max_lat, max_lng = tile_bbox(ZOOM, X, Y)
+    zones.zone_index = ZoneIndex([Zone.from_dict({"id": "tile", "weight": 0.9, "bbox": [min_lat, min_lng,
+                                                                                        max_lat, max_lng]})])
+    try:
+        after = client.get(path, headers={"If-None-Match": before.headers["ETag"]})
+        assert after.status_code == 200 and after.headers["ETag"] != before.headers["ETag"]
+        assert after.get_json()["levels"] == [2, 256]
+    finally:
+        zones.zone_index = previous
+
+
+def test_invalid_tiles_are_rejected():
+    client = api.app.test_client()
+    assert client.get("/risk/tile/1/2/0").status_code == 400
+    assert client.get(f"/risk/tile/{ZOOM}/{X}/{Y}?hour=24").status_code == 400
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,246 @@
+"""
+SAFEHER - SOS fan-out tests
+Runs without Firebase or MySQL: sends go through a local stand-in for firebase_admin.messaging,
+and contacts are stored in a throwaway SQLite database
+Usage: python -m pytest test_sos_fanout.py  (or python test_sos_fanout.py)
+"""
+
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Select the embedded backend before db_adapter loads storage
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "safeher_test.db")
+
+import db_adapter
+from db_adapter import log_user, log_contact, lookup_contacts, lookup_sos_recipients, register_device
+from sos_fanout import SOSFanout, fcm_multicast_sender, DELIVERED, PARTIAL, FAILED, NO_DEVICE, UNREGISTERED
+from sos_pipeline import SOSPipeline
+from outbox import Outbox
+from validators import phone_key
+
+
+class FakeMessaging:
+    """Stand-in for the firebase_admin.messaging names fcm_multicast_sender uses"""
+
+    class UnregisteredError(Exception):
+        pass
+
+    class Notification:
+        def __init__(self, title=None, body=None):
+            self.title = title
+            self.body = body
+
+    class AndroidConfig:
+        def __init__(self, priority=None):
+            self.priority = priority
+
+    class MulticastMessage:
+        def __init__(self, tokens, notification=None, data=None, android=None):
+            self.tokens = tokens
+            self.notification = notification
+            self.data = data
+            self.android = android
+
+    class SendResponse:
+        def __init__(self, exception=None):
+            self.success = exception is None
+            self.exception = exception
+
+    class BatchResponse:
+        def __init__(self, responses):
+            self.responses = responses
+
+    def __init__(self, unregistered=(), failing=(), latency=0.0):
+        self.unregistered = set(unregistered)
+        self.failing = set(failing)
+        self.latency = latency
+        self.messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def send_each_for_multicast(self, message):
+        assert len(message.tokens) <= 500
+        with self._lock:
+            self.messages.append(message)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        responses = []
+        for token in message.tokens:
+            if token in self.unregistered:
+                responses.append(self.SendResponse(self.UnregisteredError("Requested entity was not found")))
+            elif token in self.failing:
+                responses.append(self.SendResponse(RuntimeError("Internal error")))
+            else:
+                responses.append(self.SendResponse())
+        return self.BatchResponse(responses)
+
+
+def sos_event(username="sarah_doe", sos_id=None):
+    event = {"username": username, "name": "Sarah", "timestamp": datetime.now().isoformat()}
+    if sos_id:
+        event["sos_id"] = sos_id
+    return event
+
+
+def new_outbox():
+    # No outbox workers, so the test decides when queued sends are retried
+    return Outbox(os.path.join(tempfile.mkdtemp(), "outbox.db"), workers=0)
+
+
+def recipients(count, devices=1):
+    return [{"name": f"Contact {i}", "phone": str(900000000 + i),
+             "tokens": [f"token-{i}-{d}" for d in range(devices)]} for i in range(count)]
+
+
+def test_dozens_of_contacts_go_out_in_one_multicast():
+    fcm = FakeMessaging()
+    fanout = SOSFanout(lambda username: recipients(40), fcm_multicast_sender(fcm))
+    result = fanout.send(sos_event())
+    assert len(fcm.messages) == 1
+    assert result["recipients"] == 40 and result["delivered"] == 40 and result["failed"] == 0
+    assert all(status["status"] == DELIVERED for status in result["statuses"])
+    message = fcm.messages[0]
+    assert message.data["type"] == "sos" and message.data["username"] == "sarah_doe"
+    assert message.android.priority == "high"
+
+
+def test_tokens_are_chunked_with_bounded_concurrency():
+    fcm = FakeMessaging(latency=0.02)
+    fanout = SOSFanout(lambda username: recipients(300, devices=4), fcm_multicast_sender(fcm),
+                       chunk_size=100, concurrency=3)
+    result = fanout.send(sos_event())
+    assert len(fcm.messages) == 12
+    assert sorted(len(m.tokens) for m in fcm.messages) == [100] * 12
+    assert fcm.max_in_flight <= 3
+    assert result["devices"] == 1200 and result["delivered"] == 1200
+
+
+def test_per_recipient_status():
+    people = [
+        {"name": "Mom", "phone": "1", "tokens": ["mom-phone", "mom-tablet"]},
+        {"name": "Dad", "phone": "2", "tokens": ["dad-phone"]},
+        {"name": "Sister", "phone": "3", "tokens": []},
+        {"name": "Friend", "phone": "4", "tokens": ["friend-phone"]}
+    ]
+    fcm = FakeMessaging(failing={"mom-tablet", "dad-phone"})
+    result = SOSFanout(lambda username: people, fcm_multicast_sender(fcm)).send(sos_event())
+    statuses = {status["name"]: status for status in result["statuses"]}
+    assert statuses["Mom"]["status"] == PARTIAL and statuses["Mom"]["delivered"] == 1
+    assert statuses["Dad"]["status"] == FAILED and statuses["Dad"]["error"] == FAILED
+    assert statuses["Sister"]["status"] == NO_DEVICE
+    assert statuses["Friend"]["status"] == DELIVERED
+    assert result["reached"] == 2 and result["delivered"] == 2 and result["failed"] == 2
+
+
+def test_unregistered_tokens_are_removed():
+    removed = []
+    fcm = FakeMessaging(unregistered={"token-1-0"})
+    fanout = SOSFanout(lambda username: recipients(3), fcm_multicast_sender(fcm), removed.extend)
+    result = fanout.send(sos_event())
+    assert removed == ["token-1-0"]
+    assert [status["error"] for status in result["statuses"]] == [None, UNREGISTERED, None]
+    assert fanout.stats()["removed_tokens"] == 1
+
+
+def test_shared_device_is_notified_once():
+    people = [{"name": "Mom", "phone": "1", "tokens": ["family-tablet"]},
+              {"name": "Dad", "phone": "2", "tokens": ["family-tablet"]}]
+    fcm = FakeMessaging()
+    result = SOSFanout(lambda username: people, fcm_multicast_sender(fcm)).send(sos_event())
+    assert fcm.messages[0].tokens == ["family-tablet"]
+    assert [status["status"] for status in result["statuses"]] == [DELIVERED, DELIVERED]
+
+
+def test_failed_chunk_only_fails_its_own_tokens():
+    def send(tokens, event):
+        if "token-0-0" in tokens:
+            raise ConnectionError("FCM unavailable")
+        return [None] * len(tokens)
+
+    fanout = SOSFanout(lambda username: recipients(10), send, chunk_size=5)
+    result = fanout.send(sos_event())
+    assert result["delivered"] == 5 and result["failed"] == 5
+    # The exception text is logged, not returned
+    assert result["statuses"][0]["error"] == FAILED and result["statuses"][-1]["error"] is None
+
+
+def test_failed_devices_are_queued_once_per_sos_id_and_retried():
+    fcm = FakeMessaging(unregistered={"token-0-0"}, failing={"token-1-0", "token-2-0"})
+    removed = []
+    outbox = new_outbox()
+    fanout = SOSFanout(lambda username: recipients(4), fcm_multicast_sender(fcm), removed.extend, outbox)
+    result = fanout.send(sos_event(sos_id="alert-0001"))
+    again = fanout.send(sos_event(sos_id="alert-0001"))
+    # The unregistered token is dropped, not retried
+    assert result["queued_for_retry"] == 2 and again["queued_for_retry"] == 0
+    assert outbox.stats()["backlog"]["sos"] == 2
+
+    fcm.failing = {"token-2-0"}
+    sent_before = len(fcm.messages)
+    while outbox.process_once(time.time() + 3600):
+        pass
+    assert sorted(message.tokens[0] for message in fcm.messages[sent_before:]) == ["token-1-0", "token-2-0"]
+    stats = outbox.stats(time.time() + 3600)
+    assert stats["sent"] == 1 and stats["retried"] == 1 and stats["backlog"]["sos"] == 1
+    assert set(removed) == {"token-0-0"}
+
+
+def test_sos_only_reaches_the_users_own_contacts():
+    for username, phone in (("alice_a", "9000000001"), ("bob_b", "9000000002")):
+        assert log_user(username, "secret", f"{username}@example.com", "1234")[0]
+        assert log_contact(username, "Contact", "Friend", phone)[0]
+    register_device("alice-contact-phone", "9000000001")
+    register_device("bob-contact-phone", "9000000002")
+
+    fcm = FakeMessaging()
+    result = SOSFanout(lookup_sos_recipients, fcm_multicast_sender(fcm)).send(sos_event("alice_a"))
+    assert [token for message in fcm.messages for token in message.tokens] == ["alice-contact-phone"]
+    assert result["recipients"] == 1 and result["delivered"] == 1
+
+
+def test_contact_added_through_another_worker_gets_the_next_sos():
+    assert log_user("carol_c", "secret", "carol_c@example.com", "1234")[0]
+    assert log_contact("carol_c", "Mom", "Mother", "9000000011")[0]
+    assert len(lookup_sos_recipients("carol_c")) == 1 and len(lookup_contacts("carol_c")) == 1
+    # Written by another worker: this worker's cache is never told
+    db_adapter.backend.insert_contact("carol_c", "Sister", "Sister", "9000000012")
+    db_adapter.backend.insert_device_token("sister-phone", phone_key("9000000012"))
+    assert len(lookup_contacts("carol_c")) == 1
+    sister = lookup_sos_recipients("carol_c")[1]
+    assert sister["name"] == "Sister" and sister["tokens"] == ["sister-phone"]
+
+
+def test_pipeline_returns_contact_statuses_alongside_topic_send():
+    fcm = FakeMessaging()
+    fanout = SOSFanout(lambda username: recipients(2), fcm_multicast_sender(fcm))
+    pipeline = SOSPipeline(lambda event: None, lambda event: None, fanout.send,
+                           spool_path=os.path.join(tempfile.mkdtemp(), "spool.jsonl"), outbox=new_outbox())
+    result = pipeline.dispatch("sarah_doe", "Sarah")
+    assert result["sent"] and result["logged"]
+    assert result["contacts"]["delivered"] == 2
+
+
+def test_pipeline_survives_a_failing_fanout():
+    def resolve(username):
+        raise RuntimeError("contacts unavailable")
+
+    pipeline = SOSPipeline(lambda event: None, lambda event: None, SOSFanout(resolve, lambda t, e: []).send,
+                           spool_path=os.path.join(tempfile.mkdtemp(), "spool.jsonl"), outbox=new_outbox())
+    result = pipeline.dispatch("sarah_doe", "Sarah")
+    assert result["sent"]
+    assert result["contacts"] == {"error": "failed"}
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,106 @@
+"""
+SAFEHER - SOS spool tests
+Runs without Firebase or MySQL: the database is a stand-in that can be taken down, and
+two spools on the same file stand in for two pre-fork worker processes
+Usage: python -m pytest test_sos_spool.py  (or python test_sos_spool.py)
+"""
+
+import os
+import tempfile
+import threading
+import time
+from outbox import Outbox
+from sos_pipeline import SOSPipeline, SOSSpool
+
+
+class LocalDB:
+    """Stand-in for log_sos: stores SOS events while up, raises while down"""
+
+    def __init__(self, up=True, delay=0.0):
+        self.up = up
+        self.delay = delay
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        time.sleep(self.delay)
+        if not self.up:
+            raise ConnectionError("Can't connect to MySQL server")
+        with self._lock:
+            self.rows.append(event["sos_id"])
+
+
+def spool_path():
+    return os.path.join(tempfile.mkdtemp(), "sos_spool.jsonl")
+
+
+def test_sos_is_spooled_while_db_is_down_and_replayed_once_back():
+    directory = tempfile.mkdtemp()
+    db = LocalDB(up=False)
+    pipeline = SOSPipeline(db, lambda event: None, spool_path=os.path.join(directory, "sos_spool.jsonl"),
+                           outbox=Outbox(os.path.join(directory, "outbox.db"), workers=0))
+    result = pipeline.dispatch("sarah_doe", "Sarah", sos_id="alert-0001")
+    assert not result["logged"] and result["spooled"] and result["sent"]
+    assert pipeline.stats()["spool_depth"] == 1
+
+    assert pipeline.spool.replay(db) == 0
+    assert pipeline.stats()["spool_depth"] == 1
+
+    db.up = True
+    assert pipeline.spool.replay(db) == 1
+    assert db.rows == ["alert-0001"] and pipeline.stats()["spool_depth"] == 0
+
+
+def test_event_appended_during_a_replay_is_kept():
+    path = spool_path()
+    first, second = SOSSpool(path), SOSSpool(path)
+    first.append({"sos_id": "alert-0001"})
+    db = LocalDB(delay=0.2)
+    replay = threading.Thread(target=first.replay, args=(db,))
+    replay.start()
+    time.sleep(0.05)
+    # The other worker's append waits for the replay instead of being overwritten by it
+    second.append({"sos_id": "alert-0002"})
+    replay.join()
+    assert db.rows == ["alert-0001"]
+    assert second.depth() == 1 and second.replay(db) == 1
+    assert db.rows == ["alert-0001", "alert-0002"]
+
+
+def test_concurrent_replays_write_each_event_once():
+    path = spool_path()
+    workers = [SOSSpool(path) for _ in range(4)]
+    for i in range(20):
+        workers[0].append({"sos_id": f"alert-{i:04d}"})
+    db = LocalDB(delay=0.001)
+    threads = [threading.Thread(target=worker.replay, args=(db,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(db.rows) == [f"alert-{i:04d}" for i in range(20)]
+
+
+def test_unreadable_line_is_quarantined():
+    path = spool_path()
+    spool = SOSSpool(path)
+    spool.append({"sos_id": "alert-0001"})
+    with open(path, 'a', encoding='utf-8') as f:
+        # A write cut short by a crash
+        f.write('{"sos_id": "alert-00')
+    spool.append({"sos_id": "alert-0002"})
+    db = LocalDB()
+    assert spool.replay(db) == 2
+    assert db.rows == ["alert-0001", "alert-0002"] and spool.depth() == 0
+    with open(spool.quarantine_path, encoding='utf-8') as f:
+        assert f.read() == '{"sos_id": "alert-00\n'
+    # Nothing is left behind to fail the next pass
+    spool.append({"sos_id": "alert-0003"})
+    assert spool.replay(db) == 1
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
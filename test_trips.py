@@ -0,0 +1,74 @@
+"""
+SAFEHER - Journey mode tests
+Runs without a database: trips are stored in a throwaway SQLite file, and two managers on
+the same file stand in for two pre-fork worker processes
+Usage: python -m pytest test_trips.py  (or python test_trips.py)
+"""
+
+import os
+import tempfile
+import trips
+from trips import TripManager, TRIP_STOP_SECONDS
+
+ORIGIN = (12.90, 77.50)
+DESTINATION = (12.95, 77.55)
+
+
+def worker_pair(notify_fn=None):
+    path = os.path.join(tempfile.mkdtemp(), "trips.db")
+    return TripManager(path, notify_fn), TripManager(path, notify_fn)
+
+
+def test_trip_started_on_one_worker_is_seen_by_another():
+    first, second = worker_pair()
+    trip = first.start("sarah_doe", ORIGIN, DESTINATION, expected_minutes=30)
+    now = trip.started_at
+    assert second.add_fix("sarah_doe", 12.905, 77.505, at=now + 60)[0].fixes == 1
+    assert first.add_fix("sarah_doe", 12.910, 77.510, at=now + 120)[0].fixes == 2
+
+    state = second.get(trip.id, track=True).to_dict(track=True)
+    assert state["fixes"] == 2 and [fix["at"] for fix in state["track"]] == [now + 60, now + 120]
+    assert state["distance_km"] > 0
+
+    first.end(trip.id)
+    assert second.active_trip("sarah_doe") is None
+    assert second.add_fix("sarah_doe", 12.915, 77.515) == (None, [])
+
+
+def test_starting_a_trip_ends_the_previous_one():
+    first, second = worker_pair()
+    old = first.start("sarah_doe", ORIGIN, DESTINATION)
+    new = second.start("sarah_doe", ORIGIN, DESTINATION)
+    assert first.get(old.id).status == "ended"
+    assert first.active_trip("sarah_doe").id == new.id
+
+
+def test_deviation_and_long_stop_notify_once_across_workers():
+    notified = []
+    first, second = worker_pair(lambda trip, alert: notified.append(alert["type"]))
+    trip = first.start("sarah_doe", ORIGIN, DESTINATION)
+    now = trip.started_at
+    # Two fixes ~2 km off the route, then staying put, alternating between workers
+    for i, manager in enumerate((first, second, first, second)):
+        manager.add_fix("sarah_doe", 12.94, 77.49, at=now + i * TRIP_STOP_SECONDS / 2)
+    assert notified == ["deviation", "long_stop"]
+    assert [alert["type"] for alert in first.get(trip.id).alerts] == ["deviation", "long_stop"]
+    assert first.stats()["alerts"] == 2
+
+
+def test_overspeed_is_not_notified():
+    notified = []
+    manager, _ = worker_pair(lambda trip, alert: notified.append(alert["type"]))
+    trip = manager.start("sarah_doe", ORIGIN, DESTINATION)
+    now = trip.started_at
+    for i in range(10):
+        manager.add_fix("sarah_doe", ORIGIN[0] + i * 0.005, ORIGIN[1] + i * 0.005, at=now + i * 5)
+    assert "overspeed" in [alert["type"] for alert in manager.get(trip.id).alerts]
+    assert "overspeed" not in trips.TRIP_NOTIFY_ALERTS and notified == []
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✓ {name}")
@@ -0,0 +1,343 @@
+"""
+Trips - Journey mode with streaming deviation, speed and stop detection
+A trip is a straight route from its origin to a destination. Each fix is appended
+to an in-memory track and checked in O(1): distance off the route segment, speed
+since the previous fix and time spent within a small radius. Alerts fire once per
+episode (deviation, long stop, overspeed, overdue) and arrival ends the trip.
+Trips are kept in a local SQLite file shared by every worker process on the host, so a
+trip started by one worker is updated and read by the others; each fix is applied in a
+write transaction, so two workers never interleave on one trip.
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from db_pool import SQLitePool
+from logger import info, error, warning
+
+TRIP_DEVIATION_M = float(os.getenv('TRIP_DEVIATION_M', 500))
+# Consecutive off-route fixes needed before a deviation alert (filters single GPS jumps)
+TRIP_DEVIATION_FIXES = int(os.getenv('TRIP_DEVIATION_FIXES', 2))
+TRIP_STOP_RADIUS_M = float(os.getenv('TRIP_STOP_RADIUS_M', 50))
+TRIP_STOP_SECONDS = float(os.getenv('TRIP_STOP_SECONDS', 600))
+TRIP_MAX_SPEED_KMH = float(os.getenv('TRIP_MAX_SPEED_KMH', 150))
+TRIP_ARRIVAL_M = float(os.getenv('TRIP_ARRIVAL_M', 150))
+TRIP_TRACK_MAX = int(os.getenv('TRIP_TRACK_MAX', 5000))
+TRIP_IDLE_TIMEOUT = float(os.getenv('TRIP_IDLE_TIMEOUT', 6 * 3600))
+# Alerts that are pushed to the user's contacts (the rest only show up in the trip state)
+TRIP_NOTIFY_ALERTS = set(filter(None, os.getenv('TRIP_NOTIFY_ALERTS', 'deviation,long_stop,overdue').split(',')))
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+TRIPS_PATH = os.getenv('TRIPS_PATH', os.path.join(SPOOL_DIR, "trips.db"))
+# A trip is overdue once it takes this many times its expected duration
+TRIP_OVERDUE_FACTOR = 1.5
+
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LNG = 111320.0
+# Speed is smoothed so one noisy fix doesn't trip the overspeed alert
+SPEED_SMOOTHING = 0.3
+# Fixes closer together than this (seconds) update distance but not speed
+MIN_SPEED_INTERVAL = 1.0
+
+ACTIVE = "active"
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS trips (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        status TEXT NOT NULL,
+        state TEXT NOT NULL,
+        alerts INTEGER NOT NULL DEFAULT 0,
+        last_fix_at REAL NOT NULL,
+        ended_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_trips_user ON trips (username, status);
+    CREATE TABLE IF NOT EXISTS trip_fixes (
+        trip_id TEXT NOT NULL,
+        at REAL NOT NULL,
+        lat REAL NOT NULL,
+        lng REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_trip_fixes_trip ON trip_fixes (trip_id);
+'''
+
+
+class Trip:
+    """One user's journey; fixes are projected onto a local plane centred on the origin"""
+
+    def __init__(self, username, origin, destination, expected_minutes=None, now=None):
+        now = time.time() if now is None else now
+        self.id = uuid.uuid4().hex[:12]
+        self.username = username
+        self.origin = origin
+        self.destination = destination
+        self.started_at = now
+        self.expected_seconds = expected_minutes * 60 if expected_minutes else None
+        self.status = ACTIVE
+        self.ended_at = None
+        self.track = deque(maxlen=TRIP_TRACK_MAX)
+        self.alerts = []
+        self.distance_m = 0.0
+        self.speed_kmh = 0.0
+        self.off_route_m = 0.0
+        self.progress = 0.0
+        self.fixes = 0
+        self.last_fix_at = now
+        self._kx = METERS_PER_DEG_LNG * math.cos(math.radians(origin[0]))
+        self._dest_xy = self._xy(*destination)
+        self._route_len2 = self._dest_xy[0] ** 2 + self._dest_xy[1] ** 2
+        self._last = None
+        self._off_route_fixes = 0
+        self._deviating = False
+        self._stop_anchor = None
+        self._stop_since = None
+        self._stop_alerted = False
+        self._overspeed = False
+        self._overdue = False
+        self._lock = threading.Lock()
+
+    def _xy(self, lat, lng):
+        """Meters east/north of the origin (flat-earth; fine at city scale)"""
+        return (lng - self.origin[1]) * self._kx, (lat - self.origin[0]) * METERS_PER_DEG_LAT
+
+    def _route_position(self, x, y):
+        """(distance off the origin-destination segment, fraction of the route covered)"""
+        if self._route_len2 == 0:
+            return math.hypot(x, y), 1.0
+        t = max(0.0, min(1.0, (x * self._dest_xy[0] + y * self._dest_xy[1]) / self._route_len2))
+        return math.hypot(x - t * self._dest_xy[0], y - t * self._dest_xy[1]), t
+
+    def _alert(self, kind, at, **details):
+        alert = {"type": kind, "at": at, **details}
+        self.alerts.append(alert)
+        warning("Trip %s (%s): %s %s", self.id, self.username, kind, details)
+        return alert
+
+    def add_fix(self, lat, lng, accuracy=0.0, at=None):
+        """Append one fix and run the detectors; returns the alerts it raised"""
+        at = time.time() if at is None else at
+        with self._lock:
+            if self.status != ACTIVE:
+                return []
+            raised = []
+            x, y = self._xy(lat, lng)
+            self.track.append((at, lat, lng))
+            self.fixes += 1
+            self.last_fix_at = at
+
+            # Speed and distance travelled since the previous fix
+            if self._last is not None:
+                last_at, last_x, last_y = self._last
+                step = math.hypot(x - last_x, y - last_y)
+                self.distance_m += step
+                if at - last_at >= MIN_SPEED_INTERVAL:
+                    speed = step / (at - last_at) * 3.6
+                    self.speed_kmh += SPEED_SMOOTHING * (speed - self.speed_kmh)
+            self._last = (at, x, y)
+            if self.speed_kmh > TRIP_MAX_SPEED_KMH and not self._overspeed:
+                self._overspeed = True
+                raised.append(self._alert("overspeed", at, speed_kmh=round(self.speed_kmh, 1)))
+            elif self.speed_kmh <= TRIP_MAX_SPEED_KMH:
+                self._overspeed = False
+
+            # Distance off the route, allowing for the fix's own accuracy
+            self.off_route_m, self.progress = self._route_position(x, y)
+            if self.off_route_m > TRIP_DEVIATION_M + (accuracy or 0.0):
+                self._off_route_fixes += 1
+                if self._off_route_fixes >= TRIP_DEVIATION_FIXES and not self._deviating:
+                    self._deviating = True
+                    raised.append(self._alert("deviation", at, off_route_m=round(self.off_route_m)))
+            else:
+                self._off_route_fixes = 0
+                self._deviating = False
+
+            # Stops: time since the user last left a TRIP_STOP_RADIUS_M circle
+            if self._stop_anchor is None or math.hypot(x - self._stop_anchor[0], y - self._stop_anchor[1]) > TRIP_STOP_RADIUS_M:
+                self._stop_anchor = (x, y)
+                self._stop_since = at
+                self._stop_alerted = False
+            elif at - self._stop_since >= TRIP_STOP_SECONDS and not self._stop_alerted:
+                self._stop_alerted = True
+                raised.append(self._alert("long_stop", at, stopped_seconds=round(at - self._stop_since)))
+
+            if self.expected_seconds and not self._overdue and \
+                    at - self.started_at > self.expected_seconds * TRIP_OVERDUE_FACTOR:
+                self._overdue = True
+                raised.append(self._alert("overdue", at, elapsed_minutes=round((at - self.started_at) / 60)))
+
+            if math.hypot(x - self._dest_xy[0], y - self._dest_xy[1]) <= TRIP_ARRIVAL_M + (accuracy or 0.0):
+                self.status = "arrived"
+                self.ended_at = at
+                info("Trip %s (%s) arrived after %.2f km", self.id, self.username, self.distance_m / 1000)
+            return raised
+
+    def end(self, at=None):
+        with self._lock:
+            if self.status == ACTIVE:
+                self.status = "ended"
+                self.ended_at = time.time() if at is None else at
+
+    def to_state(self):
+        """Everything but the track and lock, as JSON"""
+        return json.dumps({key: value for key, value in self.__dict__.items() if key not in ("track", "_lock")})
+
+    @classmethod
+    def from_state(cls, state, track=()):
+        trip = cls.__new__(cls)
+        trip.__dict__.update(json.loads(state))
+        trip.track = deque(track, maxlen=TRIP_TRACK_MAX)
+        trip._lock = threading.Lock()
+        return trip
+
+    def to_dict(self, track=False):
+        with self._lock:
+            remaining = math.hypot(self._last[1] - self._dest_xy[0], self._last[2] - self._dest_xy[1]) \
+                if self._last else math.sqrt(self._route_len2)
+            result = {
+                "trip_id": self.id,
+                "username": self.username,
+                "status": self.status,
+                "origin": {"lat": self.origin[0], "lng": self.origin[1]},
+                "destination": {"lat": self.destination[0], "lng": self.destination[1]},
+                "started_at": self.started_at,
+                "ended_at": self.ended_at,
+                "fixes": self.fixes,
+                "distance_km": round(self.distance_m / 1000, 3),
+                "remaining_km": round(remaining / 1000, 3),
+                "progress": round(self.progress, 3),
+                "off_route_m": round(self.off_route_m, 1),
+                "speed_kmh": round(self.speed_kmh, 1),
+                "stopped_seconds": round(self.last_fix_at - self._stop_since) if self._stop_since else 0,
+                "alerts": list(self.alerts)
+            }
+            if track:
+                result["track"] = [{"at": at, "lat": lat, "lng": lng} for at, lat, lng in self.track]
+            return result
+
+
+class TripManager:
+    """
+    Trips by id, with at most one active trip per user, stored at path.
+    notify_fn(trip, alert) is called for each TRIP_NOTIFY_ALERTS alert once it is saved.
+    Returned trips are snapshots; changes go through the manager.
+    """
+
+    def __init__(self, path=TRIPS_PATH, notify_fn=None, idle_timeout=TRIP_IDLE_TIMEOUT):
+        self.path = path
+        self.notify_fn = notify_fn
+        self.idle_timeout = idle_timeout
+        self.started = 0
+        self.expired = 0
+        self._pool = SQLitePool(self._connect)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def _transaction(self):
+        """Write transaction; other workers wait for it, so a trip's read-modify-write is atomic"""
+        return self._pool.transaction()
+
+    def _load(self, conn, where, params, track=False):
+        row = conn.execute(f'SELECT id, state FROM trips WHERE {where}', params).fetchone()
+        if row is None:
+            return None
+        fixes = ()
+        if track:
+            fixes = reversed(conn.execute(
+                'SELECT at, lat, lng FROM trip_fixes WHERE trip_id = ? ORDER BY rowid DESC LIMIT ?',
+                (row[0], TRIP_TRACK_MAX)).fetchall())
+        return Trip.from_state(row[1], fixes)
+
+    def _save(self, conn, trip):
+        conn.execute('UPDATE trips SET status = ?, state = ?, alerts = ?, last_fix_at = ?, ended_at = ? WHERE id = ?',
+                     (trip.status, trip.to_state(), len(trip.alerts), trip.last_fix_at, trip.ended_at, trip.id))
+
+    def start(self, username, origin, destination, expected_minutes=None):
+        """Start a trip (ending the user's current one, if any)"""
+        self._expire()
+        trip = Trip(username, origin, destination, expected_minutes)
+        with self._transaction() as conn:
+            previous = self._load(conn, 'username = ? AND status = ?', (username, ACTIVE))
+            if previous is not None:
+                previous.end()
+                self._save(conn, previous)
+            conn.execute('INSERT INTO trips (id, username, status, state, last_fix_at) VALUES (?, ?, ?, ?, ?)',
+                         (trip.id, username, trip.status, trip.to_state(), trip.last_fix_at))
+        self.started += 1
+        info("Trip %s started for %s to %.5f,%.5f", trip.id, username, destination[0], destination[1])
+        return trip
+
+    def get(self, trip_id, track=False):
+        with self._pool.connection() as conn:
+            return self._load(conn, 'id = ?', (trip_id,), track)
+
+    def active_trip(self, username):
+        """The user's trip if it is still active"""
+        with self._pool.connection() as conn:
+            return self._load(conn, 'username = ? AND status = ?', (username, ACTIVE))
+
+    def add_fix(self, username, lat, lng, accuracy=0.0, at=None):
+        """Feed a fix to the user's active trip; returns (trip, alerts) or (None, [])"""
+        # Most fixes come from users without a trip: one indexed read, no write lock
+        with self._pool.connection() as conn:
+            if conn.execute('SELECT 1 FROM trips WHERE username = ? AND status = ?', (username, ACTIVE)).fetchone() is None:
+                return None, []
+        with self._transaction() as conn:
+            trip = self._load(conn, 'username = ? AND status = ?', (username, ACTIVE))
+            if trip is None:
+                return None, []
+            alerts = trip.add_fix(lat, lng, accuracy, at)
+            self._save(conn, trip)
+            conn.execute('INSERT INTO trip_fixes (trip_id, at, lat, lng) VALUES (?, ?, ?, ?)', (trip.id, *trip.track[-1]))
+            if trip.fixes > TRIP_TRACK_MAX and trip.fixes % 100 == 0:
+                conn.execute('DELETE FROM trip_fixes WHERE trip_id = ? AND rowid <= (SELECT rowid FROM trip_fixes '
+                             'WHERE trip_id = ? ORDER BY rowid DESC LIMIT 1 OFFSET ?)',
+                             (trip.id, trip.id, TRIP_TRACK_MAX))
+        for alert in alerts:
+            if alert["type"] in TRIP_NOTIFY_ALERTS and self.notify_fn is not None:
+                try:
+                    self.notify_fn(trip, alert)
+                except Exception as e:
+                    error("❌ Trip %s %s alert could not be sent: %s", trip.id, alert["type"], e)
+        return trip, alerts
+
+    def end(self, trip_id):
+        with self._transaction() as conn:
+            trip = self._load(conn, 'id = ?', (trip_id,))
+            if trip is not None:
+                trip.end()
+                self._save(conn, trip)
+        return trip
+
+    def _expire(self):
+        """Forget trips that finished, or went without a fix, more than idle_timeout ago"""
+        stale = 'SELECT id FROM trips WHERE COALESCE(ended_at, last_fix_at) < ?'
+        cutoff = time.time() - self.idle_timeout
+        with self._transaction() as conn:
+            conn.execute(f'DELETE FROM trip_fixes WHERE trip_id IN ({stale})', (cutoff,))
+            self.expired += conn.execute('DELETE FROM trips WHERE COALESCE(ended_at, last_fix_at) < ?', (cutoff,)).rowcount
+
+    def stats(self):
+        self._expire()
+        with self._pool.connection() as conn:
+            active, tracked, alerts = conn.execute(
+                'SELECT COALESCE(SUM(status = ?), 0), COUNT(*), COALESCE(SUM(alerts), 0) FROM trips', (ACTIVE,)).fetchone()
+        return {
+            "active": active,
+            "tracked": tracked,
+            "started": self.started,
+            "expired": self.expired,
+            "alerts": alerts
+        }
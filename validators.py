@@ -1,13 +1,63 @@
 """
 Input Validators - Validate all user inputs before database operations
 """
+import math
 import re
+from datetime import datetime
+import numpy as np
+
+USERNAME_RE = re.compile(r'^[a-zA-Z0-9_]+$')
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+PHONE_FORMATTING_RE = re.compile(r'[-()\s+]')
+NAME_RE = re.compile(r'^[a-zA-Z\s]+$')
+
+# Per-row error codes returned by validate_fix_columns (first failing check wins)
+FIX_OK = 0
+FIX_COORDINATES_NOT_NUMERIC = 1
+FIX_LATITUDE_RANGE = 2
+FIX_LONGITUDE_RANGE = 3
+FIX_ACCURACY_NOT_NUMERIC = 4
+FIX_ACCURACY_NEGATIVE = 5
+FIX_ACCURACY_TOO_LARGE = 6
+FIX_TIMESTAMP_INVALID = 7
+
+FIX_ERRORS = {
+    FIX_COORDINATES_NOT_NUMERIC: ("Coordinates", "Coordinates must be numbers"),
+    FIX_LATITUDE_RANGE: ("Coordinates", "Latitude must be between -90 and 90"),
+    FIX_LONGITUDE_RANGE: ("Coordinates", "Longitude must be between -180 and 180"),
+    FIX_ACCURACY_NOT_NUMERIC: ("Accuracy", "Accuracy must be a number"),
+    FIX_ACCURACY_NEGATIVE: ("Accuracy", "Accuracy cannot be negative"),
+    FIX_ACCURACY_TOO_LARGE: ("Accuracy", "Accuracy seems invalid (> 10km)"),
+    FIX_TIMESTAMP_INVALID: ("Timestamp", "Timestamp must be epoch seconds or ISO 8601")
+}
+
+MAX_ACCURACY = 10000
+# Last second of year 9999 in UTC+14, the easternmost zone: the largest epoch that
+# datetime.fromtimestamp converts to local time in every time zone
+MAX_EPOCH_SECONDS = 253402300799 - 14 * 3600
+
+# Saved place fences: circle radius bounds (meters) and polygon vertex limit
+MIN_PLACE_RADIUS = 10
+MAX_PLACE_RADIUS = 50000
+MAX_POLYGON_VERTICES = 200
+
+# FCM registration tokens are ~160 characters; leave room for format changes
+MAX_DEVICE_TOKEN_LENGTH = 255
+# Client-chosen SOS ids, so a resent /sos is recognised as the same alert
+SOS_ID_RE = re.compile(r'^[a-zA-Z0-9_-]{8,64}$')
+# Routine times: 24-hour HH:MM or HH:MM:SS
+TIME_OF_DAY_RE = re.compile(r'^([01]?\d|2[0-3]):[0-5]\d(:[0-5]\d)?$')
+
+# Risk heatmap tiles: deepest zoom level and grid size bounds (cells per side)
+MAX_TILE_ZOOM = 20
+MIN_TILE_SIZE = 4
+MAX_TILE_SIZE = 128
 
 def validate_username(username):
     """Validate username (3-50 chars, alphanumeric + underscore)"""
     if not username or len(username) < 3 or len(username) > 50:
         return False, "Username must be 3-50 characters"
-    if not re.match(r'^[a-zA-Z0-9_]+$', username):
+    if not USERNAME_RE.match(username):
         return False, "Username can only contain letters, numbers, and underscores"
     return True, "Valid"
 
@@ -15,8 +65,7 @@ def validate_email(email):
     """Validate email format"""
     if not email:
         return False, "Email is required"
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if not re.match(email_pattern, email):
+    if not EMAIL_RE.match(email):
         return False, "Invalid email format"
     return True, "Valid"
 
@@ -33,13 +82,39 @@ def validate_contact_phone(contact):
     if not contact:
         return False, "Contact is required"
     # Remove common formatting characters
-    clean_contact = re.sub(r'[-()\s+]', '', contact)
+    clean_contact = PHONE_FORMATTING_RE.sub('', contact)
     if not clean_contact.isdigit():
         return False, "Contact must be numeric (with optional formatting)"
     if len(clean_contact) < 10 or len(clean_contact) > 15:
         return False, "Contact must be 10-15 digits"
     return True, "Valid"
 
+def phone_key(contact):
+    """
+    Digits a phone number is matched on: the last 9, as emergency_contacts stores them.
+    Returns None if there are no digits.
+    """
+    digits = PHONE_FORMATTING_RE.sub('', str(contact))
+    if not digits.isdigit():
+        return None
+    return str(int(digits[-9:]))
+
+def validate_device_token(token):
+    """Validate an FCM registration token"""
+    if not token or not isinstance(token, str):
+        return False, "Token is required"
+    if len(token) > MAX_DEVICE_TOKEN_LENGTH or any(c.isspace() for c in token):
+        return False, f"Token must be at most {MAX_DEVICE_TOKEN_LENGTH} characters without spaces"
+    
+    return True, "Valid"
+
+def validate_sos_id(sos_id):
+    """Validate a client-supplied SOS id"""
+    if not isinstance(sos_id, str) or not SOS_ID_RE.match(sos_id):
+        return False, "SOS id must be 8-64 letters, digits, '-' or '_'"
+    
+    return True, "Valid"
+
 def validate_coordinates(lat, lng):
     """Validate latitude and longitude"""
     try:
@@ -47,6 +122,8 @@ def validate_coordinates(lat, lng):
         lng = float(lng)
     except (ValueError, TypeError):
         return False, "Coordinates must be numbers"
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        return False, "Coordinates must be finite numbers"
     
     if lat < -90 or lat > 90:
         return False, "Latitude must be between -90 and 90"
@@ -61,19 +138,60 @@ def validate_accuracy(accuracy):
         accuracy = float(accuracy)
     except (ValueError, TypeError):
         return False, "Accuracy must be a number"
+    if math.isnan(accuracy):
+        return False, "Accuracy must be a number"
     
     if accuracy < 0:
         return False, "Accuracy cannot be negative"
-    if accuracy > 10000:
+    if accuracy > MAX_ACCURACY:
         return False, "Accuracy seems invalid (> 10km)"
     
     return True, "Valid"
 
+def validate_place_radius(radius):
+    """Validate a circular place fence radius in meters"""
+    try:
+        radius = float(radius)
+    except (ValueError, TypeError):
+        return False, "Radius must be a number"
+    
+    if radius < MIN_PLACE_RADIUS or radius > MAX_PLACE_RADIUS:
+        return False, f"Radius must be between {MIN_PLACE_RADIUS} and {MAX_PLACE_RADIUS} meters"
+    
+    return True, "Valid"
+
+def validate_polygon(polygon):
+    """Validate a polygon fence given as a list of [lat, lng] vertices"""
+    if not isinstance(polygon, list) or len(polygon) < 3:
+        return False, "Polygon must have at least 3 vertices"
+    if len(polygon) > MAX_POLYGON_VERTICES:
+        return False, f"Polygon cannot have more than {MAX_POLYGON_VERTICES} vertices"
+    
+    for vertex in polygon:
+        if not isinstance(vertex, (list, tuple)) or len(vertex) != 2:
+            return False, "Polygon vertices must be [lat, lng] pairs"
+        valid, msg = validate_coordinates(vertex[0], vertex[1])
+        if not valid:
+            return False, msg
+    
+    return True, "Valid"
+
+def validate_tile(zoom, x, y, size):
+    """Validate XYZ tile coordinates and the requested grid size"""
+    if zoom < 0 or zoom > MAX_TILE_ZOOM:
+        return False, f"Zoom must be between 0 and {MAX_TILE_ZOOM}"
+    if not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        return False, f"Tile x and y must be between 0 and {2 ** zoom - 1} at zoom {zoom}"
+    if size < MIN_TILE_SIZE or size > MAX_TILE_SIZE:
+        return False, f"Size must be between {MIN_TILE_SIZE} and {MAX_TILE_SIZE}"
+    
+    return True, "Valid"
+
 def validate_name(name):
     """Validate name (2-100 chars, letters and spaces)"""
     if not name or len(name) < 2 or len(name) > 100:
         return False, "Name must be 2-100 characters"
-    if not re.match(r'^[a-zA-Z\s]+$', name):
+    if not NAME_RE.match(name):
         return False, "Name can only contain letters and spaces"
     return True, "Valid"
 
@@ -82,3 +200,79 @@ def validate_relation(relation):
     if relation and len(relation) > 50:
         return False, "Relation must be less than 50 characters"
     return True, "Valid"
+
+def validate_time_of_day(value):
+    """Validate a routine time (24-hour HH:MM or HH:MM:SS)"""
+    if not isinstance(value, str) or not TIME_OF_DAY_RE.match(value.strip()):
+        return False, "Time must be HH:MM or HH:MM:SS (24-hour)"
+    return True, "Valid"
+
+def validate_timestamp(timestamp):
+    """Validate optional fix timestamp (epoch seconds or ISO 8601 string)"""
+    if timestamp is None:
+        return True, "Valid"
+    if isinstance(timestamp, bool):
+        return False, "Timestamp must be epoch seconds or ISO 8601"
+    try:
+        if isinstance(timestamp, (int, float)):
+            datetime.fromtimestamp(timestamp)
+        else:
+            datetime.fromisoformat(str(timestamp))
+    except (ValueError, TypeError, OverflowError, OSError):
+        return False, "Timestamp must be epoch seconds or ISO 8601"
+    return True, "Valid"
+
+def to_float_array(values):
+    """
+    Column of numbers as a float64 array (NumPy arrays and array.array are not copied).
+    Values that cannot be converted become NaN.
+    """
+    try:
+        column = np.asarray(values, dtype=np.float64)
+        if column.ndim == 1:
+            return column
+    except (ValueError, TypeError):
+        pass
+    column = np.empty(len(values), dtype=np.float64)
+    for index, value in enumerate(values):
+        try:
+            column[index] = float(value)
+        except (ValueError, TypeError):
+            column[index] = np.nan
+    return column
+
+def validate_coordinates_array(lats, lngs):
+    """Vectorized validate_coordinates; returns a boolean mask of valid rows"""
+    lats = to_float_array(lats)
+    lngs = to_float_array(lngs)
+    return (lats >= -90) & (lats <= 90) & (lngs >= -180) & (lngs <= 180)
+
+def validate_accuracy_array(accuracies):
+    """Vectorized validate_accuracy; returns a boolean mask of valid rows"""
+    accuracies = to_float_array(accuracies)
+    return (accuracies >= 0) & (accuracies <= MAX_ACCURACY)
+
+def validate_fix_columns(lats, lngs, accuracies=None, timestamps=None):
+    """
+    Validate columns of location fixes in one pass.
+    timestamps are epoch seconds (NaN where a row has none).
+    Returns: (mask, codes) - boolean mask of valid rows and a uint8 FIX_* error code per row
+    """
+    lats = to_float_array(lats)
+    lngs = to_float_array(lngs)
+    codes = np.zeros(len(lats), dtype=np.uint8)
+    
+    # Assign from the last check to the first so each row keeps its first failure
+    if timestamps is not None:
+        timestamps = to_float_array(timestamps)
+        present = ~np.isnan(timestamps)
+        codes[present & ~((timestamps >= 0) & (timestamps <= MAX_EPOCH_SECONDS))] = FIX_TIMESTAMP_INVALID
+    if accuracies is not None:
+        accuracies = to_float_array(accuracies)
+        codes[accuracies > MAX_ACCURACY] = FIX_ACCURACY_TOO_LARGE
+        codes[accuracies < 0] = FIX_ACCURACY_NEGATIVE
+        codes[np.isnan(accuracies)] = FIX_ACCURACY_NOT_NUMERIC
+    codes[(lngs < -180) | (lngs > 180)] = FIX_LONGITUDE_RANGE
+    codes[(lats < -90) | (lats > 90)] = FIX_LATITUDE_RANGE
+    codes[np.isnan(lats) | np.isnan(lngs)] = FIX_COORDINATES_NOT_NUMERIC
+    return codes == FIX_OK, codes
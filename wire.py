@@ -0,0 +1,64 @@
+"""
+Wire Format - Compact binary encoding for batches of location fixes
+Body layout (little-endian):
+  4-byte header: b"SHL" + version byte (1)
+  N x 28-byte records: float64 lat, float64 lng, float32 accuracy, int64 timestamp (epoch ms, 0 = now)
+"""
+import numpy as np
+from validators import validate_fix_columns, MAX_EPOCH_SECONDS
+
+MAGIC = b"SHL"
+VERSION = 1
+HEADER = MAGIC + bytes([VERSION])
+HEADER_SIZE = len(HEADER)
+
+FIX_DTYPE = np.dtype([
+    ("lat", "<f8"),
+    ("lng", "<f8"),
+    ("accuracy", "<f4"),
+    ("timestamp", "<i8")
+])
+RECORD_SIZE = FIX_DTYPE.itemsize
+
+CONTENT_TYPE = "application/vnd.safeher.locations+binary"
+
+# Compared as int64, so no record is let through by float rounding near the bound
+MAX_TIMESTAMP_MS = MAX_EPOCH_SECONDS * 1000
+
+
+class WireFormatError(ValueError):
+    """Raised when a binary payload is malformed"""
+
+
+def decode_fixes(body):
+    """
+    Decode a binary payload into a structured NumPy array without copying the records.
+    The returned array is a read-only view on body.
+    """
+    view = memoryview(body)
+    if len(view) < HEADER_SIZE or bytes(view[:HEADER_SIZE - 1]) != MAGIC:
+        raise WireFormatError("Missing SHL header")
+    if view[HEADER_SIZE - 1] != VERSION:
+        raise WireFormatError(f"Unsupported wire format version {view[HEADER_SIZE - 1]}")
+    payload = view[HEADER_SIZE:]
+    if len(payload) % RECORD_SIZE:
+        raise WireFormatError(f"Payload length {len(payload)} is not a multiple of {RECORD_SIZE}")
+    return np.frombuffer(payload, dtype=FIX_DTYPE)
+
+
+def encode_fixes(lats, lngs, accuracies, timestamps_ms=None):
+    """Encode column arrays into a binary payload (used by clients, tests and benchmarks)"""
+    fixes = np.zeros(len(lats), dtype=FIX_DTYPE)
+    fixes["lat"] = lats
+    fixes["lng"] = lngs
+    fixes["accuracy"] = accuracies
+    if timestamps_ms is not None:
+        fixes["timestamp"] = timestamps_ms
+    return HEADER + fixes.tobytes()
+
+
+def validate_fixes(fixes):
+    """Vectorized range checks; returns a boolean mask of valid records"""
+    timestamps = fixes["timestamp"]
+    mask, _ = validate_fix_columns(fixes["lat"], fixes["lng"], fixes["accuracy"])
+    return mask & (timestamps >= 0) & (timestamps <= MAX_TIMESTAMP_MS)
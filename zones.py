@@ -0,0 +1,274 @@
+"""
+Zones - Registry of named risk zones backed by a grid-bucket spatial index
+Each zone is bucketed into every fixed-size lat/lng cell its bounding box touches,
+so a point lookup only tests the handful of zones registered in its own cell.
+A reload is announced through a generation file under spool/ that every worker
+process checks, so all of them serve the same zones.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from geo import point_in_polygon
+from logger import info, error
+
+ZONES_PATH = os.getenv(
+    'ZONES_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "risk_zones.json")
+)
+ZONE_INDEX_CELL = float(os.getenv('ZONE_INDEX_CELL', 0.05))
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+ZONES_GENERATION_PATH = os.getenv('ZONES_GENERATION_PATH', os.path.join(SPOOL_DIR, "zones.generation"))
+# Seconds between checks of the generation file by each worker
+ZONES_CHECK_INTERVAL = float(os.getenv('ZONES_CHECK_INTERVAL', 1.0))
+
+# Zones covering more buckets than this are kept in a short list checked by bounding box
+MAX_BUCKETS_PER_ZONE = 4096
+
+
+class Zone:
+    """A named polygon (list of (lat, lng) vertices) with a risk weight"""
+
+    __slots__ = ("id", "name", "weight", "reason", "polygon", "bbox", "is_box")
+
+    def __init__(self, zone_id, name, weight, reason, polygon):
+        self.id = zone_id
+        self.name = name
+        self.weight = float(weight)
+        self.reason = reason
+        self.polygon = [(float(lat), float(lng)) for lat, lng in polygon]
+        lats = [p[0] for p in self.polygon]
+        lngs = [p[1] for p in self.polygon]
+        self.bbox = (min(lats), min(lngs), max(lats), max(lngs))
+        # Axis-aligned rectangles need no edge test once the bounding box matches
+        self.is_box = len(self.polygon) == 4 and set(lats) == {self.bbox[0], self.bbox[2]} and \
+            set(lngs) == {self.bbox[1], self.bbox[3]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a zone from a JSON object with either "polygon" or "bbox" """
+        if "polygon" in data:
+            polygon = data["polygon"]
+        else:
+            min_lat, min_lng, max_lat, max_lng = data["bbox"]
+            polygon = [(min_lat, min_lng), (min_lat, max_lng), (max_lat, max_lng), (max_lat, min_lng)]
+        return cls(data["id"], data.get("name", data["id"]), data["weight"],
+                   data.get("reason", "High-risk zone detected"), polygon)
+
+    def contains(self, lat, lng):
+        """Point-in-polygon test (ray casting); points on the bounding box edge count as inside"""
+        min_lat, min_lng, max_lat, max_lng = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+            return False
+        if self.is_box:
+            return True
+        return point_in_polygon(self.polygon, lat, lng)
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "weight": self.weight, "reason": self.reason}
+
+
+class ZoneIndex:
+    """Immutable spatial index over a list of zones"""
+
+    def __init__(self, zones, cell=ZONE_INDEX_CELL):
+        self.zones = list(zones)
+        self.cell = cell
+        # Derived from the content, so every worker (and a restarted one) agrees on it
+        # and results cached against other zones are never served
+        content = json.dumps([cell] + [[z.id, z.weight, z.reason, z.polygon] for z in self.zones])
+        self.version = hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+        self.buckets = defaultdict(list)
+        self.large = []
+        for zone_index, zone in enumerate(self.zones):
+            min_lat, min_lng, max_lat, max_lng = zone.bbox
+            row0, col0 = self._key(min_lat, min_lng)
+            row1, col1 = self._key(max_lat, max_lng)
+            if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_BUCKETS_PER_ZONE:
+                self.large.append(zone_index)
+                continue
+            for row in range(row0, row1 + 1):
+                for col in range(col0, col1 + 1):
+                    self.buckets[(row, col)].append(zone_index)
+        self.buckets = dict(self.buckets)
+
+    @classmethod
+    def from_file(cls, path, cell=ZONE_INDEX_CELL):
+        """Load zones from a JSON file of the form {"zones": [...]}"""
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls([Zone.from_dict(z) for z in data.get("zones", [])], cell)
+
+    def _key(self, lat, lng):
+        return math.floor(lat / self.cell), math.floor(lng / self.cell)
+
+    def candidates(self, lat, lng):
+        """Indexes of zones whose bounding box may contain the point"""
+        if not (math.isfinite(lat) and math.isfinite(lng)):
+            # NaN/inf are in no zone (math.floor would raise)
+            return ()
+        bucket = self.buckets.get(self._key(lat, lng), ())
+        return list(bucket) + self.large if self.large else bucket
+
+    def lookup(self, lat, lng):
+        """All zones containing the point"""
+        return [self.zones[i] for i in self.candidates(lat, lng) if self.zones[i].contains(lat, lng)]
+
+    def max_zone(self, lat, lng):
+        """The highest-weight zone containing the point, or None"""
+        best = None
+        for i in self.candidates(lat, lng):
+            zone = self.zones[i]
+            if (best is None or zone.weight > best.weight) and zone.contains(lat, lng):
+                best = zone
+        return best
+
+    def crosses(self, min_lat, min_lng, max_lat, max_lng):
+        """
+        True if some zone may cover part of the box but not all of it: its bounding box
+        touches the box and it is not a rectangle covering the whole box
+        """
+        row0, col0 = self._key(min_lat, min_lng)
+        row1, col1 = self._key(max_lat, max_lng)
+        candidates = set(self.large)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                candidates.update(self.buckets.get((row, col), ()))
+        for i in candidates:
+            zone_min_lat, zone_min_lng, zone_max_lat, zone_max_lng = self.zones[i].bbox
+            touches = zone_min_lat <= max_lat and min_lat <= zone_max_lat and \
+                zone_min_lng <= max_lng and min_lng <= zone_max_lng
+            covers = self.zones[i].is_box and zone_min_lat <= min_lat and max_lat <= zone_max_lat and \
+                zone_min_lng <= min_lng and max_lng <= zone_max_lng
+            if touches and not covers:
+                return True
+        return False
+
+    def max_weights(self, lats, lngs):
+        """
+        Bulk lookup: highest containing zone weight per point.
+        Points are grouped by bucket so each bucket's candidates are fetched once.
+        Returns: (weights, zone_index) arrays, zone_index is -1 where no zone matches
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        weights = np.zeros(lats.shape, dtype=np.float32)
+        zone_index = np.full(lats.shape, -1, dtype=np.int64)
+        if not self.zones or lats.size == 0:
+            return weights, zone_index
+
+        # NaN/inf land in a bucket no zone is in, and fail every contains() test
+        with np.errstate(invalid="ignore"):
+            rows = np.floor(lats / self.cell).astype(np.int64).reshape(-1)
+            cols = np.floor(lngs / self.cell).astype(np.int64).reshape(-1)
+        flat_lats = lats.reshape(-1).tolist()
+        flat_lngs = lngs.reshape(-1).tolist()
+        best_weight = [0.0] * len(flat_lats)
+        best_zone = [-1] * len(flat_lats)
+
+        groups = defaultdict(list)
+        for point, key in enumerate(zip(rows.tolist(), cols.tolist())):
+            groups[key].append(point)
+
+        for key, points in groups.items():
+            candidates = self.buckets.get(key, [])
+            if self.large:
+                candidates = list(candidates) + self.large
+            for i in candidates:
+                zone = self.zones[i]
+                for point in points:
+                    if zone.weight > best_weight[point] and zone.contains(flat_lats[point], flat_lngs[point]):
+                        best_weight[point] = zone.weight
+                        best_zone[point] = i
+
+        weights[...] = np.asarray(best_weight, dtype=np.float32).reshape(lats.shape)
+        zone_index[...] = np.asarray(best_zone, dtype=np.int64).reshape(lats.shape)
+        return weights, zone_index
+
+    def stats(self):
+        return {
+            "zones": len(self.zones),
+            "buckets": len(self.buckets),
+            "large_zones": len(self.large),
+            "cell_deg": self.cell
+        }
+
+
+zone_index = ZoneIndex([])
+# Last generation file seen by this process: (mtime, inode), and when it was checked
+_generation = {"seen": None, "checked": 0.0}
+_sync_lock = threading.Lock()
+
+
+def _load(path):
+    global zone_index
+    new_index = ZoneIndex.from_file(path)
+    zone_index = new_index
+    info("Risk zones loaded from %s: %s zones in %s buckets (version %s)",
+         path, len(new_index.zones), len(new_index.buckets), new_index.version)
+    return new_index
+
+
+def _read_generation():
+    """((mtime, inode), zone version, path) of the last reload announced by any worker, or Nones"""
+    try:
+        with open(ZONES_GENERATION_PATH, encoding='utf-8') as f:
+            stat = os.fstat(f.fileno())
+            version, _, path = f.read().partition("\n")
+        return (stat.st_mtime_ns, stat.st_ino), version, path.strip() or ZONES_PATH
+    except FileNotFoundError:
+        return None, None, None
+
+
+def reload_zones(path=None):
+    """Rebuild the index from disk, swap it in and announce it to the other workers"""
+    path = os.path.abspath(path or ZONES_PATH)
+    new_index = _load(path)
+    os.makedirs(os.path.dirname(os.path.abspath(ZONES_GENERATION_PATH)), exist_ok=True)
+    temp_path = f"{ZONES_GENERATION_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(f"{new_index.version}\n{path}")
+    os.replace(temp_path, ZONES_GENERATION_PATH)
+    with _sync_lock:
+        _generation["seen"] = _read_generation()[0]
+    return new_index
+
+
+def sync_zones(now=None):
+    """Reload from disk if another worker announced a reload; checks at most every ZONES_CHECK_INTERVAL"""
+    now = time.monotonic() if now is None else now
+    if now - _generation["checked"] < ZONES_CHECK_INTERVAL or not _sync_lock.acquire(blocking=False):
+        return
+    try:
+        _generation["checked"] = now
+        seen, version, path = _read_generation()
+        if seen == _generation["seen"]:
+            return
+        _generation["seen"] = seen
+        if version != zone_index.version:
+            _load(path)
+    except Exception as e:
+        # Keep serving the current zones; the next announced reload tries again
+        error("Risk zone sync failed: %s", e)
+    finally:
+        _sync_lock.release()
+
+
+def get_zone_index():
+    """Current index (callers should hold on to the returned object for one lookup)"""
+    sync_zones()
+    return zone_index
+
+
+# A worker started after a reload loads the zones the others were told to load
+_generation["seen"], _, _path = _read_generation()
+_path = _path or ZONES_PATH
+if os.path.exists(_path):
+    try:
+        _load(_path)
+    except Exception as e:
+        error("Risk zone load failed, continuing without zones: %s", e)